@@ -0,0 +1,219 @@
+"""Per-class grade analytics for a term, computed with NumPy over whole columns.
+
+The spreadsheet's ``Total`` and ``Grade`` columns are stored as uploaded and
+are what the report emails show. The analytics recompute both from the
+scores (total = sum of the student's scores, grade = ``get_grade`` of their
+mean score), count where the two disagree, and describe every class:
+totals, mean scores and each assessment (mean, standard deviation,
+percentiles), a histogram of mean scores and the grade counts.
+
+Classes are independent, so a large multi-class term is summarized by a
+process pool, one task per class. Results are cached per term and
+``terms.data_version``, which every upload that changes the term bumps, so
+they are recomputed at most once per upload.
+"""
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from terms import get_assessments
+
+# Lowest mean score for each letter grade, best first; anything below the last is an F
+GRADE_THRESHOLDS = [(90, 'A'), (80, 'B'), (70, 'C'), (60, 'D')]
+GRADES = [grade for _, grade in GRADE_THRESHOLDS] + ['F']
+
+PERCENTILES = [10, 25, 50, 75, 90]
+HISTOGRAM_BINS = list(range(0, 101, 10))
+
+# Stored and recomputed totals closer than this are the same (spreadsheets round)
+TOTAL_TOLERANCE = 0.01
+
+# Ascending bounds for np.searchsorted and the grade each slot maps to ('F' below the first)
+_BOUNDS = np.array([bound for bound, _ in reversed(GRADE_THRESHOLDS)], dtype=float)
+_SLOT_GRADES = np.array(['F'] + [grade for _, grade in reversed(GRADE_THRESHOLDS)])
+
+
+def get_grade(average):
+    for bound, grade in GRADE_THRESHOLDS:
+        if average >= bound:
+            return grade
+    return 'F'
+
+
+def grade_array(averages):
+    """Vectorized ``get_grade``: letter grades for an array of mean scores ('' where NaN)."""
+    averages = np.asarray(averages, dtype=float)
+    grades = _SLOT_GRADES[np.searchsorted(_BOUNDS, averages, side='right')]
+    return np.where(np.isnan(averages), '', grades)
+
+
+def _round(value):
+    return round(float(value), 2)
+
+
+def describe(values):
+    # Count, mean, population standard deviation, range and percentiles, ignoring NaN
+    values = values[~np.isnan(values)]
+    if not values.size:
+        return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None,
+                'percentiles': dict.fromkeys((f'p{p}' for p in PERCENTILES))}
+    return {
+        'count': int(values.size),
+        'mean': _round(values.mean()),
+        'std': _round(values.std()),
+        'min': _round(values.min()),
+        'max': _round(values.max()),
+        'percentiles': {f'p{p}': _round(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))},
+    }
+
+
+def summarize(name, scores, stored_totals, stored_grades):
+    """Summary of one group of students; runs in the pool workers, so only arrays go in and out.
+
+    ``scores`` is a students x assessments matrix with NaN for missing
+    scores, ``stored_totals`` the uploaded totals (NaN when empty) and
+    ``stored_grades`` the letters of the uploaded grades ('' when empty).
+    """
+    counts = (~np.isnan(scores)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        totals = np.where(counts > 0, np.nansum(scores, axis=1), np.nan)
+        averages = totals / counts
+    grades = grade_array(averages)
+
+    graded = grades != ''
+    mismatched_grades = graded & (stored_grades != '') & (grades != stored_grades)
+    stored_letters, stored_counts = np.unique(stored_grades[stored_grades != ''], return_counts=True)
+    histogram, _ = np.histogram(np.clip(averages[graded], 0, 100), bins=HISTOGRAM_BINS)
+
+    return {
+        'class': name,
+        'students': int(len(scores)),
+        'total': describe(totals),
+        'average': describe(averages),
+        'assessments': [describe(scores[:, column]) for column in range(scores.shape[1])],
+        'grades': {grade: int(np.count_nonzero(grades == grade)) for grade in GRADES},
+        'stored_grades': {str(grade): int(count) for grade, count in zip(stored_letters, stored_counts)},
+        'histogram': [int(count) for count in histogram],
+        # NaN never compares greater, so students without scores or an uploaded total are skipped
+        'mismatched_totals': int(np.count_nonzero(np.abs(totals - stored_totals) > TOTAL_TOLERANCE)),
+        'mismatched_grades': int(np.count_nonzero(mismatched_grades)),
+    }
+
+
+def _summarize_task(task):
+    return summarize(*task)
+
+
+def load_term(c, term_id, assessments):
+    """The term's students as arrays: ``(classes, scores, stored_totals, stored_grades)``.
+
+    ``scores`` has one column per assessment, in term order.
+    """
+    # One row per student with the scores already pivoted: a primary-key lookup per score is
+    # faster than joining the long table and pivoting the million-row result in Python
+    lookups = ', '.join('(SELECT score FROM scores WHERE student_id = s.id AND assessment_id = ?)'
+                        for _ in assessments)
+    plain = c.connection.cursor()
+    plain.row_factory = None
+    rows = plain.execute(f"SELECT s.class, s.grade, s.total{', ' if lookups else ''}{lookups} "
+                         "FROM students s WHERE s.term_id = ?", [a['id'] for a in assessments] + [term_id]).fetchall()
+    classes = np.array([row[0] or '' for row in rows])
+    # Letters only, so an uploaded 'B+' agrees with a recomputed 'B'
+    stored_grades = np.array([(row[1] or '').strip()[:1].upper() for row in rows], dtype='<U1')
+    values = np.array([row[2:] for row in rows], dtype=float).reshape(len(rows), len(assessments) + 1)  # None -> NaN
+    return classes, values[:, 1:], values[:, 0], stored_grades
+
+
+def class_tasks(classes, scores, stored_totals, stored_grades):
+    # One summarize() argument tuple per class, in class name order
+    names, inverse = np.unique(classes, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(1, len(names)))
+    return [(str(name), scores[rows], stored_totals[rows], stored_grades[rows])
+            for name, rows in zip(names, np.split(order, bounds))]
+
+
+class TermAnalytics:
+    """Computes and caches the analytics of a term.
+
+    With ``workers`` > 0, terms of at least ``parallel_min_rows`` students
+    in more than one class are summarized on a process pool (started on
+    first use with the 'spawn' method, so workers never inherit the web
+    process's threads or database connections). Up to ``cache_size`` terms
+    are kept; an entry is used only while the term's ``data_version`` is
+    unchanged.
+    """
+
+    def __init__(self, workers=0, parallel_min_rows=50000, cache_size=32):
+        self.workers = workers
+        self.parallel_min_rows = parallel_min_rows
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _cached(self, term_id, version):
+        with self._lock:
+            entry = self._cache.get(term_id)
+            if entry is None or entry[0] != version:
+                return None
+            self._cache.move_to_end(term_id)
+            return entry[1]
+
+    def _store(self, term_id, version, result):
+        with self._lock:
+            self._cache[term_id] = (version, result)
+            self._cache.move_to_end(term_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def compute(self, c, term_id):
+        start = time.perf_counter()
+        assessments = get_assessments(c, term_id)
+        classes, scores, stored_totals, stored_grades = load_term(c, term_id, assessments)
+        tasks = class_tasks(classes, scores, stored_totals, stored_grades)
+
+        parallel = self.workers > 0 and len(tasks) > 1 and len(scores) >= self.parallel_min_rows
+        if parallel:
+            # The classes go to the pool while this thread summarizes the whole term
+            pending = self._get_pool().map(_summarize_task, tasks)
+            overall = summarize('', scores, stored_totals, stored_grades)
+            summaries = list(pending)
+        else:
+            overall = summarize('', scores, stored_totals, stored_grades)
+            summaries = [summarize(*task) for task in tasks]
+
+        del overall['class']
+        for summary in [overall, *summaries]:
+            summary['assessments'] = [dict(code=a['code'], label=a['label'], **stats)
+                                      for a, stats in zip(assessments, summary['assessments'])]
+        return {
+            'overall': overall,
+            'classes': summaries,
+            'grade_thresholds': [{'grade': grade, 'min_average': bound} for bound, grade in GRADE_THRESHOLDS],
+            'histogram_bins': HISTOGRAM_BINS,
+            'parallel': parallel,
+            'compute_ms': round((time.perf_counter() - start) * 1000, 1),
+        }
+
+    def get(self, c, term_id):
+        """``(result, cached)`` for the term, computing it if an upload changed the term since."""
+        # Read the version before the data: a concurrent upload then at worst causes one extra recompute
+        version = c.execute("SELECT data_version FROM terms WHERE id = ?", (term_id,)).fetchone()[0]
+        result = self._cached(term_id, version)
+        if result is not None:
+            return result, True
+        result = self.compute(c, term_id)
+        self._store(term_id, version, result)
+        return result, False
@@ -1,32 +1,147 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, stream_with_context
 from flask_mail import Mail, Message
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 import os
-import pandas as pd
+import hmac
 import sqlite3
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import db
+import metrics
 from datetime import datetime
 import json
+from datetime import timedelta
 from functools import wraps
+from jobs import JobQueue, init_job_tables
+from smtp_pool import SMTPPool
+from async_sender import IN_FLIGHT, NOT_SENT, AsyncEngineError, AsyncSendEngine, build_email
+from credentials import CredentialCipher, CredentialsError, has_key
+import mailers
+from mailers import MailAccountError
+from ratelimit import SendThrottle
+from events import EventBroker, encode, reconnect_later
+import retry
+from importer import ImportValidationError, iter_frames, read_frame, import_students, required_columns
+import dal
+import stats
+import terms
+from terms import TermError
+import sessions
+import users
+from email_render import render_report, report_fingerprint
+from export import ExportError, stream_export
+from report_pdf import PdfRenderer, sheet_filename
+from pagination import PaginationError, decode_cursor, page, parse_date_range, parse_fields, parse_limit
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
+app.config['DATABASE'] = 'student_results.db'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Import uploads chunk by chunk from the request stream instead of saving them first
+app.config['STREAMING_IMPORT'] = os.environ.get('STREAMING_IMPORT', '1') == '1'
+app.config['IMPORT_CHUNK_SIZE'] = int(os.environ.get('IMPORT_CHUNK_SIZE', 10000))
+# 'merge' upserts on (email, class) and keeps student ids; 'replace' deletes and reinserts everything
+app.config['IMPORT_MODE'] = os.environ.get('IMPORT_MODE', 'merge')
 
-# Email configuration
+# Email configuration: the app-wide account, used by users who have not added their own in Settings
+# (server and port are also the defaults for those accounts)
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 587
 app.config['MAIL_USE_TLS'] = True
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME', '')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD', '')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_USERNAME', '')
+# Fernet key(s) encrypting the users' stored mail passwords (see credentials.py); derived from SECRET_KEY if unset,
+# unless SECRET_KEY is still the placeholder above
+app.config['MAIL_CREDENTIALS_KEY'] = os.environ.get('MAIL_CREDENTIALS_KEY', '')
+# Jobs with at least this many recipients are spread over all of the user's sender accounts (0 = never)
+app.config['SEND_SHARD_MIN'] = int(os.environ.get('SEND_SHARD_MIN', 200))
 
+# Number of background threads draining the send queue
+app.config['SEND_WORKERS'] = int(os.environ.get('SEND_WORKERS', 4))
+# Queue items each worker takes at once (one student lookup query per batch)
+app.config['SEND_BATCH_SIZE'] = int(os.environ.get('SEND_BATCH_SIZE', 50))
+# Number of SMTP connections kept open and shared by the send workers
+app.config['SMTP_POOL_SIZE'] = int(os.environ.get('SMTP_POOL_SIZE', app.config['SEND_WORKERS']))
+# 'flask-mail' (threaded SMTP pool) or 'async' (aiosmtplib engine, optional dependency)
+app.config['SEND_ENGINE'] = os.environ.get('SEND_ENGINE', 'flask-mail')
+# Async engine: connections to open, messages in flight, retries for transient failures
+app.config['ASYNC_POOL_SIZE'] = int(os.environ.get('ASYNC_POOL_SIZE', 8))
+app.config['ASYNC_CONCURRENCY'] = int(os.environ.get('ASYNC_CONCURRENCY', 32))
+app.config['ASYNC_RETRIES'] = int(os.environ.get('ASYNC_RETRIES', 2))
+# Longest a send worker waits for one batch from the async engine; messages not yet sent by then
+# are retried later, those still being sent are failed without a retry
+app.config['ASYNC_BATCH_TIMEOUT'] = int(os.environ.get('ASYNC_BATCH_TIMEOUT', 900))
+# Outbound rate limits of each sender account (Gmail: about 500/day, 2000/day on Workspace)
+app.config['SEND_RATE_PER_SECOND'] = float(os.environ.get('SEND_RATE_PER_SECOND', 5))
+app.config['SEND_BURST'] = int(os.environ.get('SEND_BURST', 10))
+app.config['SEND_DAILY_LIMIT'] = int(os.environ.get('SEND_DAILY_LIMIT', 500))  # 0 = no daily budget
+# Longest pause after a throttling reply (421/454), and how often one message is retried
+app.config['SEND_MAX_BACKOFF'] = int(os.environ.get('SEND_MAX_BACKOFF', 300))
+app.config['SEND_THROTTLE_RETRIES'] = int(os.environ.get('SEND_THROTTLE_RETRIES', 8))
+# Live send progress (/api/events): events kept for reconnecting watchers, and seconds between
+# keepalives on an idle stream
+app.config['EVENTS_BUFFER'] = int(os.environ.get('EVENTS_BUFFER', 10000))
+app.config['EVENTS_KEEPALIVE'] = int(os.environ.get('EVENTS_KEEPALIVE', 15))
+# Every open stream holds a server thread: at most this many per process (keep it below the
+# threads per worker), and streams of users with nothing being sent end and are reopened by the
+# browser after EVENTS_IDLE_RETRY seconds
+app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', 4))
+app.config['EVENTS_IDLE_RETRY'] = int(os.environ.get('EVENTS_IDLE_RETRY', 30))
+# Class analytics: process pool size (0 = compute in the request thread) and the smallest term
+# worth splitting across it; results are cached per term until the next upload
+app.config['ANALYTICS_WORKERS'] = int(os.environ.get('ANALYTICS_WORKERS', min(os.cpu_count() or 1, 4)))
+app.config['ANALYTICS_PARALLEL_MIN_ROWS'] = int(os.environ.get('ANALYTICS_PARALLEL_MIN_ROWS', 50000))
+# Transient send failures are retried from the job queue with exponential backoff
+app.config['RETRY_MAX_ATTEMPTS'] = int(os.environ.get('RETRY_MAX_ATTEMPTS', 5))
+app.config['RETRY_BASE_DELAY'] = int(os.environ.get('RETRY_BASE_DELAY', 60))
+app.config['RETRY_MAX_DELAY'] = int(os.environ.get('RETRY_MAX_DELAY', 3600))
+# /metrics is open unless METRICS_TOKEN is set; then scrapers send "Authorization: Bearer <token>"
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Per-request cProfile, for requests sent with "X-Profile: 1" or ?profile=1; off in production
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS', '0') == '1'
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+# Sessions live in the database and end after this long without a request
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=float(os.environ.get('SESSION_LIFETIME_HOURS', 24)))
+# Per-process cache of signed-in users' rows and settings
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+# Printable report card attached to every results email (needs fpdf2); PDF_FONT is a TrueType font
+# for names outside Latin-1, PDF_LOGO an image for the top of the sheet
+app.config['PDF_ATTACHMENTS'] = os.environ.get('PDF_ATTACHMENTS', '0') == '1'
+app.config['PDF_TITLE'] = os.environ.get('PDF_TITLE', 'Report Card')
+app.config['PDF_FONT'] = os.environ.get('PDF_FONT', '')
+app.config['PDF_LOGO'] = os.environ.get('PDF_LOGO', '')
+# Process pool that draws the sheets (0 = on the send threads), and where finished sheets are kept
+# so an unchanged report is never drawn twice
+app.config['PDF_WORKERS'] = int(os.environ.get('PDF_WORKERS', min(os.cpu_count() or 1, 4)))
+app.config['PDF_CACHE_DIR'] = os.environ.get('PDF_CACHE_DIR', 'pdf_cache')
+
+db.init_app(app)
+metrics.init_app(app)
+app.session_interface = sessions.SQLiteSessionInterface()
+user_cache = users.UserCache(size=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
 mail = Mail(app)
+smtp_pool = SMTPPool(mail, size=app.config['SMTP_POOL_SIZE'])
+send_throttle = SendThrottle.from_config(app.config)
+# The app-wide account; the async engine is created on first use so aiosmtplib is only needed when selected
+default_mailer = mailers.Mailer(app.config['MAIL_DEFAULT_SENDER'], smtp_pool, send_throttle,
+                                lambda throttle: AsyncSendEngine.from_config(app.config, throttle=throttle))
+credential_cipher = None
+credential_cipher_lock = threading.Lock()
+send_events = EventBroker(capacity=app.config['EVENTS_BUFFER'])
+event_streams = threading.BoundedSemaphore(app.config['EVENTS_MAX_STREAMS'])
+term_analytics = None
+term_analytics_lock = threading.Lock()
+pdf_renderer = None
+pdf_renderer_lock = threading.Lock()
 
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -37,9 +152,115 @@ ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'xls'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Schema migrations, applied in order by init_db(); append new ones, never edit old ones
+MIGRATIONS = [
+    # 1: indexes for the per-user filters and sorts behind /api/students, /api/stats and /api/logs
+    [
+        "CREATE INDEX IF NOT EXISTS idx_students_uploaded_by ON students (uploaded_by, id)",
+        "CREATE INDEX IF NOT EXISTS idx_email_logs_sent_by_status ON email_logs (sent_by, status)",
+        "CREATE INDEX IF NOT EXISTS idx_email_logs_sent_by_date ON email_logs (sent_by, sent_date DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_send_job_items_job_status ON send_job_items (job_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_send_job_items_status ON send_job_items (status)",
+    ],
+    # 2: keyset pagination orders logs by (sent_date, id) and students by id within a class
+    [
+        "CREATE INDEX IF NOT EXISTS idx_email_logs_sent_by_date_id ON email_logs (sent_by, sent_date DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_email_logs_sent_by_status_date ON email_logs (sent_by, status, sent_date DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_students_uploaded_by_class ON students (uploaded_by, class, id)",
+        "DROP INDEX IF EXISTS idx_email_logs_sent_by_date",
+        "DROP INDEX IF EXISTS idx_email_logs_sent_by_status",
+    ],
+    # 3: per-user dashboard statistics, backfilled from the existing rows
+    [
+        stats.init_stats_table,
+        stats.rebuild,
+    ],
+    # 4: retry queue; every log row records which job item and attempt it belongs to
+    [
+        "ALTER TABLE send_job_items ADD COLUMN attempts INTEGER DEFAULT 0",
+        "ALTER TABLE send_job_items ADD COLUMN next_attempt_at TIMESTAMP",
+        "ALTER TABLE email_logs ADD COLUMN attempt INTEGER DEFAULT 1",
+        "ALTER TABLE email_logs ADD COLUMN job_item_id INTEGER REFERENCES send_job_items (id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_email_logs_item_attempt ON email_logs (job_item_id, attempt) "
+        "WHERE job_item_id IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_send_job_items_status_next ON send_job_items (status, next_attempt_at)",
+        "DROP INDEX IF EXISTS idx_send_job_items_status",
+    ],
+    # 5: report fingerprints, so an unchanged report is never sent to the same student twice
+    [
+        "ALTER TABLE email_logs ADD COLUMN fingerprint TEXT",
+        "ALTER TABLE send_job_items ADD COLUMN fingerprint TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_email_logs_sent_fingerprint ON email_logs (sent_by, fingerprint) "
+        "WHERE status = 'success' AND fingerprint IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_send_job_items_fingerprint ON send_job_items (fingerprint) "
+        "WHERE fingerprint IS NOT NULL",
+    ],
+    # 6: merge imports match students on (email, class); keep the newest copy of any duplicate first
+    [
+        "DELETE FROM students WHERE id NOT IN "
+        "(SELECT MAX(id) FROM students GROUP BY uploaded_by, email, IFNULL(class, ''))",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_students_user_email_class "
+        "ON students (uploaded_by, email, IFNULL(class, ''))",
+        stats.rebuild,
+    ],
+    # 7: terms, classes, configurable assessments and long-format scores; a students row is now one
+    # enrollment in a term and every per-user student query is scoped to a term
+    [
+        terms.init_term_tables,
+        stats.init_term_stats_table,
+        "ALTER TABLE students ADD COLUMN term_id INTEGER REFERENCES terms (id)",
+        "ALTER TABLE students ADD COLUMN class_id INTEGER REFERENCES classes (id)",
+        terms.backfill_terms,
+        "ALTER TABLE students DROP COLUMN hw1",
+        "ALTER TABLE students DROP COLUMN participation",
+        "ALTER TABLE students DROP COLUMN q1",
+        "ALTER TABLE students DROP COLUMN final_khmer",
+        "ALTER TABLE students DROP COLUMN final_english",
+        "ALTER TABLE user_stats DROP COLUMN total_students",
+        "ALTER TABLE user_stats DROP COLUMN avg_hw1",
+        "ALTER TABLE user_stats DROP COLUMN avg_participation",
+        "ALTER TABLE user_stats DROP COLUMN avg_q1",
+        "ALTER TABLE user_stats DROP COLUMN avg_final_khmer",
+        "ALTER TABLE user_stats DROP COLUMN avg_final_english",
+        "ALTER TABLE user_stats DROP COLUMN avg_total",
+        "DROP INDEX IF EXISTS idx_students_user_email_class",
+        "DROP INDEX IF EXISTS idx_students_uploaded_by",
+        "DROP INDEX IF EXISTS idx_students_uploaded_by_class",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_students_term_email_class "
+        "ON students (term_id, email, IFNULL(class, ''))",
+        "CREATE INDEX IF NOT EXISTS idx_students_term ON students (term_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_students_term_class ON students (term_id, class, id)",
+        stats.rebuild_terms,
+    ],
+    # 8: uploads bump a term's data_version, which keys the cached analytics
+    [
+        "ALTER TABLE terms ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0",
+    ],
+    # 9: server-side sessions; settings_version keys the cached user settings
+    [
+        sessions.init_session_table,
+        "ALTER TABLE users ADD COLUMN settings_version INTEGER NOT NULL DEFAULT 0",
+    ],
+    # 10: per-user sender accounts; logs record the address each email went out from
+    [
+        mailers.init_mail_account_table,
+        "ALTER TABLE email_logs ADD COLUMN sent_from TEXT",
+        "ALTER TABLE send_jobs ADD COLUMN sharded INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_email_logs_sent_from_date ON email_logs (sent_from, sent_date) "
+        "WHERE status = 'success'",
+    ],
+]
+
+# Columns the list endpoints can return (see the ?fields= projection)
+# ('scores' is not a column: it is the student's {assessment code: score} from the scores table)
+STUDENT_FIELDS = ['id', 'first_name', 'last_name', 'email', 'class', 'scores', 'total', 'grade', 'comments',
+                  'upload_date', 'uploaded_by', 'term_id', 'class_id']
+LOG_FIELDS = ['id', 'student_id', 'student_name', 'student_email', 'status', 'sent_date', 'sent_by', 'error_message',
+              'attempt']
+
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('student_results.db')
+    conn = db.get_connection(app.config['DATABASE'])
     c = conn.cursor()
     
     # Users table
@@ -51,7 +272,7 @@ def init_db():
                   full_name TEXT NOT NULL,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     
-    # Students table
+    # Students table (migration 7 moves the score columns into the scores table)
     c.execute('''CREATE TABLE IF NOT EXISTS students
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   first_name TEXT NOT NULL,
@@ -83,22 +304,42 @@ def init_db():
                   FOREIGN KEY (student_id) REFERENCES students (id),
                   FOREIGN KEY (sent_by) REFERENCES users (id))''')
     
-    # Create default admin user
-    default_password = generate_password_hash('admin123')
-    try:
-        c.execute("INSERT INTO users (username, password, email, full_name) VALUES (?, ?, ?, ?)",
-                  ('admin', default_password, 'admin@school.com', 'Administrator'))
-    except sqlite3.IntegrityError:
-        pass  # User already exists
+    # Background send queue tables
+    init_job_tables(c)
+    
+    # Create default admin user (hashing is slow, so only when it is missing)
+    if not c.execute("SELECT 1 FROM users WHERE username = 'admin'").fetchone():
+        default_password = generate_password_hash('admin123')
+        try:
+            c.execute("INSERT INTO users (username, password, email, full_name) VALUES (?, ?, ?, ?)",
+                      ('admin', default_password, 'admin@school.com', 'Administrator'))
+        except sqlite3.IntegrityError:
+            pass  # Created by another process meanwhile
     
     conn.commit()
-    conn.close()
+    
+    db.migrate(conn, MIGRATIONS)
+
+# Application factory for WSGI servers (see wsgi.py and gunicorn.conf.py): creates or migrates the
+# schema and starts the send workers, in one process only when the server runs several
+def create_app(send_workers=True):
+    init_db()
+    if not has_key(app.config):
+        print('WARNING: neither MAIL_CREDENTIALS_KEY nor a SECRET_KEY of your own is set; teachers cannot '
+              'save mail accounts until one is set in .env')
+    # A server may fork after this; no SQLite connection must be shared with its workers
+    db.close_connection(app.config['DATABASE'])
+    if send_workers:
+        job_queue.start_elected(app.config['DATABASE'] + '.send.lock')
+    return app
 
 # Login required decorator
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        # The cached user row; a user deleted meanwhile is signed out
+        if 'user_id' not in session or current_user_settings() is None:
+            session.clear()
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
@@ -117,16 +358,20 @@ def login():
         username = data.get('username')
         password = data.get('password')
         
-        conn = sqlite3.connect('student_results.db')
-        conn.row_factory = sqlite3.Row
+        conn = db.get_db()
         c = conn.cursor()
         user = c.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-        conn.close()
         
         if user and check_password_hash(user['password'], password):
+            # A new session id on every login, so a session id seen before cannot be reused
+            session.clear()
+            session.regenerate()
+            session.settings_version = user['settings_version']
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['full_name'] = user['full_name']
+            sessions.purge_expired(c)
+            conn.commit()
             return jsonify({'success': True, 'message': 'Login successful'})
         
         return jsonify({'success': False, 'message': 'Invalid username or password'}), 401
@@ -163,7 +408,88 @@ def logs_page():
 def settings_page():
     return render_template('settings.html')
 
+# The signed-in user's row and settings (see users.py); hot requests never read the users table
+def current_user_settings():
+    return user_cache.get(db.get_db().cursor(), session['user_id'], session.settings_version)
+
+# Call in the transaction that changes a user's settings, before committing it
+def settings_changed(c):
+    user_id = session['user_id']
+    session.settings_version = users.bump_settings_version(c, user_id)
+    user_cache.invalidate(user_id)
+
+# The term a request names with term_id, or the user's current term
+def request_term(term_id=None):
+    if term_id not in (None, ''):
+        return terms.resolve_term(db.get_db().cursor(), session['user_id'], term_id)
+    term = current_user_settings()['current_term']
+    if term is None:
+        conn = db.get_db()
+        term = terms.get_current_term(conn.cursor(), session['user_id'])  # creates the user's first term
+        settings_changed(conn.cursor())
+        conn.commit()
+    return dict(term)
+
 # API Endpoints
+@app.route('/api/terms', methods=['GET'])
+@login_required
+def get_terms():
+    request_term()  # make sure there is a current term
+    return jsonify({'success': True, 'terms': terms.list_terms(db.get_db().cursor(), session['user_id'])})
+
+@app.route('/api/terms', methods=['POST'])
+@login_required
+def create_term():
+    data = request.get_json(silent=True) or {}
+    conn = db.get_db()
+    try:
+        request_term()  # a new term copies the current term's assessments
+        term = terms.create_term(conn.cursor(), session['user_id'], data.get('name'), data.get('assessments'),
+                                 make_current=data.get('make_current', True))
+        if term['is_current']:
+            settings_changed(conn.cursor())
+        conn.commit()
+    except TermError as e:
+        conn.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    return jsonify({
+        'success': True,
+        'message': f'Created term "{term["name"]}"',
+        'term': term,
+        'assessments': terms.get_assessments(conn.cursor(), term['id'])
+    }), 201
+
+@app.route('/api/terms/<int:term_id>', methods=['GET'])
+@login_required
+def get_term(term_id):
+    c = db.get_db().cursor()
+    term = terms.get_term(c, session['user_id'], term_id)
+    
+    if not term:
+        return jsonify({'success': False, 'message': 'Term not found'}), 404
+    
+    return jsonify({
+        'success': True,
+        'term': term,
+        'assessments': terms.get_assessments(c, term_id),
+        'classes': terms.list_classes(c, term_id)
+    })
+
+@app.route('/api/terms/<int:term_id>/activate', methods=['POST'])
+@login_required
+def activate_term(term_id):
+    conn = db.get_db()
+    term = terms.get_term(conn.cursor(), session['user_id'], term_id)
+    
+    if not term:
+        return jsonify({'success': False, 'message': 'Term not found'}), 404
+    
+    terms.set_current_term(conn.cursor(), session['user_id'], term_id)
+    settings_changed(conn.cursor())
+    conn.commit()
+    return jsonify({'success': True, 'message': f'"{term["name"]}" is now the current term'})
+
 @app.route('/api/upload', methods=['POST'])
 @login_required
 def upload_file():
@@ -178,50 +504,49 @@ def upload_file():
     if not allowed_file(file.filename):
         return jsonify({'success': False, 'message': 'Invalid file type. Please upload CSV or Excel file'}), 400
     
+    mode = request.form.get('mode', app.config['IMPORT_MODE'])
+    
+    try:
+        term = request_term(request.form.get('term_id'))
+    except TermError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
     try:
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        conn = db.get_db()
+        # The columns to read and validate come from the term's assessments
+        columns = required_columns(terms.get_assessments(conn.cursor(), term['id']))
         
-        # Read file based on extension
-        if filename.endswith('.csv'):
-            df = pd.read_csv(filepath)
+        if app.config['STREAMING_IMPORT']:
+            # Validate and insert chunk by chunk straight from the request stream
+            frames = iter_frames(file.stream, filename.lower(), app.config['IMPORT_CHUNK_SIZE'], columns)
+            count, rows_per_second, summary = import_students(conn, frames, session['user_id'], mode, term['id'])
         else:
-            df = pd.read_excel(filepath)
-        
-        # Validate required columns
-        required_columns = ['first name', 'last name', 'email', 'class', 'hw1', 'participation', 'q1', 'final khmer', 'final english', 'total', 'grade', 'comments']
-        missing_columns = [col for col in required_columns if col not in df.columns.str.lower()]
-        
-        if missing_columns:
-            os.remove(filepath)
-            return jsonify({'success': False, 'message': f'Missing columns: {", ".join(missing_columns)}'}), 400
-        
-        # Normalize column names
-        df.columns = df.columns.str.lower()
-        
-        # Store in database
-        conn = sqlite3.connect('student_results.db')
-        c = conn.cursor()
-        
-        # Clear existing students for this upload
-        c.execute("DELETE FROM students WHERE uploaded_by = ?", (session['user_id'],))
-        
-        for _, row in df.iterrows():
-            c.execute('''INSERT INTO students 
-                         (first_name, last_name, email, class, hw1, participation, q1, final_khmer, final_english, total, grade, comments, uploaded_by)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                      (row['first name'], row['last name'], row['email'], row['class'], 
-                       row['hw1'], row['participation'], row['q1'], row['final khmer'], 
-                       row['final english'], row['total'], row['grade'], row['comments'], session['user_id']))
-        
-        conn.commit()
-        conn.close()
-        
-        # Clean up file
-        os.remove(filepath)
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            file.save(filepath)
+            try:
+                # Read file based on extension (only the columns we import)
+                df = read_frame(filepath, columns)
+                count, rows_per_second, summary = import_students(conn, [df], session['user_id'], mode,
+                                                                  term['id'])
+            finally:
+                # Clean up file
+                os.remove(filepath)
         
-        return jsonify({'success': True, 'message': f'Successfully uploaded {len(df)} students', 'count': len(df)})
+        return jsonify({
+            'success': True,
+            'message': (f"Successfully uploaded {count} students: {summary['added']} added, "
+                        f"{summary['changed']} changed, {summary['removed']} removed, "
+                        f"{summary['unchanged']} unchanged"),
+            'count': count,
+            'mode': mode,
+            'term': term,
+            'summary': summary,
+            'rows_per_second': rows_per_second
+        })
+    
+    except ImportValidationError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error processing file: {str(e)}'}), 500
@@ -229,14 +554,218 @@ def upload_file():
 @app.route('/api/students', methods=['GET'])
 @login_required
 def get_students():
-    conn = sqlite3.connect('student_results.db')
-    conn.row_factory = sqlite3.Row
+    args = request.args
+    try:
+        limit = parse_limit(args.get('limit'))
+        fields = parse_fields(args.get('fields'), STUDENT_FIELDS, ['id'])
+        cursor = decode_cursor(args.get('cursor'), (int,))
+        term = request_term(args.get('term_id'))
+    except (PaginationError, TermError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    # Only the term's rows are read (idx_students_term / idx_students_term_class)
+    where = ['term_id = ?']
+    params = [term['id']]
+    if args.get('class'):
+        where.append('class = ?')
+        params.append(args['class'])
+    if args.get('grade'):
+        where.append('grade = ?')
+        params.append(args['grade'])
+    if args.get('search'):
+        where.append('(first_name LIKE ? OR last_name LIKE ? OR email LIKE ?)')
+        params.extend([f"%{args['search']}%"] * 3)
+    if cursor:
+        # Keyset: continue strictly after the last row of the previous page
+        where.append('id < ?')
+        params.append(cursor[0])
+    
+    c = db.get_db().cursor()
+    columns = [field for field in fields if field != 'scores']
+    students = c.execute(f"SELECT {', '.join(columns)} FROM students WHERE {' AND '.join(where)} "
+                         "ORDER BY id DESC LIMIT ?", params + [limit + 1]).fetchall()
+    
+    students_list, next_cursor = page(students, limit, ['id'])
+    if 'scores' in fields:
+        scores = dal.fetch_scores(c, [student['id'] for student in students_list])
+        for student in students_list:
+            student['scores'] = {code: score for code, _, score in scores.get(student['id'], [])}
+    return jsonify({
+        'success': True,
+        'term': term,
+        'assessments': [{'code': a['code'], 'label': a['label']} for a in terms.get_assessments(c, term['id'])],
+        'students': students_list,
+        'next_cursor': next_cursor
+    })
+
+# Build the results email for one student row, with its report card when one was rendered
+def build_result_message(student, sender, pdf=None):
+    subject, body, html = render_report(student)
+    msg = Message(subject=subject, recipients=[student['email']], sender=sender)
+    msg.body = body
+    msg.html = html
+    if pdf is not None:
+        msg.attach(sheet_filename(student), 'application/pdf', pdf)
+    return msg
+
+# Created on first use, so fpdf2 and the process pool are only needed with PDF_ATTACHMENTS (locked:
+# a second instance would start its own pool)
+def get_pdf_renderer():
+    global pdf_renderer
+    with pdf_renderer_lock:
+        if pdf_renderer is None:
+            pdf_renderer = PdfRenderer(app.config['PDF_CACHE_DIR'], title=app.config['PDF_TITLE'],
+                                       font=app.config['PDF_FONT'], logo=app.config['PDF_LOGO'],
+                                       workers=app.config['PDF_WORKERS'])
+        return pdf_renderer
+
+# The batch's report cards, drawn in the background while the batch is being sent: one future
+# per entry of to_send, or None without PDF_ATTACHMENTS
+def submit_report_cards(to_send):
+    if not app.config['PDF_ATTACHMENTS']:
+        return [None] * len(to_send)
+    renderer = get_pdf_renderer()
+    return [renderer.submit(student) for _, student, _ in to_send]
+
+# Messages sent before a restart still count against today's quota; runs in the process whose
+# workers send, just before they start
+def sync_daily_budget():
+    conn = db.get_connection(app.config['DATABASE'])
+    send_throttle.consume_daily(dal.count_recent_sends(conn.cursor(), default_mailer.sender, unattributed=True))
+
+# Created on first use, so the cryptography package is only needed once users store mail passwords
+def get_credential_cipher():
+    global credential_cipher
+    with credential_cipher_lock:
+        if credential_cipher is None:
+            credential_cipher = CredentialCipher.from_config(app.config)
+        return credential_cipher
+
+# One pooled transport and rate limiter per sender account, in the process that sends
+mailer_registry = mailers.MailerRegistry(app.config, default_mailer, get_credential_cipher)
+
+# Send one batch of queued students (runs on send worker threads); outcomes are
+# logged through record(), which buffers them into small transactions
+def deliver_batch(items, record):
+    conn = db.get_connection(app.config['DATABASE'])
     c = conn.cursor()
-    students = c.execute("SELECT * FROM students WHERE uploaded_by = ? ORDER BY id DESC", (session['user_id'],)).fetchall()
-    conn.close()
+    students = dal.fetch_students(c, [item['student_id'] for item in items])
+    
+    pending = []
+    for item in items:
+        student = students.get(item['student_id'])
+        if not student:
+            record(item, 'failed', 'Student not found')
+            continue
+        pending.append((item, student, report_fingerprint(student)))
+    
+    # Checked again here: another job may have delivered the same report since this one was queued
+    already_sent = set()
+    for user_id in {item['created_by'] for item, _, _ in pending}:
+        already_sent |= {(user_id, fp) for fp in dal.sent_fingerprints(
+            c, user_id, [fp for item, _, fp in pending if item['created_by'] == user_id])}
+    to_send = []
+    for item, student, fingerprint in pending:
+        if item['fingerprint'] is not None and (item['created_by'], fingerprint) in already_sent:
+            record(item, 'skipped', 'Unchanged since it was last sent')
+        else:
+            to_send.append((item, student, fingerprint))
+    
+    # A sharded job may send from any of its user's accounts, the others from the primary one
+    senders = {}
+    for item, _, _ in to_send:
+        if item['created_by'] not in senders:
+            senders[item['created_by']] = mailer_registry.for_user(c, item['created_by'])
+    
+    def mailers_for(item):
+        user_mailers = senders[item['created_by']]
+        return user_mailers if item['sharded'] else user_mailers[:1]
     
-    students_list = [dict(student) for student in students]
-    return jsonify({'success': True, 'students': students_list})
+    report_cards = submit_report_cards(to_send)
+    if app.config['SEND_ENGINE'] == 'async':
+        deliver_batch_async(to_send, report_cards, mailers_for, record)
+        return
+    
+    with app.app_context():
+        for (item, student, fingerprint), report_card in zip(to_send, report_cards):
+            # The account that can send soonest, so a paused or exhausted one doesn't hold up the batch
+            mailer = mailer_registry.pick(mailers_for(item))
+            try:
+                msg = build_result_message(student, mailer.sender,
+                                           report_card.result() if report_card is not None else None)
+                mailer.send(msg)
+                record(item, 'success', None, student, fingerprint=fingerprint, sender=mailer.sender)
+                
+            except Exception as email_error:
+                # Log failure with detailed error; transient ones are scheduled for another attempt
+                error_msg = retry.describe(email_error)
+                record(item, 'failed', error_msg, student, retry.is_transient(email_error), sender=mailer.sender)
+                student_name = f"{student['first_name']} {student['last_name']}"
+                print(f"Error sending to {student_name}: {error_msg}")  # Print to console for debugging
+
+# Same as above, but the whole batch is handed to the async engine and sent concurrently
+def deliver_batch_async(to_send, report_cards, mailers_for, record):
+    # Every account's engine sends its share of the batch at once
+    groups = {}
+    for (item, student, fingerprint), report_card in zip(to_send, report_cards):
+        mailer = mailer_registry.pick(mailers_for(item))
+        subject, body, html = render_report(student)
+        message = build_email(mailer.sender, student['email'], subject, body, html)
+        if report_card is not None:
+            try:
+                message.add_attachment(report_card.result(), maintype='application', subtype='pdf',
+                                       filename=sheet_filename(student))
+            except Exception as e:
+                error_msg = retry.describe(e)
+                record(item, 'failed', error_msg, student, retry.is_transient(e), sender=mailer.sender)
+                print(f"Error sending to {student['first_name']} {student['last_name']}: {error_msg}")
+                continue
+        groups.setdefault(mailer, []).append((item, student, fingerprint, message))
+    
+    pending = []
+    for mailer, entries in groups.items():
+        try:
+            pending.append((mailer, entries, mailer.engine().submit_batch([entry[3] for entry in entries])))
+        except AsyncEngineError as e:
+            # The account changed and its engine was closed while this batch was being prepared;
+            # try again later with the new settings
+            for item, student, _, _ in entries:
+                record(item, 'failed', retry.describe(e), student, True, sender=mailer.sender)
+    
+    # The groups are sent at the same time, so they share one deadline
+    timeout = app.config['ASYNC_BATCH_TIMEOUT']
+    deadline = time.monotonic() + timeout
+    for mailer, entries, batch in pending:
+        try:
+            results = batch.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            # Keep what finished; a message handed to the server may have been delivered, so only the
+            # ones never sent are retried
+            results = batch.cancel()
+            print(f"Batch of {len(entries)} from {mailer.sender} timed out after {timeout} s")
+        for (item, student, fingerprint, _), outcome in zip(entries, results):
+            if outcome is None:
+                record(item, 'success', None, student, fingerprint=fingerprint, sender=mailer.sender)
+                continue
+            if outcome == NOT_SENT:
+                error_msg, transient = f"Not sent within {timeout} s", True
+            elif outcome == IN_FLIGHT:
+                error_msg = (f"Delivery unknown: still sending after {timeout} s. Not retried, as it may "
+                             f"have been delivered")
+                transient = False
+            else:
+                error_msg, transient = retry.describe(outcome), retry.is_transient(outcome)
+            record(item, 'failed', error_msg, student, transient, sender=mailer.sender)
+            print(f"Error sending to {student['first_name']} {student['last_name']}: {error_msg}")
+
+job_queue = JobQueue(app.config['DATABASE'], deliver_batch, workers=app.config['SEND_WORKERS'],
+                     batch_size=app.config['SEND_BATCH_SIZE'],
+                     max_attempts=app.config['RETRY_MAX_ATTEMPTS'],
+                     retry_delay=app.config['RETRY_BASE_DELAY'],
+                     max_retry_delay=app.config['RETRY_MAX_DELAY'],
+                     events=send_events,
+                     on_start=sync_daily_budget)
+metrics.gauge('send_queue_depth', 'Recipients queued for the send workers', fn=job_queue.depth)
 
 @app.route('/api/send-emails', methods=['POST'])
 @login_required
@@ -247,303 +776,348 @@ def send_emails():
     if not student_ids:
         return jsonify({'success': False, 'message': 'No students selected'}), 400
     
-    # Check if email is configured
-    if not app.config.get('MAIL_USERNAME') or not app.config.get('MAIL_PASSWORD'):
+    # Check if email is configured: the user's own accounts, or the app-wide one
+    accounts = current_user_settings()['mail_accounts']
+    if not accounts and not (app.config.get('MAIL_USERNAME') and app.config.get('MAIL_PASSWORD')):
         return jsonify({
             'success': False, 
             'message': 'Email not configured. Please go to Settings and configure your email first.'
         }), 400
     
-    conn = sqlite3.connect('student_results.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    # Students whose report is unchanged since it was last sent are skipped unless force is set
+    fingerprints = None
+    if not data.get('force'):
+        students = dal.fetch_students(db.get_db().cursor(), student_ids)
+        fingerprints = {student_id: report_fingerprint(student) for student_id, student in students.items()}
     
-    success_count = 0
-    failed_count = 0
-    results = []
+    # Large sends are spread over all of the user's accounts; "shard" in the request overrides SEND_SHARD_MIN
+    shard = data.get('shard')
+    if shard is None:
+        shard = 0 < app.config['SEND_SHARD_MIN'] <= len(student_ids)
+    sharded = bool(shard) and len(accounts) > 1
     
-    for student_id in student_ids:
-        student = c.execute("SELECT * FROM students WHERE id = ?", (student_id,)).fetchone()
-        
-        if not student:
-            continue
-        
-        try:
-            # Create email message
-            student_name = f"{student['first_name']} {student['last_name']}"
-            msg = Message(
-                subject=f"Academic Results - {student['class']}",
-                recipients=[student['email']]
-            )
-            
-            # Plain text email body (fallback)
-            msg.body = f'''
-Academic Results Report
-Class: {student['class']}
-
-Dear {student_name},
-
-We are pleased to share your academic results for {student['class']}.
-
-Assessment Scores:
-- Homework 1 (HW1): {student['hw1']}
-- Participation: {student['participation']}
-- Quiz 1 (Q1): {student['q1']}
-- Final Exam - Khmer: {student['final_khmer']}
-- Final Exam - English: {student['final_english']}
-
-Total Score: {student['total']}
-Final Grade: {student['grade']}
-
-{f"Teacher Comments: {student['comments']}" if student['comments'] else ''}
-
-Keep up the great work!
-
-Best regards,
-Academic Department
-
----
-This is an automated email. Please do not reply to this message.
-            '''
-            
-            # HTML email body (for modern email clients)
-            msg.html = f'''
-            <html>
-            <head>
-                <style>
-                    body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                    .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                    .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 30px; text-align: center; border-radius: 10px 10px 0 0; }}
-                    .content {{ background: #f9f9f9; padding: 30px; border-radius: 0 0 10px 10px; }}
-                    .result-table {{ width: 100%; border-collapse: collapse; margin: 20px 0; background: white; }}
-                    .result-table th, .result-table td {{ padding: 12px; text-align: left; border-bottom: 1px solid #ddd; }}
-                    .result-table th {{ background-color: #667eea; color: white; }}
-                    .total {{ font-weight: bold; font-size: 18px; color: #667eea; }}
-                    .grade-badge {{ display: inline-block; padding: 8px 16px; border-radius: 20px; background: #667eea; color: white; font-weight: bold; }}
-                    .footer {{ text-align: center; margin-top: 20px; color: #666; font-size: 12px; }}
-                    .comments {{ background: #fff3cd; padding: 15px; border-radius: 5px; margin-top: 15px; border-left: 4px solid #ffc107; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>Academic Results Report</h1>
-                        <p>Class: {student['class']}</p>
-                    </div>
-                    <div class="content">
-                        <h2>Dear {student_name},</h2>
-                        <p>We are pleased to share your academic results for {student['class']}.</p>
-                        
-                        <table class="result-table">
-                            <tr>
-                                <th>Assessment</th>
-                                <th>Score</th>
-                            </tr>
-                            <tr>
-                                <td>Homework 1 (HW1)</td>
-                                <td>{student['hw1']}</td>
-                            </tr>
-                            <tr>
-                                <td>Participation</td>
-                                <td>{student['participation']}</td>
-                            </tr>
-                            <tr>
-                                <td>Quiz 1 (Q1)</td>
-                                <td>{student['q1']}</td>
-                            </tr>
-                            <tr>
-                                <td>Final Exam - Khmer</td>
-                                <td>{student['final_khmer']}</td>
-                            </tr>
-                            <tr>
-                                <td>Final Exam - English</td>
-                                <td>{student['final_english']}</td>
-                            </tr>
-                            <tr class="total">
-                                <td>Total Score</td>
-                                <td>{student['total']}</td>
-                            </tr>
-                            <tr class="total">
-                                <td>Final Grade</td>
-                                <td><span class="grade-badge">{student['grade']}</span></td>
-                            </tr>
-                        </table>
-                        
-                        {f'<div class="comments"><strong>Teacher Comments:</strong><br>{student["comments"]}</div>' if student['comments'] else ''}
-                        
-                        <p>Keep up the great work!</p>
-                        <p>Best regards,<br>Academic Department</p>
-                    </div>
-                    <div class="footer">
-                        <p>This is an automated email. Please do not reply to this message.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            '''
-            
-            # Send email
-            try:
-                mail.send(msg)
-                
-                # Log success
-                c.execute('''INSERT INTO email_logs 
-                             (student_id, student_name, student_email, status, sent_by)
-                             VALUES (?, ?, ?, ?, ?)''',
-                          (student['id'], student_name, student['email'], 'success', session['user_id']))
-                
-                success_count += 1
-                results.append({'id': student['id'], 'name': student_name, 'status': 'success'})
-                
-            except Exception as email_error:
-                # Log failure with detailed error
-                error_msg = f"{type(email_error).__name__}: {str(email_error)}"
-                c.execute('''INSERT INTO email_logs 
-                             (student_id, student_name, student_email, status, sent_by, error_message)
-                             VALUES (?, ?, ?, ?, ?, ?)''',
-                          (student['id'], student_name, student['email'], 'failed', session['user_id'], error_msg))
-                
-                failed_count += 1
-                results.append({'id': student['id'], 'name': student_name, 'status': 'failed', 'error': error_msg})
-                print(f"Error sending to {student_name}: {error_msg}")  # Print to console for debugging
-            
-        except Exception as e:
-            # Catch any other errors (like invalid student data)
-            error_msg = f"General error: {str(e)}"
-            print(f"Error processing student {student_id}: {error_msg}")
-            failed_count += 1
+    # Queue the send; workers deliver in the background and /api/jobs/<id> reports progress
+    job_id, queued, skipped = job_queue.submit(session['user_id'], student_ids, fingerprints, sharded)
     
-    conn.commit()
-    conn.close()
+    if job_id is None:
+        return jsonify({
+            'success': True,
+            'message': f'All {skipped} reports were already sent or queued unchanged; nothing to send',
+            'job_id': None,
+            'total': 0,
+            'skipped': skipped
+        })
+    
+    message = f'Queued {queued} emails for sending'
+    if skipped:
+        message += f' ({skipped} unchanged reports skipped)'
+    return jsonify({
+        'success': True,
+        'message': message,
+        'job_id': job_id,
+        'total': queued,
+        'skipped': skipped,
+        'sharded': sharded
+    }), 202
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    job = job_queue.get(job_id, session['user_id'])
+    
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    
+    return jsonify({'success': True, 'job': job, 'rate_limit': mailer_registry.status(session['user_id'])})
+
+# Server-Sent Events: per-recipient outcomes ('progress') and job counts ('job') as the send workers
+# commit them; ?job_id= limits the stream to one job and starts it with the job's current counts.
+# Without a job_id the stream ends while none of the user's jobs is sending, and the browser
+# resumes it later from its Last-Event-ID, so an open logs page holds a thread only during sends
+@app.route('/api/events', methods=['GET'])
+@login_required
+def stream_events():
+    user_id = session['user_id']
+    job_id = request.args.get('job_id', type=int)
+    if job_id is not None and not job_queue.get(job_id, user_id, failures=False):
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    
+    idle_retry = app.config['EVENTS_IDLE_RETRY']
+    if not event_streams.acquire(blocking=False):
+        # All stream slots of this process are taken; the browser tries again later
+        return Response(f'retry: {idle_retry * 1000}\n\n', status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(idle_retry), 'Cache-Control': 'no-cache'})
+    
+    cursor = send_events.cursor(request.headers.get('Last-Event-ID'))
+    keepalive = app.config['EVENTS_KEEPALIVE']
+    
+    # Holds only the user id, job id and cursor; the request context is not kept alive
+    def events():
+        nonlocal cursor
+        yield b'retry: 3000\n\n'
+        if job_id is not None:
+            yield encode('job', job_queue.get(job_id, user_id, failures=False))
+        # A resumed stream first gets what it missed, without waiting
+        timeout = keepalive if job_id is not None else 0
+        while True:
+            chunks, cursor, missed = send_events.wait(cursor, user_id, job_id, timeout=timeout)
+            timeout = keepalive
+            if missed:
+                yield encode('resync', {'job_id': job_id})
+            if chunks:
+                yield b''.join(chunks)
+            elif job_id is not None:
+                # The keepalive carries fresh counts, which also covers sends delivered by another process
+                yield encode('job', job_queue.get(job_id, user_id, failures=False))
+                rate_limit = mailer_registry.status(user_id)
+                if rate_limit['paused_for'] > 0:
+                    yield encode('rate_limit', rate_limit)
+            elif not job_queue.has_active_job(user_id):
+                yield reconnect_later(cursor, idle_retry)
+                return
+            else:
+                yield b': keepalive\n\n'
+    
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also runs when the client disconnects before the first event
+    response.call_on_close(event_streams.release)
+    return response
+
+# Re-drive a send run: its failed (and not yet due) items are sent again right away;
+# items with a logged success are skipped, so nobody gets the same email twice
+@app.route('/api/retry-failed', methods=['POST'])
+@login_required
+def retry_failed():
+    data = request.get_json(silent=True) or {}
+    job_id = data.get('job_id') or job_queue.latest_job_id(session['user_id'])
+    
+    if not job_id:
+        return jsonify({'success': False, 'message': 'No send job to retry'}), 404
+    
+    try:
+        job_id = int(job_id)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid job_id'}), 400
+    
+    requeued = job_queue.retry_failed(job_id, session['user_id'])
+    if requeued is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
     
     return jsonify({
         'success': True,
-        'message': f'Sent {success_count} emails successfully, {failed_count} failed',
-        'success_count': success_count,
-        'failed_count': failed_count,
-        'results': results
+        'job_id': job_id,
+        'requeued': requeued,
+        'message': f'Queued {requeued} emails for another attempt'
     })
 
+# WHERE clause for the current user's logs from the status and date range query parameters
+def log_filters(args):
+    date_from, date_to = parse_date_range(args.get('date_from'), args.get('date_to'))
+    
+    where = ['sent_by = ?']
+    params = [session['user_id']]
+    if args.get('status') and args['status'] != 'all':
+        where.append('status = ?')
+        params.append(args['status'])
+    if date_from:
+        where.append('sent_date >= ?')
+        params.append(date_from)
+    if date_to:
+        where.append('sent_date < ?')
+        params.append(date_to)
+    return where, params
+
 @app.route('/api/logs', methods=['GET'])
 @login_required
 def get_logs():
-    conn = sqlite3.connect('student_results.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    logs = c.execute('''SELECT * FROM email_logs 
-                        WHERE sent_by = ? 
-                        ORDER BY sent_date DESC 
-                        LIMIT 100''', (session['user_id'],)).fetchall()
-    conn.close()
+    args = request.args
+    try:
+        limit = parse_limit(args.get('limit'))
+        fields = parse_fields(args.get('fields'), LOG_FIELDS, ['id', 'sent_date'])
+        cursor = decode_cursor(args.get('cursor'), (str, int))
+        where, params = log_filters(args)
+    except PaginationError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     
-    logs_list = [dict(log) for log in logs]
-    return jsonify({'success': True, 'logs': logs_list})
+    if args.get('search'):
+        where.append('(student_name LIKE ? OR student_email LIKE ?)')
+        params.extend([f"%{args['search']}%"] * 2)
+    if cursor:
+        # Keyset: continue strictly after the last (sent_date, id) of the previous page
+        where.append('(sent_date, id) < (?, ?)')
+        params.extend(cursor)
+    
+    c = db.get_db().cursor()
+    logs = c.execute(f"SELECT {', '.join(fields)} FROM email_logs WHERE {' AND '.join(where)} "
+                     "ORDER BY sent_date DESC, id DESC LIMIT ?", params + [limit + 1]).fetchall()
+    
+    logs_list, next_cursor = page(logs, limit, ['sent_date', 'id'])
+    return jsonify({'success': True, 'logs': logs_list, 'next_cursor': next_cursor})
 
 @app.route('/api/export-logs', methods=['GET'])
 @login_required
 def export_logs():
-    conn = sqlite3.connect('student_results.db')
-    df = pd.read_sql_query('''SELECT student_name, student_email, status, sent_date, error_message 
-                              FROM email_logs 
-                              WHERE sent_by = ? 
-                              ORDER BY sent_date DESC''', conn, params=(session['user_id'],))
-    conn.close()
+    args = request.args
+    try:
+        where, params = log_filters(args)
+    except PaginationError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     
-    filename = f'email_logs_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    df.to_csv(filepath, index=False)
+    columns = ['student_name', 'student_email', 'status', 'sent_date', 'error_message']
+    cursor = db.get_db().execute(f"SELECT {', '.join(columns)} FROM email_logs WHERE {' AND '.join(where)} "
+                                 "ORDER BY sent_date DESC, id DESC", params)
+    
+    try:
+        chunks, extension, mimetype = stream_export(cursor, columns, args.get('format', 'csv'),
+                                                    compress=args.get('gzip') == '1')
+    except ExportError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     
-    return send_file(filepath, as_attachment=True, download_name=filename)
+    # Rows go straight from the cursor to the client; nothing is written to disk
+    filename = f'email_logs_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 @app.route('/api/stats', methods=['GET'])
 @login_required
 def get_stats():
-    conn = sqlite3.connect('student_results.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    # Total students
-    total_students = c.execute("SELECT COUNT(*) as count FROM students WHERE uploaded_by = ?", 
-                               (session['user_id'],)).fetchone()['count']
-    
-    # Total emails sent
-    total_sent = c.execute("SELECT COUNT(*) as count FROM email_logs WHERE sent_by = ? AND status = 'success'", 
-                          (session['user_id'],)).fetchone()['count']
-    
-    # Failed emails
-    total_failed = c.execute("SELECT COUNT(*) as count FROM email_logs WHERE sent_by = ? AND status = 'failed'", 
-                            (session['user_id'],)).fetchone()['count']
-    
-    # Average scores
-    avg_scores = c.execute('''SELECT 
-                              AVG(hw1) as avg_hw1,
-                              AVG(participation) as avg_participation,
-                              AVG(q1) as avg_q1,
-                              AVG(final_khmer) as avg_final_khmer,
-                              AVG(final_english) as avg_final_english,
-                              AVG(total) as avg_total
-                              FROM students WHERE uploaded_by = ?''', (session['user_id'],)).fetchone()
+    # Primary-key lookups in the summary tables kept current by the write paths; student figures
+    # are for one term (the current one unless ?term_id= names another)
+    try:
+        term = request_term(request.args.get('term_id'))
+    except TermError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     
-    conn.close()
+    c = db.get_db().cursor()
+    user_stats = stats.get_user_stats(c, session['user_id'])
+    term_stats = stats.get_term_stats(c, term['id'])
+    averages = [{'code': a['code'], 'label': a['label'], 'average': round(term_stats.get(f"avg_{a['code']}") or 0, 2)}
+                for a in terms.get_assessments(c, term['id'])]
     
     return jsonify({
         'success': True,
         'stats': {
-            'total_students': total_students,
-            'total_sent': total_sent,
-            'total_failed': total_failed,
-            'avg_hw1': round(avg_scores['avg_hw1'] or 0, 2),
-            'avg_participation': round(avg_scores['avg_participation'] or 0, 2),
-            'avg_q1': round(avg_scores['avg_q1'] or 0, 2),
-            'avg_final_khmer': round(avg_scores['avg_final_khmer'] or 0, 2),
-            'avg_final_english': round(avg_scores['avg_final_english'] or 0, 2),
-            'avg_total': round(avg_scores['avg_total'] or 0, 2)
+            'term': term,
+            'total_students': int(term_stats.get('total_students') or 0),
+            'total_sent': user_stats['total_sent'],
+            'total_failed': user_stats['total_failed'],
+            # avg_<code> per assessment, plus the same figures in term order under 'averages'
+            **{f"avg_{average['code']}": average['average'] for average in averages},
+            'avg_total': round(term_stats.get('avg_total') or 0, 2),
+            'averages': averages
         }
     })
 
-@app.route('/api/update-email-config', methods=['POST'])
+# Created on first use, so only processes that serve analytics load NumPy (locked: a second
+# instance would start its own process pool)
+def get_term_analytics():
+    global term_analytics
+    with term_analytics_lock:
+        if term_analytics is None:
+            from analytics import TermAnalytics
+            term_analytics = TermAnalytics(workers=app.config['ANALYTICS_WORKERS'],
+                                           parallel_min_rows=app.config['ANALYTICS_PARALLEL_MIN_ROWS'])
+        return term_analytics
+
+@app.route('/api/analytics', methods=['GET'])
 @login_required
-def update_email_config():
-    data = request.get_json()
-    email = data.get('email')
-    password = data.get('password')
-    
-    if not email or not password:
-        return jsonify({'success': False, 'message': 'Email and password are required'}), 400
+def get_analytics():
+    # Totals and grades recomputed from the scores, with per-class distributions; cached per term
+    # until the next upload changes it
+    try:
+        term = request_term(request.args.get('term_id'))
+    except TermError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     
-    # Update email configuration
-    app.config['MAIL_USERNAME'] = email
-    app.config['MAIL_PASSWORD'] = password
-    app.config['MAIL_DEFAULT_SENDER'] = email
+    result, cached = get_term_analytics().get(db.get_db().cursor(), term['id'])
+    return jsonify({'success': True, 'term': term, 'cached': cached, **result})
+
+# Prometheus scrape endpoint: request, query, SMTP and upload timings plus the send queue depth
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
     
-    # Save to .env file for persistence
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# Sender accounts are stored per user, with the password encrypted; the send workers use the new
+# settings from their next batch
+def save_mail_account(data, primary, replace_primary=False):
+    conn = db.get_db()
+    c = conn.cursor()
     try:
-        env_path = os.path.join(os.path.dirname(__file__), '.env')
-        with open(env_path, 'w') as f:
-            f.write(f'MAIL_USERNAME={email}\n')
-            f.write(f'MAIL_PASSWORD={password}\n')
-            f.write(f'SECRET_KEY=your-secret-key-change-in-production\n')
-    except Exception as e:
-        print(f"Warning: Could not save to .env file: {e}")
-    
-    # Reinitialize mail
-    global mail
-    mail = Mail(app)
+        previous = c.execute("SELECT id FROM mail_accounts WHERE user_id = ? AND is_primary = 1",
+                             (session['user_id'],)).fetchone() if replace_primary else None
+        account_id = mailers.save_account(c, get_credential_cipher(), session['user_id'], data.get('email'),
+                                          data.get('password'), data.get('server') or app.config['MAIL_SERVER'],
+                                          data.get('port') or app.config['MAIL_PORT'],
+                                          data.get('use_tls', app.config['MAIL_USE_TLS']), primary=primary)
+        if previous is not None and previous['id'] != account_id:
+            mailers.delete_account(c, session['user_id'], previous['id'])
+        settings_changed(c)
+        conn.commit()
+    except (MailAccountError, CredentialsError) as e:
+        conn.rollback()
+        return str(e)
+    return None
+
+@app.route('/api/update-email-config', methods=['POST'])
+@login_required
+def update_email_config():
+    # The settings form's single account: it replaces the user's primary sender account (any
+    # additional accounts are kept)
+    error = save_mail_account(request.get_json(silent=True) or {}, primary=True, replace_primary=True)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
     
     return jsonify({'success': True, 'message': 'Email configuration updated and saved successfully'})
 
-def get_grade(average):
-    if average >= 90:
-        return 'A'
-    elif average >= 80:
-        return 'B'
-    elif average >= 70:
-        return 'C'
-    elif average >= 60:
-        return 'D'
+@app.route('/api/mail-accounts', methods=['GET'])
+@login_required
+def get_mail_accounts():
+    return jsonify({'success': True, 'accounts': current_user_settings()['mail_accounts']})
+
+# Additional sender accounts for sharded sends ("primary": true makes the new one the primary account)
+@app.route('/api/mail-accounts', methods=['POST'])
+@login_required
+def add_mail_account():
+    data = request.get_json(silent=True) or {}
+    error = save_mail_account(data, primary=bool(data.get('primary')))
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+    
+    return jsonify({'success': True, 'accounts': current_user_settings()['mail_accounts']}), 201
+
+@app.route('/api/mail-accounts/<int:account_id>', methods=['DELETE'])
+@login_required
+def delete_mail_account(account_id):
+    conn = db.get_db()
+    c = conn.cursor()
+    if not mailers.delete_account(c, session['user_id'], account_id):
+        return jsonify({'success': False, 'message': 'Account not found'}), 404
+    
+    settings_changed(c)
+    conn.commit()
+    return jsonify({'success': True, 'accounts': current_user_settings()['mail_accounts']})
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the dashboard statistics table from scratch."""
+    conn = db.get_connection(app.config['DATABASE'])
+    drifted = stats.rebuild(conn.cursor())
+    drifted_terms = stats.rebuild_terms(conn.cursor())
+    conn.commit()
+    
+    if drifted or drifted_terms:
+        print(f"Rebuilt statistics; fixed drift for user ids: {', '.join(map(str, drifted)) or 'none'}; "
+              f"term ids: {', '.join(map(str, drifted_terms)) or 'none'}")
     else:
-        return 'F'
+        print("Rebuilt statistics; everything was consistent")
 
 if __name__ == '__main__':
-    init_db()
+    # Development server; see wsgi.py for production. Only the reloader child serves requests,
+    # so only it runs send workers
+    create_app(send_workers=os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
     app.run(debug=True, port=5000)
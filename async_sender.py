@@ -0,0 +1,252 @@
+"""Asyncio send engine: a bounded pool of aiosmtplib connections on one event loop.
+
+Selected with SEND_ENGINE=async. aiosmtplib is an optional dependency and is
+only imported when this engine is used.
+"""
+import asyncio
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+
+from ratelimit import is_throttled
+from retry import is_transient
+from smtp_pool import CONNECT_SECONDS, SEND_SECONDS
+
+
+class AsyncEngineError(RuntimeError):
+    pass
+
+
+# What SendBatch.outcomes holds for a message that has no result yet
+NOT_SENT = 'not sent'
+IN_FLIGHT = 'in flight'
+
+
+class SendBatch:
+    """A batch handed to the engine by ``submit_batch()``.
+
+    ``outcomes`` follows each message as it goes: NOT_SENT until it is first
+    handed to the server, IN_FLIGHT while it is, then None once it was sent
+    or the exception its last attempt failed with. After ``cancel()`` no
+    message of the batch is handed to the server any more.
+    """
+
+    def __init__(self, count):
+        self.outcomes = [NOT_SENT] * count
+        self.future = None
+        self._lock = threading.Lock()
+        self._cancelled = False
+
+    def _start(self, index):
+        with self._lock:
+            if self._cancelled:
+                return False
+            self.outcomes[index] = IN_FLIGHT
+            return True
+
+    def _finish(self, index, outcome):
+        with self._lock:
+            self.outcomes[index] = outcome
+
+    def result(self, timeout=None):
+        """In order, None for each message sent or the exception it failed with; may raise TimeoutError."""
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """Stop the batch; returns ``outcomes`` as they stand, which no longer change for NOT_SENT ones."""
+        with self._lock:
+            self._cancelled = True
+            outcomes = list(self.outcomes)
+        self.future.cancel()
+        return outcomes
+
+
+def build_email(sender, recipient, subject, body, html):
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['To'] = recipient
+    msg['Subject'] = subject
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid()
+    msg.set_content(body)
+    msg.add_alternative(html, subtype='html')
+    return msg
+
+
+class AsyncSendEngine:
+    """Sends batches of EmailMessages concurrently over persistent connections.
+
+    The engine owns a background thread running its event loop, so the
+    connections survive between batches; worker threads call ``send_batch()``
+    and block until that batch is done. At most ``concurrency`` messages are
+    in flight, spread over up to ``pool_size`` connections. Transient
+    failures (dropped connections, 4xx replies) are retried per recipient
+    up to ``retries`` times; 5xx replies fail at once. With a ``throttle``
+    (a ``ratelimit.SendThrottle``) every message waits for a send slot, and
+    throttling replies pause the whole engine instead of using up retries.
+    """
+
+    def __init__(self, hostname, port, username=None, password=None, start_tls=False, use_tls=False,
+                 pool_size=8, concurrency=32, retries=2, timeout=60, throttle=None):
+        try:
+            import aiosmtplib
+        except ImportError:
+            raise AsyncEngineError('SEND_ENGINE=async requires the aiosmtplib package')
+        self._aiosmtplib = aiosmtplib
+
+        self.hostname = hostname
+        self.port = port
+        self.username = username or None
+        self.password = password or None
+        self.start_tls = start_tls
+        self.use_tls = use_tls
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.throttle = throttle
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='async-send-loop', daemon=True)
+        self._thread.start()
+        self._open_count = 0
+        self._active = 0
+        self._closed = False
+        self._state = threading.Condition()
+        # Queue, semaphore and condition must be created on the engine's own loop
+        asyncio.run_coroutine_threadsafe(self._setup(), self._loop).result()
+
+    @classmethod
+    def from_config(cls, config, throttle=None):
+        return cls(config['MAIL_SERVER'], config['MAIL_PORT'],
+                   username=config.get('MAIL_USERNAME'), password=config.get('MAIL_PASSWORD'),
+                   start_tls=config.get('MAIL_USE_TLS', False), use_tls=config.get('MAIL_USE_SSL', False),
+                   pool_size=config.get('ASYNC_POOL_SIZE', 8), concurrency=config.get('ASYNC_CONCURRENCY', 32),
+                   retries=config.get('ASYNC_RETRIES', 2), throttle=throttle)
+
+    async def _setup(self):
+        self._idle = asyncio.LifoQueue()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Notified whenever a connection is returned or discarded, so checkouts waiting on a full pool
+        # can take it or open a replacement
+        self._pool_changed = asyncio.Condition()
+
+    async def _connect(self):
+        smtp = self._aiosmtplib.SMTP(hostname=self.hostname, port=self.port, username=self.username,
+                                     password=self.password, use_tls=self.use_tls,
+                                     start_tls=self.start_tls, timeout=self.timeout)
+        start = time.perf_counter()
+        await smtp.connect()
+        CONNECT_SECONDS.observe(time.perf_counter() - start, 'async')
+        return smtp
+
+    async def _checkout(self):
+        async with self._pool_changed:
+            await self._pool_changed.wait_for(lambda: not self._idle.empty() or self._open_count < self.pool_size)
+            if not self._idle.empty():
+                return self._idle.get_nowait()
+            self._open_count += 1
+        try:
+            return await self._connect()
+        except BaseException:
+            await self._release_slot()
+            raise
+
+    async def _release_slot(self):
+        async with self._pool_changed:
+            self._open_count -= 1
+            self._pool_changed.notify()
+
+    async def _checkin(self, smtp, healthy):
+        if healthy and smtp.is_connected:
+            async with self._pool_changed:
+                self._idle.put_nowait(smtp)
+                self._pool_changed.notify()
+        else:
+            smtp.close()
+            await self._release_slot()
+
+    async def _send_one(self, msg, batch, index):
+        async with self._semaphore:
+            attempt = 0
+            throttled = 0
+            while True:
+                smtp = None
+                try:
+                    if self.throttle is not None:
+                        await self.throttle.acquire_async()
+                    smtp = await self._checkout()
+                    if not batch._start(index):
+                        await self._checkin(smtp, True)
+                        return AsyncEngineError('Batch cancelled before this message was sent')
+                    start = time.perf_counter()
+                    try:
+                        await smtp.send_message(msg)
+                    except asyncio.CancelledError:
+                        # Abandoned halfway through a transaction, the connection cannot be reused
+                        smtp.close()
+                        await self._release_slot()
+                        raise
+                    except Exception as e:
+                        batch._finish(index, e)
+                        SEND_SECONDS.observe(time.perf_counter() - start, 'async', 'error')
+                        raise
+                    batch._finish(index, None)
+                    SEND_SECONDS.observe(time.perf_counter() - start, 'async', 'success')
+                    await self._checkin(smtp, True)
+                    if self.throttle is not None:
+                        self.throttle.success()
+                    return None
+                except Exception as e:
+                    if smtp is not None:
+                        # A rejected message keeps its connection; a dropped one is replaced
+                        await self._checkin(smtp, not isinstance(e, self._aiosmtplib.SMTPServerDisconnected))
+                    if self.throttle is not None and is_throttled(e) and throttled < self.throttle.retries:
+                        throttled += 1
+                        self.throttle.backoff()
+                        continue
+                    if attempt >= self.retries or not is_transient(e):
+                        return e
+                    attempt += 1
+                    await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+    async def _send_all(self, messages, batch):
+        return await asyncio.gather(*(self._send_one(msg, batch, i) for i, msg in enumerate(messages)))
+
+    def submit_batch(self, messages):
+        """Start sending ``messages``; returns a SendBatch, whose ``result()`` is ``send_batch()``'s."""
+        with self._state:
+            if self._closed:
+                raise AsyncEngineError('Send engine is closed')
+            self._active += 1
+        batch = SendBatch(len(messages))
+        batch.future = asyncio.run_coroutine_threadsafe(self._send_all(messages, batch), self._loop)
+        batch.future.add_done_callback(self._batch_done)
+        return batch
+
+    def _batch_done(self, future):
+        with self._state:
+            self._active -= 1
+            self._state.notify_all()
+
+    def send_batch(self, messages):
+        """Send ``messages``; returns, in order, None for each one sent or the exception it failed with."""
+        return self.submit_batch(messages).result()
+
+    async def _close_all(self):
+        while not self._idle.empty():
+            smtp = self._idle.get_nowait()
+            self._open_count -= 1
+            try:
+                await smtp.quit()
+            except Exception:
+                smtp.close()
+
+    def close(self):
+        # Refuse new batches, let the ones in flight finish, then shut the loop down
+        with self._state:
+            self._closed = True
+            self._state.wait_for(lambda: self._active == 0)
+        asyncio.run_coroutine_threadsafe(self._close_all(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,89 @@
+"""Cost of the class analytics behind /api/analytics: load, summarize serially or on the pool, cache hit.
+
+Usage:  python benchmarks/bench_analytics.py --students 200000 --classes 40 --workers 4
+
+The term is written straight into a temporary database. The summarize
+timings exclude loading; the pool run is warmed up first, so process
+start-up is not counted. A pool only pays off with more than one CPU:
+each class's arrays are pickled to a worker and the summary sent back.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app as student_app
+import db
+import terms
+from analytics import TermAnalytics, class_tasks, load_term, summarize
+
+
+def setup(conn, count, classes, user_id=1):
+    rng = random.Random(42)
+    c = conn.cursor()
+    term_id = terms.get_current_term(c, user_id)['id']
+    assessments = terms.get_assessments(c, term_id)
+    names = [f'C{i:03d}' for i in range(classes)]
+    c.executemany('''INSERT INTO students (first_name, last_name, email, class, total, grade, comments, term_id, uploaded_by)
+                     VALUES (?, ?, ?, ?, ?, ?, '', ?, ?)''',
+                  [(f'F{i}', f'L{i}', f's{i}@example.com', rng.choice(names), rng.randint(250, 500),
+                    rng.choice('ABCDF'), term_id, user_id) for i in range(count)])
+    c.executemany("INSERT INTO scores (student_id, assessment_id, score) VALUES (?, ?, ?)",
+                  [(row[0], a['id'], rng.randint(40, 100)) for row in c.execute('SELECT id FROM students').fetchall()
+                   for a in assessments])
+    conn.commit()
+    return term_id, assessments
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=200000)
+    parser.add_argument('--classes', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 4))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        student_app.app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        student_app.init_db()
+        conn = db.get_connection(student_app.app.config['DATABASE'])
+        term_id, assessments = setup(conn, args.students, args.classes)
+        c = conn.cursor()
+
+        load_ms, data = timed(lambda: load_term(c, term_id, assessments))
+        tasks = class_tasks(*data)
+        serial_ms, _ = timed(lambda: [summarize('', *data[1:])] + [summarize(*task) for task in tasks])
+
+        engine = TermAnalytics(workers=args.workers, parallel_min_rows=0)
+        pool = engine._get_pool()
+        list(pool.map(summarize, *zip(*tasks)))  # start the workers
+        pool_ms, _ = timed(lambda: list(pool.map(summarize, *zip(*tasks))) + [summarize('', *data[1:])])
+
+        first_ms, (result, _) = timed(lambda: engine.get(c, term_id), repeat=1)
+        cached_ms, (_, cached) = timed(lambda: engine.get(c, term_id))
+        pool.shutdown()
+
+        print(f"{args.students} students in {args.classes} classes, {len(assessments)} assessments, "
+              f"{os.cpu_count()} CPUs")
+        print(f"load arrays from SQLite        {load_ms:9.1f} ms")
+        print(f"summarize, serial              {serial_ms:9.1f} ms")
+        print(f"summarize, {args.workers} pool workers      {pool_ms:9.1f} ms")
+        print(f"GET uncached (load + summary)  {first_ms:9.1f} ms  parallel={result['parallel']}")
+        print(f"GET cached                     {cached_ms:9.3f} ms  cached={cached}")
+
+
+if __name__ == '__main__':
+    main()
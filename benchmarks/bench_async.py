@@ -0,0 +1,96 @@
+"""Compare the Flask-Mail send paths with the asyncio engine (SEND_ENGINE=async).
+
+Usage:  python benchmarks/bench_async.py --messages 10000 --threads 4 --concurrency 32
+
+Requires aiosmtplib. The local sink handles each connection on its own
+thread, so per-message server latency (--message-delay) is what the
+concurrent engines overlap.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask_mail import Mail
+
+from async_sender import AsyncSendEngine, build_email
+from bench_smtp_pool import make_app, make_message
+from smtp_pool import SMTPPool
+from smtp_sink import SMTPSink
+
+BODY = 'Total Score: 450\nFinal Grade: A\n'
+HTML = '<html><body><p>Total Score: 450</p><p>Final Grade: A</p></body></html>'
+
+
+def run(label, sink, count, fn):
+    before_connections, before_messages = sink.connections, sink.messages
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    delivered = sink.messages - before_messages
+    print(f"{label:<32} {count / elapsed:10.1f} msg/s  {elapsed:7.2f}s  "
+          f"delivered={delivered}  connections={sink.connections - before_connections}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=4, help='send workers for the pooled path')
+    parser.add_argument('--pool-size', type=int, default=8, help='connections for the async engine')
+    parser.add_argument('--concurrency', type=int, default=32, help='messages in flight for the async engine')
+    parser.add_argument('--batch-size', type=int, default=50, help='messages per send_batch() call')
+    parser.add_argument('--connect-delay', type=float, default=0.02,
+                        help='simulated handshake cost per connection, in seconds')
+    parser.add_argument('--message-delay', type=float, default=0.002,
+                        help='simulated server time per message, in seconds')
+    parser.add_argument('--skip-serial', action='store_true', help='skip the slow one-connection-per-message run')
+    args = parser.parse_args()
+
+    with SMTPSink(connect_delay=args.connect_delay, message_delay=args.message_delay) as sink:
+        app = make_app(sink.port)
+        mail = Mail(app)
+
+        def send_serial():
+            with app.app_context():
+                for i in range(args.messages):
+                    mail.send(make_message(i))
+
+        def send_pooled():
+            pool = SMTPPool(mail, size=args.threads)
+
+            def send_one(i):
+                with app.app_context():
+                    pool.send(make_message(i))
+
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                list(executor.map(send_one, range(args.messages)))
+            pool.reset()
+
+        def send_async():
+            engine = AsyncSendEngine('127.0.0.1', sink.port, pool_size=args.pool_size,
+                                     concurrency=args.concurrency)
+            try:
+                for start in range(0, args.messages, args.batch_size):
+                    batch = [build_email('bench@example.com', f'student{i}@example.com',
+                                         f'Academic Results - bench {i}', BODY, HTML)
+                             for i in range(start, min(start + args.batch_size, args.messages))]
+                    results = engine.send_batch(batch)
+                    failed = [error for error in results if error is not None]
+                    if failed:
+                        raise failed[0]
+            finally:
+                engine.close()
+
+        print(f"{args.messages} messages, connect delay {args.connect_delay * 1000:.0f} ms, "
+              f"message delay {args.message_delay * 1000:.1f} ms")
+        if not args.skip_serial:
+            run('flask-mail, mail.send per msg', sink, args.messages, send_serial)
+        run(f'flask-mail pool, {args.threads} threads', sink, args.messages, send_pooled)
+        run(f'async, {args.pool_size} conns/{args.concurrency} inflight', sink, args.messages, send_async)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Mixed read/write SQLite load test: connect-per-query vs the shared db layer.
+
+Usage:  python benchmarks/bench_db.py --threads 8 --seconds 5
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import db
+
+SCHEMA = '''CREATE TABLE email_logs
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+             student_id INTEGER,
+             student_name TEXT,
+             student_email TEXT,
+             status TEXT,
+             sent_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+             sent_by INTEGER,
+             error_message TEXT)'''
+
+READ_SQL = "SELECT * FROM email_logs WHERE sent_by = ? ORDER BY sent_date DESC LIMIT 100"
+WRITE_SQL = '''INSERT INTO email_logs (student_id, student_name, student_email, status, sent_by)
+               VALUES (?, ?, ?, ?, ?)'''
+
+
+def fresh_connection(path):
+    # What every route did before: a new default connection per request
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def setup(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute(SCHEMA)
+    conn.executemany(WRITE_SQL, [(i, f'Student {i}', f's{i}@example.com', 'success', i % 10)
+                                 for i in range(rows)])
+    conn.commit()
+    conn.close()
+
+
+def run(label, path, threads, seconds, write_ratio, shared):
+    stats = {'reads': 0, 'writes': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        rng = random.Random()
+        reads = writes = locked = 0
+        while time.perf_counter() < deadline:
+            conn = db.get_connection(path) if shared else fresh_connection(path)
+            try:
+                if rng.random() < write_ratio:
+                    conn.execute(WRITE_SQL, (1, 'Bench', 'bench@example.com', 'success', rng.randrange(10)))
+                    conn.commit()
+                    writes += 1
+                else:
+                    conn.execute(READ_SQL, (rng.randrange(10),)).fetchall()
+                    reads += 1
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                conn.rollback()
+                locked += 1
+            finally:
+                if not shared:
+                    conn.close()
+        with lock:
+            stats['reads'] += reads
+            stats['writes'] += writes
+            stats['locked'] += locked
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    total = stats['reads'] + stats['writes']
+    print(f"{label:<24} {total / seconds:10.0f} ops/s  reads={stats['reads']} "
+          f"writes={stats['writes']} locked_errors={stats['locked']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before = os.path.join(tmp, 'before.db')
+        after = os.path.join(tmp, 'after.db')
+        setup(before, args.rows)
+        setup(after, args.rows)
+
+        print(f"{args.threads} threads, {args.write_ratio:.0%} writes, {args.seconds:g}s each")
+        run('connect per query', before, args.threads, args.seconds, args.write_ratio, shared=False)
+        run('shared WAL connections', after, args.threads, args.seconds, args.write_ratio, shared=True)
+
+
+if __name__ == '__main__':
+    main()
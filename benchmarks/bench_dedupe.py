@@ -0,0 +1,79 @@
+"""Cost of the fingerprint check for a resend after a small correction.
+
+Usage:  python benchmarks/bench_dedupe.py --students 20000 --changed 0.01
+
+Every student starts with a delivered report. A fraction of the grades then
+change, and the script times the dedupe check that /api/send-emails runs
+(student lookup, fingerprints, indexed lookup of delivered ones) against
+rendering every report again, which was the cost before SMTP even started.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app as student_app
+import dal
+import db
+import terms
+from email_render import render_report, report_fingerprint
+
+
+def setup(conn, count, user_id=1):
+    rng = random.Random(42)
+    c = conn.cursor()
+    term_id = terms.get_current_term(c, user_id)['id']
+    c.executemany('''INSERT INTO students (first_name, last_name, email, class, total, grade, comments, term_id, uploaded_by)
+                     VALUES (?, ?, ?, 'A', ?, 'B', '', ?, ?)''',
+                  [(f'F{i}', f'L{i}', f's{i}@example.com', rng.randint(250, 500), term_id, user_id) for i in range(count)])
+    c.executemany("INSERT INTO scores (student_id, assessment_id, score) VALUES (?, ?, ?)",
+                  [(row[0], a['id'], rng.randint(50, 100)) for row in c.execute('SELECT id FROM students').fetchall()
+                   for a in terms.get_assessments(c, term_id)])
+    students = dal.fetch_students(c, [row[0] for row in conn.execute('SELECT id FROM students')])
+    conn.executemany('''INSERT INTO email_logs (student_id, student_name, student_email, status, sent_by, fingerprint)
+                        VALUES (?, ?, ?, 'success', ?, ?)''',
+                     [(s['id'], f"{s['first_name']} {s['last_name']}", s['email'], user_id, report_fingerprint(s))
+                      for s in students.values()])
+    conn.commit()
+    return list(students)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--changed', type=float, default=0.01, help='fraction of students whose grades change')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        student_app.app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        student_app.init_db()
+        conn = db.get_connection(student_app.app.config['DATABASE'])
+        student_ids = setup(conn, args.students)
+
+        changed = random.Random(1).sample(student_ids, int(len(student_ids) * args.changed))
+        conn.executemany("UPDATE scores SET score = score - 1 WHERE student_id = ?", [(i,) for i in changed])
+        conn.commit()
+
+        start = time.perf_counter()
+        students = dal.fetch_students(conn.cursor(), student_ids)
+        fingerprints = {sid: report_fingerprint(s) for sid, s in students.items()}
+        sent = dal.sent_fingerprints(conn.cursor(), 1, fingerprints.values())
+        to_send = [sid for sid, fp in fingerprints.items() if fp not in sent]
+        check = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for student in students.values():
+            render_report(student)
+        render = time.perf_counter() - start
+
+        print(f"{args.students} students, {len(changed)} changed")
+        print(f"dedupe check          {check * 1000:9.1f} ms  -> {len(to_send)} to resend")
+        print(f"render every report   {render * 1000:9.1f} ms  -> {len(students)} to resend")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Cost of many live-progress watchers on the send event broker (/api/events).
+
+Usage:  python benchmarks/bench_events.py --watchers 500 --batches 200 --batch-size 20
+
+Each watcher is a thread that waits on the broker the way an SSE stream
+does. The batches of events go to one user, the way a send worker flushes
+them. The script reports the delay from publish to delivery, the time
+spent publishing, and the memory each watcher adds. The memory is the
+Python heap, traced, plus RSS, which includes the thread stack.
+"""
+import argparse
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from events import EventBroker
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--watchers', type=int, default=500)
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=20, help='events per publish (one LogBuffer flush)')
+    parser.add_argument('--interval', type=float, default=0.005, help='seconds between publishes')
+    args = parser.parse_args()
+
+    broker = EventBroker(capacity=10000)
+    published = {}
+    delays = []
+    delays_lock = threading.Lock()
+    ready = threading.Barrier(args.watchers + 1)
+    expected = args.batches * args.batch_size
+
+    def watcher():
+        cursor = broker.cursor()
+        received = 0
+        mine = []
+        ready.wait()
+        while received < expected:
+            chunks, cursor, _ = broker.wait(cursor, 1, timeout=1)
+            now = time.perf_counter()
+            for chunk in chunks:
+                # Chunks start with "id: <epoch>-<sequence>"
+                mine.append(now - published[int(chunk[:chunk.index(b'\n')].rsplit(b'-', 1)[1])])
+            received += len(chunks)
+        with delays_lock:
+            delays.extend(mine)
+
+    tracemalloc.start()
+    before_heap, before_rss = tracemalloc.get_traced_memory()[0], rss_mb()
+    threads = [threading.Thread(target=watcher, daemon=True) for _ in range(args.watchers)]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)
+    heap_per_watcher = (tracemalloc.get_traced_memory()[0] - before_heap) / args.watchers
+    rss_per_watcher = (rss_mb() - before_rss) * 1e6 / args.watchers
+    tracemalloc.stop()
+    ready.wait()
+
+    publish_time = 0.0
+    for batch in range(args.batches):
+        events = [(1, 1, 'progress', {'job_id': 1, 'student_id': batch * args.batch_size + i, 'status': 'success'})
+                  for i in range(args.batch_size)]
+        start = time.perf_counter()
+        first = batch * args.batch_size + 1
+        published.update((seq, start) for seq in range(first, first + args.batch_size))
+        broker.publish(events)
+        publish_time += time.perf_counter() - start
+        time.sleep(args.interval)
+
+    for t in threads:
+        t.join()
+
+    print(f"{args.watchers} watchers, {args.batches} publishes of {args.batch_size} events")
+    print(f"publish            {publish_time / args.batches * 1e6:9.1f} us per batch")
+    print(f"delivery delay     p50 {percentile(delays, 50) * 1000:7.2f} ms   p99 {percentile(delays, 99) * 1000:7.2f} ms")
+    print(f"memory per watcher {heap_per_watcher / 1024:9.1f} KiB Python heap, {rss_per_watcher / 1024:7.1f} KiB RSS")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Time the /api/stats and /api/logs queries on a large email_logs table,
+without the secondary indexes and again after the migrations add them.
+
+Usage:  python benchmarks/bench_indexes.py --rows 1000000 --users 50
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app as student_app
+import db
+
+QUERIES = {
+    'stats: sent count': ("SELECT COUNT(*) FROM email_logs WHERE sent_by = ? AND status = 'success'", 1),
+    'stats: failed count': ("SELECT COUNT(*) FROM email_logs WHERE sent_by = ? AND status = 'failed'", 1),
+    'logs: latest 100': ("SELECT * FROM email_logs WHERE sent_by = ? ORDER BY sent_date DESC LIMIT 100", 1),
+    'stats: students count': ("SELECT COUNT(*) FROM students WHERE uploaded_by = ?", 1),
+}
+
+
+def fill(conn, rows, users):
+    rng = random.Random(42)
+    batch = []
+    for i in range(rows):
+        status = 'success' if rng.random() < 0.95 else 'failed'
+        sent_date = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:00:00"
+        batch.append((i % 5000, f'Student {i}', f's{i}@example.com', status, sent_date, rng.randint(1, users)))
+        if len(batch) == 50000:
+            conn.executemany('''INSERT INTO email_logs
+                                (student_id, student_name, student_email, status, sent_date, sent_by)
+                                VALUES (?, ?, ?, ?, ?, ?)''', batch)
+            batch = []
+    if batch:
+        conn.executemany('''INSERT INTO email_logs
+                            (student_id, student_name, student_email, status, sent_date, sent_by)
+                            VALUES (?, ?, ?, ?, ?, ?)''', batch)
+    conn.executemany('''INSERT INTO students (first_name, last_name, email, class, uploaded_by)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     [(f'F{i}', f'L{i}', f's{i}@example.com', 'A', rng.randint(1, users)) for i in range(rows // 10)])
+    conn.commit()
+
+
+def measure(conn, label, repeat):
+    print(label)
+    for name, (sql, user_id) in QUERIES.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, (user_id,)).fetchall()
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        plan = ' / '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, (user_id,)))
+        print(f"  {name:<24} {elapsed:9.2f} ms   {plan}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        student_app.app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        student_app.init_db()
+        conn = db.get_connection(student_app.app.config['DATABASE'])
+
+        # Start from the pre-migration schema
+        for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall():
+            conn.execute(f'DROP INDEX {name}')
+        conn.execute('PRAGMA user_version = 0')
+
+        start = time.perf_counter()
+        fill(conn, args.rows, args.users)
+        print(f"inserted {args.rows} email_logs rows in {time.perf_counter() - start:.1f}s")
+        conn.execute('ANALYZE')
+
+        measure(conn, 'without indexes', args.repeat)
+
+        # Only the index migrations: later ones also add columns, which init_db() already created
+        index_migrations = student_app.MIGRATIONS[:3]
+        start = time.perf_counter()
+        db.migrate(conn, index_migrations)
+        db.migrate(conn, index_migrations)  # second run is a no-op
+        conn.execute('ANALYZE')
+        print(f"migrations applied in {time.perf_counter() - start:.1f}s")
+
+        measure(conn, 'with indexes', args.repeat)
+
+
+if __name__ == '__main__':
+    main()
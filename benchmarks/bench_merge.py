@@ -0,0 +1,91 @@
+"""Re-upload cost of a corrected spreadsheet: merge (upsert) import vs delete-and-reinsert.
+
+Usage:  python benchmarks/bench_merge.py --rows 100000 --changed 0.01 --uploads 5
+
+Each mode starts from its own database holding the original upload. The
+corrected file, with a fraction of the rows changed, is then uploaded
+several times. The script reports time per upload, student rows written by
+the first re-upload, and the database file size afterwards.
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app as student_app
+import db
+from importer import import_students, iter_frames
+
+HEADER = ['First name', 'Last name', 'Email', 'Class', 'HW1', 'Participation', 'Q1',
+          'Final Khmer', 'Final English', 'Total', 'Grade', 'Comments']
+
+
+def make_rows(count, seed=42):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        scores = [rng.randint(50, 100) for _ in range(5)]
+        rows.append([f'F{i}', f'L{i}', f's{i}@example.com', rng.choice('ABCD'), *scores, sum(scores),
+                     rng.choice('ABCDF'), 'ok' if i % 3 else ''])
+    return rows
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def db_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+def run(mode, path, original, corrected, uploads):
+    student_app.app.config['DATABASE'] = path
+    student_app.init_db()
+    conn = db.get_connection(path)
+    import_students(conn, iter_frames(io.BytesIO(original), 'file.csv'), 1, mode)
+
+    timings, summaries = [], []
+    for _ in range(uploads):
+        start = time.perf_counter()
+        _, _, summary = import_students(conn, iter_frames(io.BytesIO(corrected), 'file.csv'), 1, mode)
+        timings.append(time.perf_counter() - start)
+        summaries.append(summary)
+    first = summaries[0]
+    written = first['added'] + first['changed'] + first['removed']
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print(f"{mode:<8} {sum(timings) / len(timings) * 1000:9.0f} ms/upload  rows written={written:<8} "
+          f"db size={db_size(path) / 1e6:6.1f} MB  first re-upload={first}")
+    db.close_connection(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--changed', type=float, default=0.01, help='fraction of rows edited in the corrected file')
+    parser.add_argument('--uploads', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    corrected = [list(row) for row in rows]
+    for i in random.Random(1).sample(range(args.rows), int(args.rows * args.changed)):
+        corrected[i][4] = int(corrected[i][4]) - 1
+    original, corrected = to_csv(rows), to_csv(corrected)
+
+    print(f"{args.rows} rows, {args.changed:.1%} changed, {args.uploads} re-uploads")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('replace', 'merge'):
+            run(mode, os.path.join(tmp, f'{mode}.db'), original, corrected, args.uploads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Overhead of the always-on metrics: timed SQLite statements, histogram observations and request timing.
+
+Usage:  python benchmarks/bench_metrics.py --queries 200000 --requests 2000
+
+It compares primary-key SELECTs on a plain sqlite3 connection and on the
+timed connection from db.py. It also times a bare ``observe()``, and a
+small page request through the Flask test client, with and without the
+request hooks. Profiling is not involved: when PROFILE_REQUESTS is off,
+its hooks are never registered.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask
+
+import db
+import metrics
+
+
+def per_call(fn, count):
+    start = time.perf_counter()
+    fn(count)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def select_loop(conn):
+    def run(count):
+        for i in range(count):
+            conn.execute('SELECT value FROM t WHERE id = ?', (i % 1000,)).fetchone()
+    return run
+
+
+def request_loop(client):
+    def run(count):
+        for _ in range(count):
+            client.get('/ping')
+    return run
+
+
+def make_app(instrumented):
+    app = Flask(__name__)
+    if instrumented:
+        metrics.init_app(app)
+    app.add_url_rule('/ping', 'ping', lambda: 'pong')
+    return app.test_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--queries', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        setup = sqlite3.connect(path)
+        setup.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, value TEXT)')
+        setup.executemany('INSERT INTO t VALUES (?, ?)', [(i, f'v{i}') for i in range(1000)])
+        setup.commit()
+        setup.close()
+
+        plain = sqlite3.connect(path)
+        timed = db.connect(path)
+        timed.row_factory = None  # same rows as the plain connection
+        plain_us = per_call(select_loop(plain), args.queries)
+        timed_us = per_call(select_loop(timed), args.queries)
+
+    histogram = metrics.histogram('bench_seconds', 'Benchmark observations', ['label'])
+    observe_us = per_call(lambda count: [histogram.observe(0.003, 'x') for _ in range(count)], args.queries)
+
+    bare_us = per_call(request_loop(make_app(False)), args.requests)
+    hooked_us = per_call(request_loop(make_app(True)), args.requests)
+
+    print(f"SELECT by primary key, plain      {plain_us:8.2f} us")
+    print(f"SELECT by primary key, timed      {timed_us:8.2f} us  (+{timed_us - plain_us:.2f} us)")
+    print(f"histogram observe()               {observe_us:8.2f} us")
+    print(f"test client request, no hooks     {bare_us:8.1f} us")
+    print(f"test client request, timed        {hooked_us:8.1f} us  (+{hooked_us - bare_us:.1f} us)")
+    print(f"/metrics page                     {len(metrics.render()) / 1024:8.1f} KiB")
+
+
+if __name__ == '__main__':
+    main()
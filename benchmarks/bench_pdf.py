@@ -0,0 +1,91 @@
+"""Cost of the report card PDFs: drawing a sheet, sharing layout assets, the process pool, the disk cache.
+
+Usage:  python benchmarks/bench_pdf.py --sheets 500 --workers 4 [--font DejaVuSans.ttf] [--logo logo.png]
+
+Synthetic students with five assessments are drawn with one layout. The
+serial runs draw on this thread, first rebuilding the layout's assets (the
+logo's image cache) for every sheet and then sharing them, as the pool
+workers do. The pool run is warmed up first, so process start-up is not
+counted; it writes every sheet to the disk cache, and the last run reads
+them all back from it, as a resend of unchanged reports does. Without
+--logo a generated PNG is used.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+import report_pdf
+from report_pdf import PdfRenderer, render_sheet
+
+LABELS = ['Homework 1', 'Participation', 'Quiz 1', 'Final Exam - Khmer', 'Final Exam - English']
+
+
+def make_students(count):
+    rng = random.Random(42)
+    students = []
+    for i in range(count):
+        scores = [(label, float(rng.randint(50, 100))) for label in LABELS]
+        students.append({
+            'id': i + 1, 'email': f'student{i}@example.com', 'first_name': f'First{i}',
+            'last_name': f'Last{i}', 'class': f'C{i % 12:02d}', 'total': sum(score for _, score in scores),
+            'grade': rng.choice('ABCDF'), 'comments': 'Steady progress over the term. ' * rng.randint(0, 4),
+            'scores': scores,
+        })
+    return students
+
+
+def timed(label, count, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<36} {elapsed:7.2f} s  {elapsed / count * 1000:7.2f} ms/sheet  {count / elapsed:8.1f} sheets/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sheets', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 4))
+    parser.add_argument('--font', default='', help='TrueType font (default: built-in Helvetica)')
+    parser.add_argument('--logo', default='', help='logo image (default: a generated 400x400 PNG)')
+    args = parser.parse_args()
+
+    students = make_students(args.sheets)
+    with tempfile.TemporaryDirectory() as tmp:
+        logo = args.logo
+        if not logo:
+            from PIL import Image
+            logo = os.path.join(tmp, 'logo.png')
+            Image.effect_mandelbrot((400, 400), (-2, -1.5, 1, 1.5), 100).convert('RGB').save(logo)
+        renderer = PdfRenderer(os.path.join(tmp, 'cache'), font=args.font, logo=logo, workers=args.workers)
+        size = len(render_sheet(renderer.layout, students[0]))
+        print(f"{args.sheets} sheets of {size} bytes, font {args.font or 'Helvetica'}, "
+              f"{args.workers} workers, {os.cpu_count()} CPUs")
+
+        def fresh_assets():
+            for student in students:
+                report_pdf._local.layouts = {}
+                render_sheet(renderer.layout, student)
+
+        timed('serial, assets per sheet', args.sheets, fresh_assets)
+        timed('serial, shared assets', args.sheets,
+              lambda: [render_sheet(renderer.layout, student) for student in students])
+
+        # Start every worker on sheets that are not part of the timed run
+        warmup = [dict(student, email=f"warmup-{student['email']}") for student in students[:args.workers * 2]]
+        for future in [renderer.submit(student) for student in warmup]:
+            future.result()
+        timed(f'pool of {args.workers}, drawn and cached', args.sheets,
+              lambda: [future.result() for future in [renderer.submit(student) for student in students]])
+        timed('disk cache hits', args.sheets,
+              lambda: [future.result() for future in [renderer.submit(student) for student in students]])
+        renderer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""End-to-end benchmark of the HTTP pipeline, written as JSON so commits can be compared.
+
+Usage:  python benchmarks/bench_pipeline.py --sizes 100,1000,10000,100000 --output before.json
+        python benchmarks/bench_pipeline.py --sizes 100,1000,10000,100000 --compare before.json
+
+For each size, a synthetic spreadsheet shaped like term1.csv is generated
+(seeded, so every run gets the same rows). It goes into a fresh database,
+and the endpoints are driven through the Flask test client:
+
+- ``upload``: the first upload of the file.
+- ``reupload``: uploading the unchanged file again, as a merge.
+- ``students_page``, ``students_search``, ``students_class``: walking
+  /api/students by cursor, and filtered queries.
+- ``stats``: /api/stats.
+- ``send``: /api/send-emails for up to --send students, timed until the
+  background job has delivered them all to a local SMTP sink.
+- ``resend``: the same request again, which skips every unchanged report.
+- ``export``: /api/export-logs as CSV.
+
+Each stage records latency percentiles, throughput and the peak RSS seen
+while it ran. Sizes up to 1000000 work; the upload size limit is lifted
+for the run. Send settings come from the environment like in app.py
+(e.g. SEND_ENGINE=async). The outbound rate limits default to off here.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Before app is imported: it reads these once. The sink is not Gmail, so nothing needs throttling.
+os.environ.setdefault('MAIL_USERNAME', 'bench@example.com')
+os.environ.setdefault('MAIL_PASSWORD', 'bench')
+os.environ.setdefault('SEND_RATE_PER_SECOND', '1000000')
+os.environ.setdefault('SEND_BURST', '1000000')
+os.environ.setdefault('SEND_DAILY_LIMIT', '0')
+
+from flask_mail import Mail
+
+import app as student_app
+from smtp_sink import SMTPSink
+
+HEADER = ['First name', 'Last name', 'Email', 'Class', 'HW1', 'Participation', 'Q1',
+          'Final Khmer', 'Final English', 'Total', 'Grade', 'Comments']
+COMMENTS = ['Excellent work', 'Good progress', 'Strong analytical skills', 'Needs more practice', '']
+CONFIG_KEYS = ['STREAMING_IMPORT', 'IMPORT_CHUNK_SIZE', 'IMPORT_MODE', 'SEND_ENGINE', 'SEND_WORKERS',
+               'SEND_BATCH_SIZE', 'SMTP_POOL_SIZE', 'ASYNC_POOL_SIZE', 'ASYNC_CONCURRENCY']
+# Stages where a bigger number is better, and the key that holds it
+THROUGHPUT_KEYS = {'upload': 'rows_per_second', 'reupload': 'rows_per_second', 'send': 'messages_per_second',
+                   'export': 'rows_per_second'}
+
+
+def make_csv(count, seed=42):
+    # Same columns and value ranges as term1.csv; Total is the sum of the five scores
+    rng = random.Random(seed)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    for i in range(count):
+        scores = [rng.randint(50, 100) for _ in range(5)]
+        total = sum(scores)
+        grade = 'A' if total >= 450 else 'B' if total >= 400 else 'C' if total >= 350 else 'D'
+        writer.writerow([f'First{i}', f'Last{i}', f'student{i}@example.com', rng.choice('ABCDEFGH'),
+                         *scores, total, grade, rng.choice(COMMENTS)])
+    return buffer.getvalue().encode('utf-8')
+
+
+class RSSSampler:
+    """Peak resident set size between ``reset()`` calls, sampled every few milliseconds."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._page = resource.getpagesize()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def current(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self._page
+        except OSError:
+            # No /proc (macOS): fall back to the process-wide peak (bytes there, KiB on Linux)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def reset(self):
+        self.peak = self.current()
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def summarize(latencies, elapsed, rss, **throughput):
+    latencies = sorted(latencies)
+    result = {
+        'count': len(latencies),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 90) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'peak_rss_mb': round(rss.peak / 1e6, 1),
+    }
+    result.update({key: round(units / elapsed, 1) if elapsed else None for key, units in throughput.items()})
+    return result
+
+
+def run_stage(rss, requests, call, **units):
+    # call(i) makes request i and fails loudly on an error response
+    rss.reset()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(requests):
+        t = time.perf_counter()
+        call(i)
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - start, rss, **{k: v * requests for k, v in units.items()})
+
+
+def check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f'{response.request.path} -> {response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response
+
+
+def wait_for_job(job_id, user_id, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = student_app.job_queue.get(job_id, user_id, failures=False)
+        if job['status'] == 'completed':
+            return job
+        time.sleep(0.01)
+    raise RuntimeError(f'send job {job_id} did not finish within {timeout}s')
+
+
+def bench_size(client, rss, tmp, size, args):
+    path = os.path.join(tmp, f'bench-{size}.db')
+    student_app.app.config['DATABASE'] = path
+    student_app.job_queue.db_path = path
+    student_app.init_db()
+    check(client.post('/login', json={'username': 'admin', 'password': 'admin123'}))
+    data = make_csv(size, args.seed)
+    stages = {}
+
+    def upload(_):
+        check(client.post('/api/upload', data={'file': (io.BytesIO(data), 'results.csv'), 'mode': 'merge'}))
+
+    stages['upload'] = run_stage(rss, 1, upload, rows_per_second=size)
+    stages['reupload'] = run_stage(rss, 1, upload, rows_per_second=size)
+
+    pages = []
+
+    def students_page(i):
+        cursor = pages[-1] if pages else None
+        body = check(client.get('/api/students', query_string={'limit': 100, 'cursor': cursor})).json
+        pages.append(body['next_cursor'])
+        if body['next_cursor'] is None:
+            pages.clear()  # start over at the first page
+
+    stages['students_page'] = run_stage(rss, args.requests, students_page)
+    stages['students_search'] = run_stage(rss, args.requests, lambda i: check(client.get(
+        '/api/students', query_string={'limit': 100, 'search': f'Last{i * 7919 % size}'})))
+    stages['students_class'] = run_stage(rss, args.requests, lambda i: check(client.get(
+        '/api/students', query_string={'limit': 100, 'class': 'ABCDEFGH'[i % 8]})))
+    stages['stats'] = run_stage(rss, args.requests, lambda i: check(client.get('/api/stats')))
+
+    conn = student_app.db.get_connection(path)
+    student_ids = [row[0] for row in conn.execute('SELECT id FROM students ORDER BY id LIMIT ?', (args.send,))]
+    sent = {}
+
+    def send(_):
+        body = check(client.post('/api/send-emails', json={'student_ids': student_ids})).json
+        sent['job'] = wait_for_job(body['job_id'], 1, args.send_timeout) if body['job_id'] else None
+
+    rss.reset()
+    start = time.perf_counter()
+    send(0)
+    elapsed = time.perf_counter() - start
+    stages['send'] = summarize([elapsed], elapsed, rss, messages_per_second=sent['job']['sent'])
+    stages['send']['failed'] = sent['job']['failed']
+    stages['resend'] = run_stage(rss, 1, send)
+
+    exported = {}
+
+    def export(_):
+        exported['body'] = check(client.get('/api/export-logs', query_string={'format': 'csv'})).get_data()
+
+    export(0)  # one untimed request to count the rows
+    exported_rows = exported['body'].count(b'\n') - 1
+    stages['export'] = run_stage(rss, args.export_requests, export, rows_per_second=exported_rows)
+    stages['export']['bytes'] = len(exported['body'])
+    student_app.db.close_connection(path)
+    return stages
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(__file__), check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, cwd=os.path.dirname(__file__)).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, report, threshold, min_ms):
+    """Print the change of each stage against a baseline report; returns the regressions found."""
+    old = {(run['rows'], name): stage for run in baseline['results'] for name, stage in run['stages'].items()}
+    regressions = []
+    ignored = {'output', 'compare', 'threshold', 'min_ms'}
+    changed = sorted(key for key, value in report['meta']['args'].items()
+                     if key not in ignored and baseline['meta']['args'].get(key) != value)
+    if changed:
+        print(f"\nwarning: run with different {', '.join(changed)} than the baseline", file=sys.stderr)
+    print(f"\ncompared with {baseline['meta'].get('commit')} (regression = {threshold:.0%} worse)", file=sys.stderr)
+    for run in report['results']:
+        for name, stage in run['stages'].items():
+            before = old.get((run['rows'], name))
+            if before is None:
+                continue
+            changes = {'p50_ms': 0.0}
+            # Sub-millisecond requests jitter by more than the threshold from run to run
+            if before['p50_ms'] and stage['p50_ms'] - before['p50_ms'] >= min_ms:
+                changes['p50_ms'] = stage['p50_ms'] / before['p50_ms'] - 1
+            key = THROUGHPUT_KEYS.get(name)
+            if key and before.get(key):
+                changes[key] = before[key] / stage[key] - 1 if stage[key] else float('inf')
+            worst = max(changes.values())
+            flag = 'REGRESSION' if worst > threshold else ''
+            if flag:
+                regressions.append((run['rows'], name))
+            print(f"{run['rows']:>8} {name:<16} p50 {before['p50_ms']:10.2f} -> {stage['p50_ms']:10.2f} ms "
+                  f"({stage['p50_ms'] / before['p50_ms'] - 1:+.0%})  {flag}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000', help='comma-separated row counts (up to 1000000)')
+    parser.add_argument('--requests', type=int, default=50, help='requests per read-only stage')
+    parser.add_argument('--send', type=int, default=1000, help='students emailed per size (at most the size)')
+    parser.add_argument('--send-timeout', type=float, default=600)
+    parser.add_argument('--export-requests', type=int, default=3)
+    parser.add_argument('--message-delay', type=float, default=0.0, help='simulated SMTP server time per message')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON report here (default: stdout)')
+    parser.add_argument('--compare', help='baseline JSON report to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown counted as a regression')
+    parser.add_argument('--min-ms', type=float, default=1.0, help='smallest p50 increase counted as a regression')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    app = student_app.app
+    app.config['MAX_CONTENT_LENGTH'] = None  # a 1M-row CSV is about 80 MB
+    rss = RSSSampler()
+    results = []
+    with SMTPSink(message_delay=args.message_delay) as sink, tempfile.TemporaryDirectory() as tmp:
+        app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=sink.port, MAIL_USE_TLS=False)
+        student_app.mail = Mail(app)
+        student_app.smtp_pool.reset(student_app.mail)
+        client = app.test_client()
+        for size in sizes:
+            print(f"{size} rows...", file=sys.stderr)
+            stages = bench_size(client, rss, tmp, size, args)
+            results.append({'rows': size, 'stages': stages})
+            for name, stage in stages.items():
+                extra = ''.join(f"  {key}={stage[key]}" for key in ('rows_per_second', 'messages_per_second')
+                                if key in stage)
+                print(f"  {name:<16} p50 {stage['p50_ms']:10.2f} ms  p99 {stage['p99_ms']:10.2f} ms  "
+                      f"peak RSS {stage['peak_rss_mb']:7.1f} MB{extra}", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+            'config': {key: app.config[key] for key in CONFIG_KEYS},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold, args.min_ms)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
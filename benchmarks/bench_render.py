@@ -0,0 +1,105 @@
+"""Messages rendered per second: the old per-student f-string vs the compiled Jinja templates.
+
+Usage:  python benchmarks/bench_render.py --students 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from email_render import render_batch, render_report
+
+
+def legacy_render(student):
+    # The body send_emails() used to build inline for every student (abridged markup, same work)
+    student_name = f"{student['first_name']} {student['last_name']}"
+    body = f'''
+Academic Results Report
+Class: {student['class']}
+
+Dear {student_name},
+
+Assessment Scores:
+- Homework 1 (HW1): {student['hw1']}
+- Participation: {student['participation']}
+- Quiz 1 (Q1): {student['q1']}
+- Final Exam - Khmer: {student['final_khmer']}
+- Final Exam - English: {student['final_english']}
+
+Total Score: {student['total']}
+Final Grade: {student['grade']}
+
+{f"Teacher Comments: {student['comments']}" if student['comments'] else ''}
+'''
+    html = f'''
+    <html>
+    <head>
+        <style>
+            body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
+            .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
+            .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 30px; text-align: center; border-radius: 10px 10px 0 0; }}
+            .content {{ background: #f9f9f9; padding: 30px; border-radius: 0 0 10px 10px; }}
+            .result-table {{ width: 100%; border-collapse: collapse; margin: 20px 0; background: white; }}
+            .result-table th, .result-table td {{ padding: 12px; text-align: left; border-bottom: 1px solid #ddd; }}
+            .result-table th {{ background-color: #667eea; color: white; }}
+            .total {{ font-weight: bold; font-size: 18px; color: #667eea; }}
+            .grade-badge {{ display: inline-block; padding: 8px 16px; border-radius: 20px; background: #667eea; color: white; font-weight: bold; }}
+            .footer {{ text-align: center; margin-top: 20px; color: #666; font-size: 12px; }}
+            .comments {{ background: #fff3cd; padding: 15px; border-radius: 5px; margin-top: 15px; border-left: 4px solid #ffc107; }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="header"><h1>Academic Results Report</h1><p>Class: {student['class']}</p></div>
+            <div class="content">
+                <h2>Dear {student_name},</h2>
+                <table class="result-table">
+                    <tr><th>Assessment</th><th>Score</th></tr>
+                    <tr><td>Homework 1 (HW1)</td><td>{student['hw1']}</td></tr>
+                    <tr><td>Participation</td><td>{student['participation']}</td></tr>
+                    <tr><td>Quiz 1 (Q1)</td><td>{student['q1']}</td></tr>
+                    <tr><td>Final Exam - Khmer</td><td>{student['final_khmer']}</td></tr>
+                    <tr><td>Final Exam - English</td><td>{student['final_english']}</td></tr>
+                    <tr class="total"><td>Total Score</td><td>{student['total']}</td></tr>
+                    <tr class="total"><td>Final Grade</td><td><span class="grade-badge">{student['grade']}</span></td></tr>
+                </table>
+                {f'<div class="comments"><strong>Teacher Comments:</strong><br>{student["comments"]}</div>' if student['comments'] else ''}
+            </div>
+        </div>
+    </body>
+    </html>
+    '''
+    return f"Academic Results - {student['class']}", body, html
+
+
+def make_students(count):
+    return [{'first_name': f'First{i}', 'last_name': f'Last{i}', 'email': f's{i}@example.com',
+             'class': 'Web Development', 'hw1': 95.0, 'participation': 90.0, 'q1': 88.0,
+             'final_khmer': 85.0, 'final_english': 92.0, 'total': 450.0, 'grade': 'A',
+             'scores': [('Homework 1 (HW1)', 95.0), ('Participation', 90.0), ('Quiz 1 (Q1)', 88.0),
+                        ('Final Exam - Khmer', 85.0), ('Final Exam - English', 92.0)],
+             'comments': 'Excellent work' if i % 2 else None} for i in range(count)]
+
+
+def run(label, count, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {count / elapsed:12.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=20000)
+    args = parser.parse_args()
+
+    students = make_students(args.students)
+    run('f-string per student', args.students, lambda: [legacy_render(s) for s in students])
+    run('jinja, one at a time', args.students, lambda: [render_report(s) for s in students])
+    run('jinja, batch', args.students, lambda: render_batch(students))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Cost of server-side sessions and of the per-user settings cache.
+
+Usage:  python benchmarks/bench_sessions.py --requests 2000
+
+The first part times a bare Flask request that reads the session, once
+with Flask's signed-cookie sessions and once with the SQLite sessions from
+sessions.py. The second part runs the app in a temporary directory, signs
+in and requests one page of students. It compares an empty user cache
+(size 0, so the user row and current term are read on every request) with
+the default one. It reports the time and the SQL statements per request,
+by table.
+"""
+import argparse
+import collections
+import os
+import re
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from flask import Flask, session
+from flask.sessions import SecureCookieSessionInterface
+
+TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+
+
+def per_request(client, url, count):
+    client.get(url)
+    start = time.perf_counter()
+    for _ in range(count):
+        client.get(url)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def bare_app(interface, database):
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY='bench', DATABASE=database)
+    app.session_interface = interface
+
+    @app.route('/login')
+    def login():
+        session['user_id'] = 1
+        return 'ok'
+
+    app.add_url_rule('/ping', 'ping', lambda: str(session.get('user_id')))
+    client = app.test_client()
+    client.get('/login')
+    return client
+
+
+def statements(conn, client, url, count):
+    seen = []
+    conn.set_trace_callback(seen.append)
+    try:
+        for _ in range(count):
+            client.get(url)
+    finally:
+        conn.set_trace_callback(None)
+    tables = collections.Counter(match for sql in seen for match in TABLE.findall(sql))
+    return len(seen) / count, {table: n / count for table, n in sorted(tables.items())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The app creates its database and upload folder in the working directory on import
+        os.chdir(tmp)
+        import app as application
+        import db
+        import sessions
+        import users
+
+        application.init_db()
+        database = application.app.config['DATABASE']
+        cookie_us = per_request(bare_app(SecureCookieSessionInterface(), database), '/ping', args.requests)
+        sqlite_us = per_request(bare_app(sessions.SQLiteSessionInterface(), database), '/ping', args.requests)
+        print(f"bare request, signed-cookie session   {cookie_us:8.1f} us")
+        print(f"bare request, SQLite session          {sqlite_us:8.1f} us  ({sqlite_us - cookie_us:+.1f} us)")
+
+        client = application.app.test_client()
+        client.post('/login', json={'username': 'admin', 'password': 'admin123'})
+        with open(os.path.join(ROOT, 'term1.csv'), 'rb') as f:
+            client.post('/api/upload', data={'file': (f, 'term1.csv')})
+        conn = db.get_connection(database)
+        url = '/api/students?limit=1'
+        for label, size in [('no user cache', 0), ('user cache', application.app.config['USER_CACHE_SIZE'])]:
+            application.user_cache = users.UserCache(size=size, ttl=application.app.config['USER_CACHE_TTL'])
+            elapsed = per_request(client, url, args.requests)
+            count, tables = statements(conn, client, url, 50)
+            by_table = ', '.join(f'{table} {n:g}' for table, n in tables.items())
+            print(f"{url}, {label:<14} {elapsed:8.1f} us  {count:g} statements ({by_table})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Send throughput with one sender account versus several (sharded jobs).
+
+Usage:  python benchmarks/bench_shard.py --accounts 1,2,4 --messages 200 --rate 20
+        SEND_ENGINE=async python benchmarks/bench_shard.py
+
+Every account gets the same limit of --rate messages per second
+(SEND_RATE_PER_SECOND, with a burst of one), and all of them deliver to one
+local SMTP sink. For each account count the admin user's accounts are
+replaced by that many new ones, and one sharded send of --messages students
+is timed until the job is done. While the rate limit is what binds,
+throughput grows with the number of accounts, up to what SEND_WORKERS
+threads (or the async engines) can push.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', default='1,2,4', help='comma-separated account counts')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=20, help='messages per second for each account')
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    # Before app is imported: it reads these once
+    os.environ['SEND_RATE_PER_SECOND'] = str(args.rate)
+    os.environ['SEND_BURST'] = '1'
+    os.environ['SEND_DAILY_LIMIT'] = '0'
+    # Saving the accounts needs a key for their passwords
+    os.environ.setdefault('MAIL_CREDENTIALS_KEY', 'YmVuY2gtYmVuY2gtYmVuY2gtYmVuY2gtYmVuY2gtYmU=')
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # the app creates its database and upload folder in the working directory
+        run(args)
+
+
+def run(args):
+    from bench_pipeline import check, make_csv, student_app, wait_for_job
+    from smtp_sink import SMTPSink
+
+    app = student_app.app
+    with SMTPSink() as sink:
+        student_app.init_db()
+        student_app.job_queue.start()
+        client = app.test_client()
+        check(client.post('/login', json={'username': 'admin', 'password': 'admin123'}))
+        check(client.post('/api/upload', data={'file': (io.BytesIO(make_csv(args.messages)), 'students.csv')}))
+        ids = []
+        cursor = None
+        while True:
+            page = check(client.get('/api/students', query_string={'limit': 1000, 'fields': 'id',
+                                                                   **({'cursor': cursor} if cursor else {})})).json
+            ids.extend(student['id'] for student in page['students'])
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+
+        print(f"{len(ids)} messages, {args.rate:g}/s per account, engine {app.config['SEND_ENGINE']}, "
+              f"{app.config['SEND_WORKERS']} send workers")
+        baseline = None
+        for run, count in enumerate(int(n) for n in args.accounts.split(',')):
+            for account in check(client.get('/api/mail-accounts')).json['accounts']:
+                check(client.delete(f"/api/mail-accounts/{account['id']}"))
+            for n in range(count):
+                check(client.post('/api/mail-accounts', json={
+                    'email': f'sender{run}-{n}@example.com', 'password': 'bench',
+                    'server': '127.0.0.1', 'port': sink.port, 'use_tls': False}))
+
+            start = time.perf_counter()
+            job_id = check(client.post('/api/send-emails',
+                                       json={'student_ids': ids, 'force': True, 'shard': True})).json['job_id']
+            job = wait_for_job(job_id, 1, args.timeout)
+            elapsed = time.perf_counter() - start
+            rate = job['sent'] / elapsed
+            baseline = baseline or rate
+            print(f"  {count} account(s): {job['sent']} sent, {job['failed']} failed in {elapsed:6.2f} s  "
+                  f"{rate:7.1f} msg/s  x{rate / baseline:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Compare one-connection-per-message sending with the pooled SMTP path.
+
+Usage:  python benchmarks/bench_smtp_pool.py --messages 500 --threads 4
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask
+from flask_mail import Mail, Message
+
+from smtp_pool import SMTPPool
+from smtp_sink import SMTPSink
+
+
+def make_app(port):
+    app = Flask(__name__)
+    app.config['MAIL_SERVER'] = '127.0.0.1'
+    app.config['MAIL_PORT'] = port
+    app.config['MAIL_USE_TLS'] = False
+    app.config['MAIL_USERNAME'] = 'bench@example.com'
+    app.config['MAIL_PASSWORD'] = 'bench'
+    app.config['MAIL_DEFAULT_SENDER'] = 'bench@example.com'
+    return app
+
+
+def make_message(i):
+    msg = Message(subject=f"Academic Results - bench {i}", recipients=[f"student{i}@example.com"])
+    msg.body = 'Total Score: 450\nFinal Grade: A\n'
+    msg.html = '<html><body><p>Total Score: 450</p><p>Final Grade: A</p></body></html>'
+    return msg
+
+
+def run(label, sink, count, fn):
+    before = sink.connections
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {count / elapsed:10.1f} msg/s  {elapsed:7.2f}s  "
+          f"connections={sink.connections - before}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--connect-delay', type=float, default=0.02,
+                        help='simulated handshake cost per connection, in seconds')
+    args = parser.parse_args()
+
+    with SMTPSink(connect_delay=args.connect_delay) as sink:
+        app = make_app(sink.port)
+        mail = Mail(app)
+
+        def send_serial():
+            with app.app_context():
+                for i in range(args.messages):
+                    mail.send(make_message(i))
+
+        def send_pooled(threads):
+            pool = SMTPPool(mail, size=threads)
+
+            def send_one(i):
+                with app.app_context():
+                    pool.send(make_message(i))
+
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(send_one, range(args.messages)))
+            pool.reset()
+
+        print(f"{args.messages} messages, connect delay {args.connect_delay * 1000:.0f} ms")
+        run('mail.send per message', sink, args.messages, send_serial)
+        run('pool, 1 thread', sink, args.messages, lambda: send_pooled(1))
+        run(f'pool, {args.threads} threads', sink, args.messages, lambda: send_pooled(args.threads))
+
+
+if __name__ == '__main__':
+    main()
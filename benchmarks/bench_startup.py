@@ -0,0 +1,165 @@
+"""Startup time and memory per process: importing the app, and a gunicorn or waitress server.
+
+Usage:  python benchmarks/bench_startup.py --workers 4
+        python benchmarks/bench_startup.py --server waitress
+
+The first part times ``import app`` in fresh interpreters and reports the
+resident memory and whether pandas and NumPy were loaded. The second part
+starts the server from wsgi.py in an empty directory, so it gets a new
+database. It reports the time until the first response, then RSS and PSS
+for each process. PSS counts pages shared with the master process
+proportionally. Memory is measured once after boot, then again after one
+upload, which loads pandas into the worker that handles it.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+IMPORT_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+rss = int(open('/proc/self/statm').read().split()[1]) * __import__('resource').getpagesize()
+print(json.dumps({'seconds': elapsed, 'rss': rss, 'pandas': 'pandas' in sys.modules, 'numpy': 'numpy' in sys.modules}))
+'''
+
+
+def memory(pid):
+    # RSS and PSS in bytes (PSS needs smaps_rollup, Linux 4.14+)
+    with open(f'/proc/{pid}/status') as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) * 1024
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            pss = next(int(line.split()[1]) for line in f if line.startswith('Pss:')) * 1024
+    except (OSError, StopIteration):
+        pss = None
+    return rss, pss
+
+
+def children(pid):
+    result = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # The ppid is the second field after the parenthesised command name
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        result.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    return sorted(result)
+
+
+def measure_import(runs):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    samples = [json.loads(subprocess.run([sys.executable, '-c', IMPORT_PROBE], env=env, cwd=tempfile.gettempdir(),
+                                         capture_output=True, text=True, check=True).stdout) for _ in range(runs)]
+    return {
+        'seconds': statistics.median(sample['seconds'] for sample in samples),
+        'rss': statistics.median(sample['rss'] for sample in samples),
+        'pandas': samples[0]['pandas'],
+        'numpy': samples[0]['numpy'],
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def upload(base):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    opener.open(urllib.request.Request(f'{base}/login', json.dumps({'username': 'admin', 'password': 'admin123'})
+                                       .encode(), {'Content-Type': 'application/json'})).read()
+    boundary = uuid.uuid4().hex
+    with open(os.path.join(ROOT, 'term1.csv'), 'rb') as f:
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="term1.csv"\r\n'
+                f'Content-Type: text/csv\r\n\r\n').encode() + f.read() + f'\r\n--{boundary}--\r\n'.encode()
+    opener.open(urllib.request.Request(f'{base}/api/upload', body,
+                                       {'Content-Type': f'multipart/form-data; boundary={boundary}'})).read()
+
+
+def report(label, pids):
+    print(f"  {label}")
+    for role, pid in pids:
+        rss, pss = memory(pid)
+        pss_text = f"{pss / 1e6:7.1f} MB PSS" if pss is not None else ''
+        print(f"    {role:<8} pid {pid:<7} {rss / 1e6:7.1f} MB RSS  {pss_text}")
+
+
+def measure_server(server, workers, timeout):
+    executable = 'gunicorn' if server == 'gunicorn' else 'waitress-serve'
+    if shutil.which(executable) is None:
+        print(f"{executable} is not installed; skipping the server measurement")
+        return
+    port = free_port()
+    if server == 'gunicorn':
+        command = [executable, '-c', os.path.join(ROOT, 'gunicorn.conf.py'), '--workers', str(workers),
+                   '--bind', f'127.0.0.1:{port}', 'wsgi:app']
+    else:
+        command = [executable, f'--listen=127.0.0.1:{port}', 'wsgi:app']
+    base = f'http://127.0.0.1:{port}'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    urllib.request.urlopen(f'{base}/login', timeout=1).read()
+                    break
+                except (urllib.error.URLError, ConnectionError):
+                    if process.poll() is not None or time.perf_counter() - start > timeout:
+                        raise RuntimeError(f'{server} did not start')
+                    time.sleep(0.02)
+            first_response = time.perf_counter() - start
+            if server == 'gunicorn':
+                # Wait until every worker has booted, not just the first
+                while len(children(process.pid)) < workers and time.perf_counter() - start < timeout:
+                    time.sleep(0.05)
+                time.sleep(0.5)
+                pids = [('master', process.pid)] + [('worker', pid) for pid in children(process.pid)]
+            else:
+                pids = [('server', process.pid)]
+
+            print(f"{server}: first response after {first_response * 1000:.0f} ms")
+            report('after boot', pids)
+            upload(base)
+            report('after one upload', pids)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters for the import timing')
+    parser.add_argument('--server', choices=['gunicorn', 'waitress'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    imported = measure_import(args.runs)
+    print(f"import app: {imported['seconds'] * 1000:.0f} ms, {imported['rss'] / 1e6:.1f} MB RSS "
+          f"(median of {args.runs}); pandas loaded: {imported['pandas']}, NumPy loaded: {imported['numpy']}")
+    measure_server(args.server, args.workers, args.timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Send through a rate-limited sink with and without the SendThrottle limiter.
+
+Usage:  python benchmarks/bench_throttle.py --messages 300 --threads 4 --server-rate 20
+
+The sink answers 421 once its own per-second quota is used up. Unthrottled,
+those messages fail; with the limiter they are paused, retried and delivered,
+and the sustained rate settles just under what the server allows.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask_mail import Mail
+
+from bench_smtp_pool import make_app, make_message
+from ratelimit import SendThrottle
+from smtp_pool import SMTPPool
+from smtp_sink import SMTPSink
+
+
+def run(label, args, throttle):
+    with SMTPSink(rate_limit=args.server_rate) as sink:
+        app = make_app(sink.port)
+        pool = SMTPPool(Mail(app), size=args.threads)
+
+        def send_one(i):
+            with app.app_context():
+                try:
+                    if throttle is None:
+                        pool.send(make_message(i))
+                    else:
+                        throttle.send(pool.send, make_message(i))
+                    return True
+                except Exception:
+                    return False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            results = list(executor.map(send_one, range(args.messages)))
+        elapsed = time.perf_counter() - start
+        pool.reset()
+
+    delivered = sum(results)
+    print(f"{label:<24} delivered={delivered:<5} failed={len(results) - delivered:<5} "
+          f"421 replies={sink.throttled:<5} {delivered / elapsed:7.1f} msg/s  {elapsed:6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--server-rate', type=float, default=20, help='messages/second the sink accepts')
+    parser.add_argument('--client-rate', type=float, default=50,
+                        help='configured SEND_RATE_PER_SECOND (deliberately above the server limit)')
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages, server allows {args.server_rate:g}/s, limiter set to {args.client_rate:g}/s")
+    run('no limiter', args, None)
+    run('SendThrottle', args, SendThrottle(per_second=args.client_rate, burst=args.client_rate, max_backoff=10))
+    run('SendThrottle at quota', args, SendThrottle(per_second=args.server_rate * 0.9, burst=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Local stand-in SMTP server that accepts and discards every message.
+
+Used by the benchmarks so sending can be measured offline, without Gmail.
+It speaks just enough ESMTP for smtplib, Flask-Mail and aiosmtplib: EHLO/HELO,
+AUTH (any credentials), MAIL, RCPT, DATA, RSET, NOOP and QUIT. There is no
+STARTTLS, so point clients at it with MAIL_USE_TLS = False. With
+``rate_limit`` set it behaves like a provider quota: MAIL commands beyond
+that many per second get "421 try again later" and the connection is closed.
+
+Run standalone with:  python benchmarks/smtp_sink.py --port 1025
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        sink = self.server.sink
+        # Simulated TLS/auth handshake cost paid once per connection
+        if sink.connect_delay:
+            time.sleep(sink.connect_delay)
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 smtp-sink ESMTP ready')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line[:4].decode('ascii', 'replace').upper()
+
+            if verb == 'EHLO':
+                self.wfile.write(b'250-smtp-sink\r\n250-PIPELINING\r\n250-8BITMIME\r\n'
+                                 b'250-AUTH PLAIN LOGIN\r\n250 SIZE 33554432\r\n')
+            elif verb == 'HELO':
+                self.reply('250 smtp-sink')
+            elif verb == 'AUTH':
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    size += len(data)
+                if sink.message_delay:
+                    time.sleep(sink.message_delay)
+                with sink.lock:
+                    sink.messages += 1
+                    sink.bytes += size
+                self.reply('250 2.0.0 OK queued')
+            elif verb == 'MAIL' and not sink.admit():
+                sink.throttled += 1
+                self.reply('421 4.7.0 Too many messages, try again later')
+                return
+            elif verb == 'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 2.0.0 OK')
+            else:
+                self.reply('502 5.5.2 Command not recognized')
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # The default backlog of 5 drops SYNs when a pool opens many connections at once
+    request_queue_size = 128
+
+
+class SMTPSink:
+    """Threaded SMTP sink. ``port=0`` picks a free port; read it back from ``.port``."""
+
+    def __init__(self, host='127.0.0.1', port=0, connect_delay=0.0, message_delay=0.0, rate_limit=0):
+        self.connect_delay = connect_delay
+        self.message_delay = message_delay
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.bytes = 0
+        self.throttled = 0
+        self._allowance = rate_limit
+        self._checked = time.monotonic()
+        self._server = _ThreadingServer((host, port), _SinkHandler)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address
+        self._thread = None
+
+    def admit(self):
+        # Server-side token bucket (burst of one second's worth) for rate_limit
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate_limit, self._allowance + (now - self._checked) * self.rate_limit)
+            self._checked = now
+            if self._allowance < 1:
+                return False
+            self._allowance -= 1
+            return True
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local SMTP sink')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--connect-delay', type=float, default=0.0,
+                        help='seconds to stall each new connection (simulates the TLS handshake)')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='messages per second accepted before replying 421 (0 = unlimited)')
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, connect_delay=args.connect_delay, rate_limit=args.rate_limit).start()
+    print(f"SMTP sink listening on {sink.host}:{sink.port} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"connections={sink.connections} messages={sink.messages} throttled={sink.throttled}")
+    except KeyboardInterrupt:
+        sink.stop()
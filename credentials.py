@@ -0,0 +1,67 @@
+"""Encryption of the mail passwords stored in the database.
+
+Passwords are encrypted with Fernet (AES in CBC mode plus an HMAC) from the
+``cryptography`` package, which is imported on first use.
+MAIL_CREDENTIALS_KEY holds one or more comma-separated Fernet keys
+(``python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"``).
+The first key encrypts and every key decrypts, so a key is rotated by
+putting the new one first. Without it, a key is derived from SECRET_KEY;
+changing SECRET_KEY then makes the stored passwords unreadable, and they
+have to be entered again. A key is never derived from the placeholder
+SECRET_KEY shipped in the code and docs, since anyone reading the database
+could then decrypt the passwords: with neither setting, passwords cannot be
+stored.
+"""
+import base64
+import hashlib
+
+
+# The default in app.py and the examples in the docs
+PLACEHOLDER_SECRET_KEYS = {'your-secret-key-change-in-production', 'your-random-secret-key',
+                           'change-this-to-random-string'}
+
+
+class CredentialsError(RuntimeError):
+    pass
+
+
+def has_key(config):
+    """Whether mail passwords can be stored: MAIL_CREDENTIALS_KEY or a SECRET_KEY of the deployment's own."""
+    if config.get('MAIL_CREDENTIALS_KEY', '').strip():
+        return True
+    return bool(config.get('SECRET_KEY')) and config['SECRET_KEY'] not in PLACEHOLDER_SECRET_KEYS
+
+
+def derive_key(secret):
+    return base64.urlsafe_b64encode(hashlib.sha256(b'mail-credentials:' + secret.encode()).digest())
+
+
+class CredentialCipher:
+    def __init__(self, keys):
+        try:
+            from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+        except ImportError:
+            raise CredentialsError('Storing mail passwords requires the cryptography package')
+        self._invalid_token = InvalidToken
+        try:
+            self._fernet = MultiFernet([Fernet(key) for key in keys])
+        except ValueError:
+            raise CredentialsError('MAIL_CREDENTIALS_KEY must be a comma-separated list of Fernet keys')
+
+    @classmethod
+    def from_config(cls, config):
+        keys = [key.strip().encode() for key in config.get('MAIL_CREDENTIALS_KEY', '').split(',') if key.strip()]
+        if not keys and not has_key(config):
+            raise CredentialsError('Mail passwords cannot be stored securely: set MAIL_CREDENTIALS_KEY '
+                                   '(or a SECRET_KEY of your own) in .env and restart the server')
+        return cls(keys or [derive_key(config['SECRET_KEY'])])
+
+    def encrypt(self, text):
+        return self._fernet.encrypt(text.encode())
+
+    def decrypt(self, token):
+        try:
+            return self._fernet.decrypt(token).decode()
+        except self._invalid_token:
+            raise CredentialsError('A stored mail password cannot be decrypted (the key has changed); '
+                                   'enter it again in Settings')
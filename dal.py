@@ -0,0 +1,169 @@
+"""Batch data access for the send path: chunked IN lookups and buffered log writes."""
+import time
+from collections import Counter
+
+import stats
+
+# Stay under SQLITE_MAX_VARIABLE_NUMBER (999 on older SQLite builds)
+MAX_VARIABLES = 900
+
+
+def chunked(values, size=MAX_VARIABLES):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def fetch_scores(c, student_ids, student_terms=None):
+    """``{student id: [(code, label, score), ...]}`` over every assessment of the student's term.
+
+    Assessments are in term order; a missing score is ``None``. Scores are
+    read by primary key and matched to the (few) assessments in Python,
+    which is several times faster than joining them in SQL.
+    ``student_terms`` (student id -> term id) saves the term lookup.
+    """
+    student_ids = list(dict.fromkeys(student_ids))
+    if student_terms is None:
+        student_terms = {}
+        for chunk in chunked(student_ids):
+            placeholders = ', '.join('?' for _ in chunk)
+            student_terms.update(c.execute(f"SELECT id, term_id FROM students WHERE id IN ({placeholders})",
+                                           chunk).fetchall())
+    # Plain tuples for the bulk read: a row factory costs more than the lookup itself here
+    plain = c.connection.cursor()
+    plain.row_factory = None
+    values = {}
+    for chunk in chunked(student_ids):
+        placeholders = ', '.join('?' for _ in chunk)
+        for student_id, assessment_id, score in plain.execute(
+                f"SELECT student_id, assessment_id, score FROM scores WHERE student_id IN ({placeholders})", chunk):
+            values.setdefault(student_id, {})[assessment_id] = score
+
+    assessments = {}
+    for term_id in set(student_terms.values()):
+        assessments[term_id] = c.execute("SELECT id, code, label FROM assessments WHERE term_id = ? "
+                                         "ORDER BY position", (term_id,)).fetchall()
+    scores = {}
+    for student_id, term_id in student_terms.items():
+        student_values = values.get(student_id, {})
+        scores[student_id] = [(code, label, student_values.get(assessment_id))
+                              for assessment_id, code, label in assessments.get(term_id, [])]
+    return scores
+
+
+def fetch_students(c, student_ids):
+    # One WHERE id IN (...) query per chunk instead of one query per student; each student
+    # dict carries its report lines as 'scores': [(label, score), ...]
+    students = {}
+    for chunk in chunked(list(dict.fromkeys(student_ids))):
+        placeholders = ', '.join('?' for _ in chunk)
+        for row in c.execute(f"SELECT * FROM students WHERE id IN ({placeholders})", chunk):
+            students[row['id']] = dict(row, scores=[])
+    student_terms = {student_id: student['term_id'] for student_id, student in students.items()}
+    for student_id, lines in fetch_scores(c, list(students), student_terms).items():
+        students[student_id]['scores'] = [(label, score) for _, label, score in lines]
+    return students
+
+
+def count_recent_sends(c, sender, window='-1 day', unattributed=False):
+    # Successful sends from one address inside the provider's rolling quota window; with unattributed,
+    # also those logged before sent_from was recorded (all of which went out through the app-wide account)
+    match = '(sent_from = ? OR sent_from IS NULL)' if unattributed else 'sent_from = ?'
+    return c.execute(f"""SELECT COUNT(*) FROM email_logs
+                         WHERE {match} AND status = 'success' AND sent_date >= datetime('now', ?)""",
+                     (sender, window)).fetchone()[0]
+
+
+def sent_fingerprints(c, user_id, fingerprints):
+    # Which of these report fingerprints this user has already delivered (partial index lookup)
+    sent = set()
+    for chunk in chunked(list(set(fingerprints))):
+        placeholders = ', '.join('?' for _ in chunk)
+        sent.update(row[0] for row in c.execute(
+            f"""SELECT fingerprint FROM email_logs
+                WHERE sent_by = ? AND status = 'success' AND fingerprint IN ({placeholders})""",
+            [user_id, *chunk]))
+    return sent
+
+
+class LogBuffer:
+    """Collects send outcomes and writes them in small periodic transactions.
+
+    Each flush inserts the buffered email_logs rows with one executemany,
+    marks the matching send_job_items, and bumps the user_stats counters,
+    all in one commit. A flush happens every ``flush_size`` outcomes or
+    ``flush_interval`` seconds, so a crash loses at most one small batch.
+
+    Successful rows carry the report ``fingerprint`` so the same email is not
+    sent twice, and every row the ``sender`` address it went out from. An
+    outcome with ``retry_in`` set is a failed attempt that will be tried
+    again: it is logged as 'retried' and its item is parked as 'retry'
+    until ``retry_in`` seconds from now. Log rows are keyed by
+    (job_item_id, attempt), so writing the same attempt twice is a no-op.
+    ``on_flush()`` is called after each commit.
+    """
+
+    def __init__(self, conn, flush_size=20, flush_interval=1.0, on_flush=None):
+        self.conn = conn
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self._logs = []
+        self._items = []
+        self._last_flush = time.monotonic()
+
+    def add(self, item_id, user_id, student, status, error_msg=None, attempt=1, retry_in=None, fingerprint=None,
+            sender=None):
+        if retry_in is not None:
+            log_status, item_status = 'retried', 'retry'
+        else:
+            log_status = item_status = status
+        if student is not None:
+            student_name = f"{student['first_name']} {student['last_name']}"
+            self._logs.append((student['id'], student_name, student['email'], log_status, user_id, error_msg,
+                               attempt, item_id, fingerprint if log_status == 'success' else None, sender))
+        if item_id is not None:
+            self._items.append((item_status, error_msg, retry_in, item_id))
+
+        if (max(len(self._logs), len(self._items)) >= self.flush_size or
+                time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _logged_attempts(self, c):
+        item_ids = [log[7] for log in self._logs if log[7] is not None]
+        logged = set()
+        for chunk in chunked(item_ids):
+            placeholders = ', '.join('?' for _ in chunk)
+            logged.update(tuple(row) for row in c.execute(
+                f"SELECT job_item_id, attempt FROM email_logs WHERE job_item_id IN ({placeholders})", chunk))
+        return logged
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._logs and not self._items:
+            return
+
+        c = self.conn.cursor()
+        try:
+            # An attempt that is already logged is never logged (or counted) twice
+            existing = self._logged_attempts(c)
+            logged = [log for log in self._logs if (log[7], log[6]) not in existing]
+            c.executemany('''INSERT OR IGNORE INTO email_logs
+                             (student_id, student_name, student_email, status, sent_by, error_message,
+                              attempt, job_item_id, fingerprint, sent_from)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', logged)
+            # 'retried' rows are not final, so record_email() ignores them
+            for (user_id, status), count in Counter((log[4], log[3]) for log in logged).items():
+                stats.record_email(c, user_id, status, count)
+            c.executemany('''UPDATE send_job_items
+                             SET status = ?, error_message = ?,
+                                 next_attempt_at = datetime('now', '+' || ? || ' seconds'),
+                                 updated_at = CURRENT_TIMESTAMP
+                             WHERE id = ?''', self._items)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self._logs = []
+        self._items = []
+        if self.on_flush is not None:
+            self.on_flush()
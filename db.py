@@ -0,0 +1,150 @@
+"""Shared SQLite connection layer.
+
+Connections are opened once per thread and reused: Flask requests get theirs
+through ``get_db()`` (cached on ``g``), background workers call
+``get_connection()`` directly. Every connection runs in WAL mode so readers
+never block the writer, and waits on locks instead of failing with
+"database is locked". Statements and commits are timed into the
+``sqlite_query_duration_seconds`` metric.
+"""
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+import metrics
+
+BUSY_TIMEOUT_MS = 30000
+# Per-connection prepared statement cache (sqlite3 default is 128)
+CACHED_STATEMENTS = 256
+
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    # WAL makes NORMAL durable against application crashes; only power loss can drop the last commit
+    'PRAGMA synchronous = NORMAL',
+    f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}',
+    'PRAGMA cache_size = -20000',       # ~20 MB page cache
+    'PRAGMA mmap_size = 268435456',     # 256 MB memory-mapped reads
+    'PRAGMA temp_store = MEMORY',
+]
+
+# Statements are timed by their first keyword; anything else counts as 'OTHER'
+OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH', 'BEGIN', 'CREATE', 'PRAGMA'}
+
+QUERY_SECONDS = metrics.histogram('sqlite_query_duration_seconds',
+                                  'Time spent in execute() and commit(), by statement type', ['operation'])
+
+_local = threading.local()
+
+
+def _operation(sql):
+    keyword = (sql.split(None, 1) or [''])[0].upper()
+    return keyword if keyword in OPERATIONS else 'OTHER'
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Rows fetched after execute() returns are not part of the timing
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, _operation(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, _operation(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, 'COMMIT')
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=CACHED_STATEMENTS,
+                           factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection(path):
+    # One long-lived connection per thread and database file
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = connections[path] = connect(path)
+    return conn
+
+
+def close_connection(path):
+    connections = getattr(_local, 'connections', {})
+    conn = connections.pop(path, None)
+    if conn is not None:
+        conn.close()
+
+
+def get_db():
+    if 'db' not in g:
+        g.db = get_connection(current_app.config['DATABASE'])
+    return g.db
+
+
+def _teardown_db(exc):
+    conn = g.pop('db', None)
+    # The connection outlives the request; never leave a write lock behind
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+def init_app(app):
+    app.teardown_appcontext(_teardown_db)
+
+
+def migrate(conn, migrations):
+    """Apply the migrations not yet recorded in ``PRAGMA user_version``.
+
+    ``migrations`` is an ordered list; each entry is a list of SQL statements
+    or callables taking a cursor. Every migration runs in its own transaction,
+    so it is applied exactly once even when several processes start together.
+    """
+    c = conn.cursor()
+    while True:
+        c.execute('BEGIN IMMEDIATE')
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(migrations):
+            conn.rollback()
+            return version
+        try:
+            for step in migrations[version]:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
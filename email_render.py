@@ -0,0 +1,63 @@
+"""Results email rendering from precompiled Jinja templates.
+
+The templates in templates/email are compiled once at import and never
+re-checked on disk, and the shared stylesheet is read once and inlined as
+a template global, so rendering a message is only the per-student work.
+"""
+import hashlib
+import os
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+
+_env = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=select_autoescape(['html']),
+    auto_reload=False,
+)
+
+with open(os.path.join(TEMPLATE_DIR, 'report.css')) as f:
+    _env.globals['report_css'] = Markup(f.read())
+
+# Everything a results email shows besides the assessment scores, which go between class and
+# total; two students with equal values (in the same assessments) get identical emails
+REPORT_FIELDS = ['email', 'first_name', 'last_name', 'class', 'total', 'grade', 'comments']
+
+_html_template = _env.get_template('result_report.html')
+_text_template = _env.get_template('result_report.txt')
+
+
+def render_report(student, test=False):
+    """Return ``(subject, text_body, html_body)`` for one student.
+
+    ``student`` is a dict as returned by dal.fetch_students(), with the
+    report lines of its term in ``student['scores']`` as (label, score) pairs.
+    """
+    context = {
+        'student': student,
+        'student_name': f"{student['first_name']} {student['last_name']}",
+        'test': test,
+    }
+    subject = f"Academic Results - {student['class']}"
+    if test:
+        subject = f"TEST - {subject}"
+    return subject, _text_template.render(context), _html_template.render(context)
+
+
+def render_batch(students, test=False):
+    # Render many students in one pass over the already compiled templates
+    return [render_report(student, test) for student in students]
+
+
+def report_fingerprint(student):
+    """SHA-256 of the recipient and every value the report shows; equal hashes mean an identical email.
+
+    Scores are hashed in place of the former per-assessment columns, so reports of the original
+    five assessments keep the fingerprints they were sent with. Labels are fixed per term.
+    """
+    values = [student[field] for field in REPORT_FIELDS[:4]] + [score for _, score in student['scores']] + \
+        [student[field] for field in REPORT_FIELDS[4:]]
+    payload = '\x1f'.join('' if value is None else str(value) for value in values)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
@@ -0,0 +1,127 @@
+"""Streaming exports of query results (CSV, gzip CSV, XLSX, Parquet)."""
+import csv
+import io
+import zlib
+
+FETCH_SIZE = 1000
+
+FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'xlsx': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def iter_batches(cursor, size=FETCH_SIZE):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield rows
+
+
+def iter_csv(cursor, columns):
+    # One encoded chunk per fetchmany() batch; nothing is held beyond a batch
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in iter_batches(cursor):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _ChunkSink(io.RawIOBase):
+    # Write-only file object that hands written bytes back to the generator
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ExportError('Parquet export requires the pyarrow package')
+
+
+def iter_parquet(cursor, columns):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(col, pa.string()) for col in columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    # Each fetchmany() batch becomes one row group, flushed to the client as it is written
+    for rows in iter_batches(cursor, FETCH_SIZE * 10):
+        arrays = [pa.array([None if row[i] is None else str(row[i]) for row in rows], pa.string())
+                  for i in range(len(columns))]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+
+def iter_xlsx(cursor, columns):
+    # openpyxl's write-only mode keeps rows out of memory, but can only emit the file once complete
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Email Logs')
+    sheet.append(columns)
+    for rows in iter_batches(cursor):
+        for row in rows:
+            sheet.append(list(row))
+    output = io.BytesIO()
+    workbook.save(output)
+    yield output.getvalue()
+
+
+def stream_export(cursor, columns, fmt='csv', compress=False):
+    """Return ``(chunks, extension, mimetype)`` for ``cursor`` in the requested format."""
+    if fmt not in FORMATS:
+        raise ExportError(f'Unsupported export format: {fmt}')
+    extension, mimetype = FORMATS[fmt]
+
+    if fmt == 'csv':
+        chunks = iter_csv(cursor, columns)
+    elif fmt == 'xlsx':
+        chunks = iter_xlsx(cursor, columns)
+    else:
+        # Fail before the response starts rather than halfway through the body
+        _require_pyarrow()
+        chunks = iter_parquet(cursor, columns)
+
+    if compress:
+        chunks = gzip_stream(chunks)
+        extension += '.gz'
+        mimetype = 'application/gzip'
+    return chunks, extension, mimetype
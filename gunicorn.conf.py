@@ -0,0 +1,24 @@
+"""gunicorn settings: gunicorn -c gunicorn.conf.py wsgi:app
+
+Environment overrides: BIND, WEB_CONCURRENCY (worker processes), WEB_THREADS
+(threads per worker) and WEB_TIMEOUT. Anything else can be passed on the
+command line or in GUNICORN_CMD_ARGS.
+"""
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', min(2 * (os.cpu_count() or 1) + 1, 8)))
+# Threaded workers: every open /api/events stream holds a thread while it waits. Streams are capped
+# per process (EVENTS_MAX_STREAMS, default 4, so keep WEB_THREADS above it) and only stay open while
+# the user has a send in progress
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+# Uploads are imported inside the request
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+
+
+def on_starting(server):
+    # Create or migrate the schema once in the master, before any worker is forked. The workers
+    # inherit the imported app; pandas and NumPy are not part of it, they load on first use
+    from app import create_app
+    create_app(send_workers=False)
@@ -0,0 +1,360 @@
+"""Columnar import of student result spreadsheets into one term.
+
+The columns a file must have come from the term's assessment definitions
+(see terms.py) plus the base columns; each row becomes a ``students`` row
+(an enrollment in the term) and one ``scores`` row per non-empty
+assessment. Two modes: 'replace' deletes the term's students and inserts
+the file, and 'merge' matches rows on (email, class) and only writes new
+and changed students, so student ids (referenced by email_logs) survive a
+re-upload.
+
+pandas is imported by the functions that use it, so the web server starts
+without it and only processes that handle an upload load it.
+"""
+import time
+from itertools import islice
+
+import metrics
+from stats import refresh_term_stats
+from terms import BASE_COLUMNS, DEFAULT_ASSESSMENTS, ensure_classes, get_assessments, get_current_term, \
+    parse_assessments
+
+TEXT_COLUMNS = ['first name', 'last name', 'email', 'class', 'grade', 'comments']
+NOT_NULL_COLUMNS = ['first name', 'last name', 'email']
+# Per-student values besides the key (email, class) and the scores, in students table order
+ROW_COLUMNS = ['first name', 'last name', 'total', 'grade', 'comments']
+
+INSERT_SQL = '''INSERT INTO students
+                (first_name, last_name, total, grade, comments, email, class, class_id, term_id, uploaded_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+UPDATE_SQL = '''UPDATE students
+                SET first_name = ?, last_name = ?, total = ?, grade = ?, comments = ?,
+                    upload_date = CURRENT_TIMESTAMP
+                WHERE id = ?'''
+
+IMPORT_MODES = ('merge', 'replace')
+
+BATCH_SIZE = 5000
+CHUNK_SIZE = 10000
+
+UPLOAD_ROWS = metrics.counter('upload_rows_total', 'Spreadsheet rows imported', ['mode'])
+UPLOAD_SECONDS = metrics.histogram('upload_duration_seconds', 'Time to import one upload, by mode', ['mode'],
+                                   buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+UPLOAD_ROWS_PER_SECOND = metrics.gauge('upload_rows_per_second', 'Import rate of the last upload', ['mode'])
+
+
+def required_columns(assessments):
+    # Lower-cased spreadsheet columns for a term, base columns first
+    return BASE_COLUMNS[:4] + [a['column_name'].lower() for a in assessments] + BASE_COLUMNS[4:]
+
+
+REQUIRED_COLUMNS = required_columns(parse_assessments(DEFAULT_ASSESSMENTS))
+
+
+class ImportValidationError(ValueError):
+    pass
+
+
+def _row_numbers(mask, offset=0, limit=5):
+    # Spreadsheet row numbers (header is row 1) of the first few offending rows
+    rows = [str(i + offset + 2) for i in mask.to_numpy().nonzero()[0][:limit]]
+    more = ' ...' if mask.sum() > limit else ''
+    return ', '.join(rows) + more
+
+
+def column_filter(columns=REQUIRED_COLUMNS):
+    # usecols filter so unrelated spreadsheet columns are never loaded
+    wanted = set(columns)
+    return lambda name: str(name).strip().lower() in wanted
+
+
+def text_dtypes(source, columns=REQUIRED_COLUMNS, excel=False):
+    """``dtype`` for pandas: the file's text columns, under the names the file spells them with, as str.
+
+    Otherwise pandas infers each chunk's types separately, and a numeric class with an empty cell in
+    one chunk reads as float there ('3.0' instead of '3'), which splits the class and changes merge
+    keys and report fingerprints. Reads only the header; a file object is rewound afterwards.
+    """
+    import pandas as pd
+
+    names = (pd.read_excel if excel else pd.read_csv)(source, nrows=0).columns
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    text = set(TEXT_COLUMNS) & set(columns)
+    return {name: str for name in names if str(name).strip().lower() in text}
+
+
+def read_frame(filepath, columns=REQUIRED_COLUMNS):
+    import pandas as pd
+
+    if filepath.endswith('.csv'):
+        return pd.read_csv(filepath, usecols=column_filter(columns), dtype=text_dtypes(filepath, columns))
+    return pd.read_excel(filepath, usecols=column_filter(columns), dtype=text_dtypes(filepath, columns, excel=True))
+
+
+def _iter_xlsx_frames(stream, chunk_size, columns):
+    # openpyxl read-only mode parses the sheet lazily, one row at a time
+    import pandas as pd
+    from openpyxl import load_workbook
+
+    wanted = column_filter(columns)
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, ())
+        keep = [i for i, name in enumerate(header) if name is not None and wanted(name)]
+        names = [header[i] for i in keep]
+        check_columns(names, columns)
+        # Text cells as str, like the CSV path: a chunk's column type must not depend on its other cells
+        text = [str(name).strip().lower() in TEXT_COLUMNS for name in names]
+
+        def value(row, i, is_text):
+            cell = row[i] if i < len(row) else None
+            return str(cell) if is_text and cell is not None else cell
+
+        yielded = False
+        while True:
+            chunk = [[value(row, i, is_text) for i, is_text in zip(keep, text)] for row in islice(rows, chunk_size)]
+            chunk = [row for row in chunk if any(value is not None for value in row)]
+            if not chunk:
+                break
+            yielded = True
+            yield pd.DataFrame(chunk, columns=names)
+        if not yielded:
+            yield pd.DataFrame(columns=names)
+    finally:
+        workbook.close()
+
+
+def iter_frames(stream, filename, chunk_size=CHUNK_SIZE, columns=REQUIRED_COLUMNS):
+    """Yield the upload as DataFrames of at most ``chunk_size`` rows.
+
+    Reads directly from the uploaded file object, so memory stays bounded by
+    the chunk size rather than the file size. Legacy .xls files cannot be
+    streamed and are read whole. ``columns`` are the term's required columns
+    (see required_columns()); anything else in the file is skipped.
+    """
+    import pandas as pd
+
+    if filename.endswith('.csv'):
+        yield from pd.read_csv(stream, usecols=column_filter(columns), chunksize=chunk_size,
+                               dtype=text_dtypes(stream, columns))
+    elif filename.endswith('.xlsx'):
+        yield from _iter_xlsx_frames(stream, chunk_size, columns)
+    else:
+        yield pd.read_excel(stream, usecols=column_filter(columns), dtype=text_dtypes(stream, columns, excel=True))
+
+
+def check_columns(present, columns=REQUIRED_COLUMNS):
+    present = {str(col).strip().lower() for col in present}
+    missing_columns = [col for col in columns if col not in present]
+    if missing_columns:
+        raise ImportValidationError(f'Missing columns: {", ".join(missing_columns)}')
+
+
+def normalize_frame(df, offset=0, assessments=None):
+    """Validate and clean a frame in place against a term's ``assessments``.
+
+    ``offset`` is the number of data rows before this frame, for error messages.
+    """
+    import pandas as pd
+
+    assessments = assessments or parse_assessments(DEFAULT_ASSESSMENTS)
+    check_columns(df.columns, required_columns(assessments))
+    df.columns = [str(col).strip().lower() for col in df.columns]
+
+    for col in TEXT_COLUMNS:
+        values = df[col]
+        df[col] = values.astype(str).str.strip().where(values.notna(), None)
+
+    for col in NOT_NULL_COLUMNS:
+        empty = df[col].isna() | (df[col] == '')
+        if empty.any():
+            raise ImportValidationError(f'Empty "{col}" in rows {_row_numbers(empty, offset)}')
+
+    bad_email = ~df['email'].str.contains('@', regex=False, na=False)
+    if bad_email.any():
+        raise ImportValidationError(f'Invalid email in rows {_row_numbers(bad_email, offset)}')
+
+    for col in ['total'] + [a['column_name'].lower() for a in assessments]:
+        values = pd.to_numeric(df[col], errors='coerce')
+        bad = values.isna() & df[col].notna()
+        if bad.any():
+            raise ImportValidationError(f'Non-numeric "{col}" in rows {_row_numbers(bad, offset)}')
+        df[col] = values.astype('float64')
+
+    return df
+
+
+def _values(column):
+    # Plain Python values with None for missing ones. tolist() converts in C; iterating a
+    # pandas column boxes every value in Python.
+    return column.astype(object).where(column.notna(), None).tolist()
+
+
+def _init_import_keys(c):
+    # Keys seen in this upload, and the keys of the chunk being written; temp tables, so they
+    # stay in memory and private to the connection
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS import_keys
+                 (email TEXT NOT NULL, class TEXT NOT NULL, row INTEGER,
+                  PRIMARY KEY (email, class)) WITHOUT ROWID''')
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS import_chunk
+                 (email TEXT NOT NULL, class TEXT NOT NULL,
+                  PRIMARY KEY (email, class)) WITHOUT ROWID''')
+    c.execute("DELETE FROM temp.import_keys")
+    c.execute("DELETE FROM temp.import_chunk")
+
+
+def record_keys(c, df, offset=0):
+    """Remember the (email, class) keys of a frame; rejects a student listed twice in the upload."""
+    import pandas as pd
+
+    classes = df['class'].fillna('')
+    duplicated = pd.DataFrame({'email': df['email'], 'class': classes}).duplicated()
+    if duplicated.any():
+        raise ImportValidationError(f'Duplicate email and class in rows {_row_numbers(duplicated, offset)}')
+
+    keys = list(zip(df['email'].tolist(), classes.tolist(), range(offset + 2, offset + 2 + len(df))))
+    c.executemany("INSERT OR IGNORE INTO temp.import_keys (email, class, row) VALUES (?, ?, ?)", keys)
+    if c.rowcount < len(keys):
+        # Listed again after an earlier chunk; report the offending rows
+        rows = [str(row) for email, cls, row in keys
+                if c.execute("SELECT row FROM temp.import_keys WHERE email = ? AND class = ?",
+                             (email, cls)).fetchone()[0] != row]
+        raise ImportValidationError(f'Duplicate email and class in rows {", ".join(rows[:5])}')
+
+
+def _chunk_students(c, term_id, keys):
+    """Existing students of the term for these keys: ``{key: (id, row values, scores by assessment id)}``.
+
+    Two joins against the chunk's keys through idx_students_term_email_class
+    and the scores primary key; nothing outside the chunk is read.
+    """
+    c.execute("DELETE FROM temp.import_chunk")
+    c.executemany("INSERT INTO temp.import_chunk (email, class) VALUES (?, ?)", keys)
+    join = '''FROM temp.import_chunk k JOIN students s
+                ON s.term_id = ? AND s.email = k.email AND IFNULL(s.class, '') = k.class'''
+    students = {(row[1], row[2]): (row[0], tuple(row[3:]), {}) for row in c.execute(
+        f"SELECT s.id, k.email, k.class, s.first_name, s.last_name, s.total, s.grade, s.comments {join}",
+        (term_id,))}
+    by_id = {student[0]: student[2] for student in students.values()}
+    for student_id, assessment_id, score in c.execute(
+            f"SELECT s.id, sc.assessment_id, sc.score {join} JOIN scores sc ON sc.student_id = s.id", (term_id,)):
+        by_id[student_id][assessment_id] = score
+    return students
+
+
+def write_frame(c, df, term_id, user_id, assessments, merge=True, batch_size=BATCH_SIZE):
+    """Write one validated frame into the term; returns ``(added, changed)``.
+
+    With ``merge`` rows are compared with what is stored (one read per
+    chunk) and only new and changed students are written; a changed
+    student's scores are replaced as a set. Without it every row is new.
+    """
+    classes = _values(df['class'])
+    class_ids = ensure_classes(c, term_id, classes)
+    keys = list(zip(df['email'].tolist(), [cls or '' for cls in classes]))
+    rows = list(zip(*(_values(df[col]) for col in ROW_COLUMNS)))
+    assessment_ids = [a['id'] for a in assessments]
+    scores = list(zip(*(_values(df[a['column_name'].lower()]) for a in assessments)))
+
+    existing = _chunk_students(c, term_id, keys) if merge else {}
+    new, updates, rescored = [], [], []
+    for key, cls, row, student_scores in zip(keys, classes, rows, scores):
+        student_scores = {aid: score for aid, score in zip(assessment_ids, student_scores) if score is not None}
+        found = existing.get(key)
+        if found is None:
+            new.append((key, row + (key[0], cls, class_ids.get(cls), term_id, user_id), student_scores))
+            continue
+        student_id, stored_row, stored_scores = found
+        if stored_row != row or stored_scores != student_scores:
+            updates.append(row + (student_id,))
+        if stored_scores != student_scores:
+            rescored.append((student_id, student_scores))
+
+    for start in range(0, len(new), batch_size):
+        c.executemany(INSERT_SQL, [student for _, student, _ in new[start:start + batch_size]])
+    c.executemany(UPDATE_SQL, updates)
+    c.executemany("DELETE FROM scores WHERE student_id = ?", [(student_id,) for student_id, _ in rescored])
+    if new:
+        ids = {key: student[0] for key, student in _chunk_students(c, term_id, [key for key, _, _ in new]).items()}
+        rescored.extend((ids[key], student_scores) for key, _, student_scores in new)
+    c.executemany("INSERT INTO scores (student_id, assessment_id, score) VALUES (?, ?, ?)",
+                  [(student_id, aid, score) for student_id, student_scores in rescored
+                   for aid, score in student_scores.items()])
+    return len(new), len(updates)
+
+
+def import_students(conn, frames, user_id, mode='replace', term_id=None):
+    """Load the rows in ``frames`` as the students of one term in one transaction.
+
+    ``frames`` is an iterable of DataFrames (a single whole-file frame, or
+    chunks from iter_frames) read with the term's required columns.
+    ``term_id`` defaults to the user's current term. Each chunk is
+    validated against the term's assessments and written as it arrives; any
+    invalid chunk rolls back the whole import. In 'replace' mode the term's
+    students are deleted and the file inserted; in 'merge' mode only new
+    and changed rows are written and rows missing from the file are
+    deleted, so the database work scales with the changes.
+
+    Returns ``(count, rows_per_second, summary)`` where ``summary`` counts
+    the rows ``added``, ``changed``, ``removed`` and ``unchanged``.
+    """
+    if mode not in IMPORT_MODES:
+        raise ImportValidationError(f'Unknown import mode: {mode}')
+
+    start = time.perf_counter()
+    count = added = changed = 0
+
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN")
+        if term_id is None:
+            term_id = get_current_term(c, user_id)['id']
+        assessments = get_assessments(c, term_id)
+        _init_import_keys(c)
+        # Students of the term that are not in the file
+        missing = '''SELECT id FROM students WHERE term_id = ? AND NOT EXISTS
+                         (SELECT 1 FROM temp.import_keys k
+                          WHERE k.email = students.email AND k.class = IFNULL(students.class, ''))'''
+        if mode == 'replace':
+            # Clear the term's existing students (the key table is still empty, so that is all of them)
+            c.execute(f"DELETE FROM scores WHERE student_id IN ({missing})", (term_id,))
+            c.execute("DELETE FROM students WHERE term_id = ?", (term_id,))
+            removed = c.rowcount
+
+        for df in frames:
+            df = normalize_frame(df, offset=count, assessments=assessments)
+            record_keys(c, df, offset=count)
+            chunk_added, chunk_changed = write_frame(c, df, term_id, user_id, assessments, mode == 'merge')
+            added += chunk_added
+            changed += chunk_changed
+            count += len(df)
+
+        if mode == 'merge':
+            c.execute(f"DELETE FROM scores WHERE student_id IN ({missing})", (term_id,))
+            c.execute(f"DELETE FROM students WHERE id IN ({missing})", (term_id,))
+            removed = c.rowcount
+        summary = {'added': added, 'changed': changed, 'removed': removed,
+                   'unchanged': count - added - changed}
+
+        c.execute("DELETE FROM temp.import_keys")
+        c.execute("DELETE FROM temp.import_chunk")
+        if added or changed or removed:
+            c.execute('''DELETE FROM classes WHERE term_id = ? AND NOT EXISTS
+                             (SELECT 1 FROM students s WHERE s.term_id = classes.term_id AND s.class = classes.name)''',
+                      (term_id,))
+            refresh_term_stats(c, term_id)
+            # Cached analytics of the term are stale from now on
+            c.execute("UPDATE terms SET data_version = data_version + 1 WHERE id = ?", (term_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    elapsed = time.perf_counter() - start
+    rows_per_second = round(count / elapsed) if elapsed > 0 else count
+    UPLOAD_ROWS.inc(mode, amount=count)
+    UPLOAD_SECONDS.observe(elapsed, mode)
+    UPLOAD_ROWS_PER_SECOND.set(rows_per_second, mode)
+    return count, rows_per_second, summary
@@ -0,0 +1,446 @@
+"""Background dispatch queue for bulk email sends, persisted in SQLite."""
+import queue
+import threading
+import time
+
+import metrics
+import stats
+from dal import LogBuffer, chunked, sent_fingerprints
+from db import close_connection, get_connection
+from retry import retry_delay
+
+OUTCOMES = metrics.counter('send_outcomes_total', 'Recipients processed by the send workers, by outcome',
+                           ['status'])
+
+
+def init_job_tables(c):
+    # One row per /api/send-emails request
+    c.execute('''CREATE TABLE IF NOT EXISTS send_jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  created_by INTEGER,
+                  status TEXT DEFAULT 'pending',
+                  total INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  finished_at TIMESTAMP,
+                  FOREIGN KEY (created_by) REFERENCES users (id))''')
+
+    # One row per recipient; status is pending -> running -> success/failed, or -> retry -> pending
+    # when a transient failure is scheduled again (attempts/next_attempt_at are added by migration)
+    c.execute('''CREATE TABLE IF NOT EXISTS send_job_items
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  job_id INTEGER NOT NULL,
+                  student_id INTEGER,
+                  status TEXT DEFAULT 'pending',
+                  error_message TEXT,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (job_id) REFERENCES send_jobs (id))''')
+
+
+class JobQueue:
+    """Persists send jobs and drains their items with a pool of worker threads.
+
+    Workers take items off the queue in batches. ``handler(items, record)``
+    does the actual delivery for one batch on a worker thread; it must call
+    ``record(item, status, error_message, student, transient, fingerprint, sender)``
+    once per item, and those outcomes are written in small buffered
+    transactions. Items of a job submitted with ``sharded`` may be sent
+    from any of the user's sender accounts. Items whose ``fingerprint`` is set asked for deduplication;
+    the handler may record them as 'skipped'.
+
+    A transient failure is retried up to ``max_attempts`` attempts in all,
+    with exponential backoff starting at ``retry_delay`` seconds. Waiting
+    items stay in SQLite as 'retry' and a scheduler thread re-queues them
+    when due, so retries survive restarts.
+
+    With an ``events`` broker, every outcome is published as a 'progress'
+    event once it is committed, and each job touched by a batch as a
+    'job' event (the same counts as ``get()``) when the batch is done.
+
+    When several server processes share the database, ``start_elected()``
+    runs the workers in only one of them. The others only write jobs to
+    SQLite, and the worker process polls for pending items it has not
+    queued. ``on_start`` is called in the worker process just before its
+    workers start.
+    """
+
+    def __init__(self, db_path, handler, workers=4, batch_size=50, max_attempts=5, retry_delay=60,
+                 max_retry_delay=3600, poll_interval=1.0, events=None, on_start=None):
+        self.db_path = db_path
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.events = events
+        self.on_start = on_start
+        self._queue = queue.Queue()
+        # Ids waiting in _queue, so polling SQLite never queues an item twice
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        self._threads = []
+        self._lock = threading.Lock()
+        # True while another process may hold the send lock (see start_elected())
+        self._standby = False
+
+    def _connect(self):
+        # Each worker thread reuses its own connection
+        return get_connection(self.db_path)
+
+    def _rollback(self):
+        # After a failed step. A connection that cannot even roll back is dropped, so the thread's next
+        # step opens a new one instead of the thread dying here
+        try:
+            self._connect().rollback()
+        except Exception as e:
+            print(f"Rollback failed, reconnecting: {e}")
+            try:
+                close_connection(self.db_path)
+            except Exception:
+                pass
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            if self.on_start is not None:
+                self.on_start()
+            self._resume()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f'send-worker-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            t = threading.Thread(target=self._scheduler, name='send-retry-scheduler', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def start_elected(self, lock_path):
+        """Start the workers in whichever process holds an exclusive lock on ``lock_path``.
+
+        Every server process calls this. The others wait for the lock in a
+        thread and take over when the worker process exits; the lock is
+        released with the process. Without ``fcntl`` (Windows, where servers
+        run one process) the workers just start.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            self.start()
+            return
+        self._standby = True
+
+        def elect():
+            # Kept open (closing it would release the lock) until this process exits
+            self._lock_file = open(lock_path, 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._standby = False
+            self.start()
+
+        threading.Thread(target=elect, name='send-election', daemon=True).start()
+
+    def _enqueue(self, item_ids):
+        with self._queued_lock:
+            item_ids = [item_id for item_id in item_ids if item_id not in self._queued]
+            self._queued.update(item_ids)
+        for item_id in item_ids:
+            self._queue.put(item_id)
+
+    def _resume(self):
+        # Items left running by a crashed process go back to pending
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute("UPDATE send_job_items SET status = 'pending' WHERE status = 'running'")
+        pending = c.execute("SELECT id FROM send_job_items WHERE status = 'pending' ORDER BY id").fetchall()
+        conn.commit()
+
+        self._enqueue([row['id'] for row in pending])
+
+    def _scheduler(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self._release_due()
+                self._pick_up_pending()
+            except Exception as e:
+                self._rollback()
+                print(f"Retry scheduler error: {e}")
+
+    def _release_due(self):
+        # Move retries whose backoff has expired back to pending and queue them
+        conn = self._connect()
+        c = conn.cursor()
+        due = [row['id'] for row in c.execute('''SELECT id FROM send_job_items
+                                                WHERE status = 'retry' AND next_attempt_at <= datetime('now')
+                                                ORDER BY next_attempt_at LIMIT 1000''')]
+        released = []
+        for item_id in due:
+            c.execute("UPDATE send_job_items SET status = 'pending' WHERE id = ? AND status = 'retry'", (item_id,))
+            if c.rowcount:
+                released.append(item_id)
+        conn.commit()
+
+        self._enqueue(released)
+
+    def _pick_up_pending(self):
+        # Items submitted by other server processes are only in SQLite; fetched while the queue runs low
+        if self._queue.qsize() >= self.batch_size * self.workers:
+            return
+        pending = self._connect().execute(
+            "SELECT id FROM send_job_items WHERE status = 'pending' ORDER BY id LIMIT 1000")
+        self._enqueue([row['id'] for row in pending])
+
+    def _active_fingerprints(self, c, user_id, fingerprints):
+        # Reports already waiting in one of this user's jobs (e.g. a double-clicked "Send")
+        active = set()
+        for chunk in chunked(list(set(fingerprints))):
+            placeholders = ', '.join('?' for _ in chunk)
+            active.update(row[0] for row in c.execute(
+                f'''SELECT i.fingerprint FROM send_job_items i JOIN send_jobs j ON j.id = i.job_id
+                     WHERE i.fingerprint IN ({placeholders}) AND j.created_by = ?
+                     AND i.status IN ('pending', 'running', 'retry')''', [*chunk, user_id]))
+        return active
+
+    def submit(self, user_id, student_ids, fingerprints=None, sharded=False):
+        """Queue a send; returns ``(job_id, queued, skipped)``.
+
+        With ``fingerprints`` (student id -> report fingerprint), students whose
+        current report was already delivered or is already queued are skipped.
+        Without it every student is sent, even unchanged. ``job_id`` is None
+        when nothing needed sending. A ``sharded`` job is spread over all of
+        the user's sender accounts.
+        """
+        conn = self._connect()
+        c = conn.cursor()
+        # One submit at a time, so two concurrent clicks can't both queue the same report
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            rows = [(student_id, None) for student_id in student_ids]
+            skipped = 0
+            if fingerprints is not None:
+                known = (sent_fingerprints(c, user_id, fingerprints.values()) |
+                         self._active_fingerprints(c, user_id, fingerprints.values()))
+                rows = []
+                for student_id in student_ids:
+                    fingerprint = fingerprints.get(student_id)
+                    if fingerprint in known:
+                        skipped += 1
+                        continue
+                    if fingerprint is not None:
+                        known.add(fingerprint)
+                    rows.append((student_id, fingerprint))
+
+            if not rows:
+                conn.commit()
+                return None, 0, skipped
+
+            c.execute("INSERT INTO send_jobs (created_by, status, total, sharded) VALUES (?, 'pending', ?, ?)",
+                      (user_id, len(rows), int(sharded)))
+            job_id = c.lastrowid
+            c.executemany("INSERT INTO send_job_items (job_id, student_id, fingerprint) VALUES (?, ?, ?)",
+                          [(job_id, student_id, fingerprint) for student_id, fingerprint in rows])
+            item_ids = [row['id'] for row in c.execute(
+                "SELECT id FROM send_job_items WHERE job_id = ? ORDER BY id", (job_id,))]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        if not self._standby:
+            self.start()
+            self._enqueue(item_ids)
+        return job_id, len(rows), skipped
+
+    def retry_failed(self, job_id, user_id):
+        """Re-drive a job: failed and scheduled items go back to pending now. Returns the count."""
+        conn = self._connect()
+        c = conn.cursor()
+        if not c.execute("SELECT 1 FROM send_jobs WHERE id = ? AND created_by = ?", (job_id, user_id)).fetchone():
+            return None
+
+        # Items that already have a successful attempt logged are never sent again
+        item_ids = [row['id'] for row in c.execute('''SELECT id FROM send_job_items i
+                                                     WHERE job_id = ? AND status IN ('failed', 'retry')
+                                                     AND NOT EXISTS (SELECT 1 FROM email_logs l
+                                                                     WHERE l.job_item_id = i.id
+                                                                     AND l.status = 'success')
+                                                     ORDER BY id''', (job_id,))]
+        requeued = []
+        for item_id in item_ids:
+            c.execute('''UPDATE send_job_items SET status = 'pending', next_attempt_at = NULL,
+                                                      updated_at = CURRENT_TIMESTAMP
+                         WHERE id = ? AND status IN ('failed', 'retry')''', (item_id,))
+            if c.rowcount:
+                requeued.append(item_id)
+        # Their failed attempts are no longer final: relabel them and take them out of the stats
+        relabelled = 0
+        for chunk in chunked(requeued):
+            placeholders = ', '.join('?' for _ in chunk)
+            c.execute(f"UPDATE email_logs SET status = 'retried' "
+                      f"WHERE job_item_id IN ({placeholders}) AND status = 'failed'", chunk)
+            relabelled += c.rowcount
+        if relabelled:
+            stats.record_email(c, user_id, 'failed', -relabelled)
+        if requeued:
+            c.execute("UPDATE send_jobs SET status = 'pending', finished_at = NULL WHERE id = ?", (job_id,))
+        conn.commit()
+
+        if not self._standby:
+            self.start()
+            self._enqueue(requeued)
+        return len(requeued)
+
+    def depth(self):
+        """Items queued in memory for the workers, not counting scheduled retries."""
+        return self._queue.qsize()
+
+    def has_active_job(self, user_id):
+        """Whether any of the user's jobs has items waiting to be sent now (backed-off retries don't count)."""
+        return self._connect().execute('''SELECT 1 FROM send_jobs j JOIN send_job_items i ON i.job_id = j.id
+                                          WHERE j.created_by = ? AND j.status != 'completed'
+                                            AND i.status IN ('pending', 'running') LIMIT 1''',
+                                       (user_id,)).fetchone() is not None
+
+    def latest_job_id(self, user_id):
+        row = self._connect().execute("SELECT MAX(id) FROM send_jobs WHERE created_by = ?", (user_id,)).fetchone()
+        return row[0]
+
+    def _progress(self, c, job):
+        counts = {row['status']: row['count'] for row in c.execute(
+            "SELECT status, COUNT(*) as count FROM send_job_items WHERE job_id = ? GROUP BY status",
+            (job['id'],))}
+        return {
+            'id': job['id'],
+            'status': job['status'],
+            'total': job['total'],
+            'sent': counts.get('success', 0),
+            'failed': counts.get('failed', 0),
+            'pending': counts.get('pending', 0) + counts.get('running', 0) + counts.get('retry', 0),
+            'retrying': counts.get('retry', 0),
+            'skipped': counts.get('skipped', 0),
+            'created_at': job['created_at'],
+            'finished_at': job['finished_at'],
+        }
+
+    def get(self, job_id, user_id, failures=True):
+        conn = self._connect()
+        c = conn.cursor()
+        job = c.execute("SELECT * FROM send_jobs WHERE id = ? AND created_by = ?",
+                        (job_id, user_id)).fetchone()
+        if not job:
+            return None
+
+        progress = self._progress(c, job)
+        if failures:
+            progress['failures'] = [dict(row) for row in c.execute('''SELECT student_id, error_message
+                                                                     FROM send_job_items
+                                                                     WHERE job_id = ? AND status = 'failed'
+                                                                     ORDER BY id LIMIT 50''', (job_id,))]
+        return progress
+
+    def _next_batch(self):
+        item_ids = [self._queue.get()]
+        # Share what is queued between the workers instead of one worker taking it all
+        limit = max(1, min(self.batch_size, self._queue.qsize() // self.workers + 1))
+        while len(item_ids) < limit:
+            try:
+                item_ids.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        with self._queued_lock:
+            self._queued.difference_update(item_ids)
+        return item_ids
+
+    def _worker(self):
+        while True:
+            item_ids = self._next_batch()
+            try:
+                self._process(item_ids)
+            except Exception as e:
+                self._rollback()
+                print(f"Send worker error on items {item_ids[0]}..{item_ids[-1]}: {e}")
+            finally:
+                for _ in item_ids:
+                    self._queue.task_done()
+
+    def _claim(self, item_ids):
+        # Claim the items; another worker or process may already have some of them
+        conn = self._connect()
+        c = conn.cursor()
+        claimed = []
+        for item_id in item_ids:
+            c.execute("UPDATE send_job_items SET status = 'running', attempts = attempts + 1, "
+                      "updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'pending'", (item_id,))
+            if c.rowcount:
+                claimed.append(item_id)
+
+        items = []
+        for chunk in chunked(claimed):
+            placeholders = ', '.join('?' for _ in chunk)
+            items.extend(c.execute(f'''SELECT i.id as item_id, i.job_id, i.student_id, i.attempts, i.fingerprint,
+                                              j.created_by, j.sharded
+                                         FROM send_job_items i JOIN send_jobs j ON j.id = i.job_id
+                                         WHERE i.id IN ({placeholders})''', chunk).fetchall())
+        job_ids = sorted({item['job_id'] for item in items})
+        c.executemany("UPDATE send_jobs SET status = 'running' WHERE id = ? AND status = 'pending'",
+                      [(job_id,) for job_id in job_ids])
+        conn.commit()
+        return items, job_ids
+
+    def _process(self, item_ids):
+        conn = self._connect()
+        items, job_ids = self._claim(item_ids)
+        if not items:
+            return
+
+        recorded = set()
+        outcomes = []
+
+        def publish_outcomes():
+            self.events.publish(outcomes)
+            outcomes.clear()
+
+        buffer = LogBuffer(conn, on_flush=publish_outcomes if self.events is not None else None)
+
+        def record(item, status, error_msg=None, student=None, transient=False, fingerprint=None, sender=None):
+            recorded.add(item['item_id'])
+            retry_in = None
+            if status == 'failed' and transient and item['attempts'] < self.max_attempts:
+                retry_in = retry_delay(item['attempts'], self.retry_delay, self.max_retry_delay)
+            if self.events is not None:
+                # Published by the flush that commits it, so watchers never see an unlogged outcome
+                outcomes.append((item['created_by'], item['job_id'], 'progress', {
+                    'job_id': item['job_id'],
+                    'student_id': item['student_id'],
+                    'student_name': f"{student['first_name']} {student['last_name']}" if student else None,
+                    'student_email': student['email'] if student else None,
+                    'status': 'retried' if retry_in is not None else status,
+                    'error_message': error_msg,
+                    'attempt': item['attempts'],
+                }))
+            OUTCOMES.inc('retried' if retry_in is not None else status)
+            buffer.add(item['item_id'], item['created_by'], student, status, error_msg,
+                       attempt=item['attempts'], retry_in=retry_in, fingerprint=fingerprint, sender=sender)
+
+        try:
+            self.handler(items, record)
+        except Exception as e:
+            # Never leave claimed items running; fail whatever the handler did not get to
+            error_msg = f"{type(e).__name__}: {str(e)}"
+            print(f"Send handler error: {error_msg}")
+            for item in items:
+                if item['item_id'] not in recorded:
+                    record(item, 'failed', error_msg)
+        buffer.flush()
+
+        c = conn.cursor()
+        c.executemany('''UPDATE send_jobs SET status = 'completed', finished_at = CURRENT_TIMESTAMP
+                         WHERE id = ? AND NOT EXISTS
+                             (SELECT 1 FROM send_job_items
+                              WHERE job_id = ? AND status IN ('pending', 'running', 'retry'))''',
+                      [(job_id, job_id) for job_id in job_ids])
+        conn.commit()
+
+        if self.events is not None:
+            jobs = [c.execute("SELECT * FROM send_jobs WHERE id = ?", (job_id,)).fetchone() for job_id in job_ids]
+            self.events.publish([(job['created_by'], job['id'], 'job', self._progress(c, job)) for job in jobs])
@@ -0,0 +1,226 @@
+"""Per-user sender accounts and a registry of their mail transports.
+
+Each user stores one or more SMTP accounts in ``mail_accounts``, with the
+password encrypted (see credentials.py). The primary account sends the
+user's reports. A sharded job spreads its recipients over all of the
+user's accounts, so a single mailbox's rate limit and daily quota no longer
+cap a large send. Users without an account send through the app-wide
+MAIL_* settings, as before.
+
+``MailerRegistry`` lives in the process that runs the send workers. It
+keeps one ``Mailer`` per account: a pool of SMTP connections, its own
+``SendThrottle`` and, with SEND_ENGINE=async, its own engine. A mailer is
+reused until the account's ``version`` changes. It is then rebuilt, and the
+old one is closed.
+"""
+import threading
+
+from flask_mail import Connection, _Mail
+
+from async_sender import AsyncSendEngine
+from dal import count_recent_sends
+from ratelimit import SendThrottle
+from smtp_pool import SMTPPool
+
+ACCOUNT_FIELDS = ['id', 'email', 'server', 'port', 'use_tls', 'is_primary', 'updated_at']
+
+
+class MailAccountError(ValueError):
+    pass
+
+
+def init_mail_account_table(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS mail_accounts
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  email TEXT NOT NULL,
+                  password BLOB NOT NULL,
+                  server TEXT NOT NULL,
+                  port INTEGER NOT NULL,
+                  use_tls INTEGER NOT NULL DEFAULT 1,
+                  is_primary INTEGER NOT NULL DEFAULT 0,
+                  version INTEGER NOT NULL DEFAULT 0,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  UNIQUE (user_id, email),
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+
+
+def list_accounts(c, user_id):
+    """The user's accounts without their passwords, primary first."""
+    rows = c.execute(f"SELECT {', '.join(ACCOUNT_FIELDS)} FROM mail_accounts WHERE user_id = ? "
+                     "ORDER BY is_primary DESC, id", (user_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def save_account(c, cipher, user_id, email, password, server, port, use_tls=True, primary=False):
+    """Add an account, or update the user's account with this address. Returns its id.
+
+    With ``primary`` it becomes the user's primary account, and the previous
+    primary one stays as an additional account. The first account a user
+    adds is always the primary one.
+    """
+    email = str(email or '').strip()
+    if not email or not password:
+        raise MailAccountError('Email and password are required')
+    try:
+        port = int(port)
+    except (TypeError, ValueError):
+        raise MailAccountError('Invalid port')
+
+    c.execute('''INSERT INTO mail_accounts (user_id, email, password, server, port, use_tls)
+                 VALUES (?, ?, ?, ?, ?, ?)
+                 ON CONFLICT (user_id, email) DO UPDATE SET
+                     password = excluded.password, server = excluded.server, port = excluded.port,
+                     use_tls = excluded.use_tls, version = version + 1, updated_at = CURRENT_TIMESTAMP''',
+              (user_id, email, cipher.encrypt(password), server, port, int(bool(use_tls))))
+    account_id = c.execute("SELECT id FROM mail_accounts WHERE user_id = ? AND email = ?",
+                           (user_id, email)).fetchone()[0]
+    has_primary = c.execute("SELECT 1 FROM mail_accounts WHERE user_id = ? AND is_primary = 1",
+                            (user_id,)).fetchone()
+    if primary or not has_primary:
+        c.execute("UPDATE mail_accounts SET is_primary = (id = ?) WHERE user_id = ?", (account_id, user_id))
+    return account_id
+
+
+def delete_account(c, user_id, account_id):
+    """Remove an account; the oldest remaining one becomes primary. Returns False if there was none."""
+    row = c.execute("SELECT is_primary FROM mail_accounts WHERE id = ? AND user_id = ?",
+                    (account_id, user_id)).fetchone()
+    if row is None:
+        return False
+    c.execute("DELETE FROM mail_accounts WHERE id = ?", (account_id,))
+    if row['is_primary']:
+        c.execute('''UPDATE mail_accounts SET is_primary = 1
+                     WHERE id = (SELECT MIN(id) FROM mail_accounts WHERE user_id = ?)''', (user_id,))
+    return True
+
+
+def account_config(config, account, password):
+    # The app's mail settings with this account's server and login
+    return dict(config, MAIL_SERVER=account['server'], MAIL_PORT=account['port'],
+                MAIL_USE_TLS=bool(account['use_tls']), MAIL_USE_SSL=False, MAIL_USERNAME=account['email'],
+                MAIL_PASSWORD=password, MAIL_DEFAULT_SENDER=account['email'])
+
+
+class AccountMail(_Mail):
+    """Flask-Mail settings for one account, for ``SMTPPool``."""
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['MAIL_SERVER'], config['MAIL_USERNAME'], config['MAIL_PASSWORD'], config['MAIL_PORT'],
+                   config['MAIL_USE_TLS'], config['MAIL_USE_SSL'], config['MAIL_DEFAULT_SENDER'],
+                   int(config.get('MAIL_DEBUG', False)), config.get('MAIL_MAX_EMAILS'),
+                   config.get('MAIL_SUPPRESS_SEND', False), config.get('MAIL_ASCII_ATTACHMENTS', False))
+
+    def connect(self):
+        # Flask-Mail's own connect() always uses the app's settings (app.extensions['mail'])
+        return Connection(self)
+
+
+class Mailer:
+    """Sends as one account: pooled connections, that account's rate limits and, on demand, an async engine."""
+
+    def __init__(self, sender, pool, throttle, engine_factory, account_id=None, user_id=None, version=None):
+        self.sender = sender
+        self.pool = pool
+        self.throttle = throttle
+        self.account_id = account_id
+        self.user_id = user_id
+        self.version = version
+        self.picked = 0
+        self._engine_factory = engine_factory
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def send(self, msg):
+        self.throttle.send(self.pool.send, msg)
+
+    def engine(self):
+        with self._lock:
+            if self._engine is None:
+                self._engine = self._engine_factory(self.throttle)
+            return self._engine
+
+    def close(self):
+        # Batches in flight finish first (see AsyncSendEngine.close)
+        self.pool.reset()
+        with self._lock:
+            engine, self._engine = self._engine, None
+        if engine is not None:
+            engine.close()
+
+
+class MailerRegistry:
+    """One ``Mailer`` per sender account, built on first use and rebuilt when the account changes.
+
+    ``default`` sends for users without an account. ``cipher`` is called to
+    get the ``CredentialCipher`` when a password has to be decrypted.
+    """
+
+    def __init__(self, config, default, cipher):
+        self.config = config
+        self.default = default
+        self._cipher = cipher
+        self._mailers = {}
+        self._lock = threading.Lock()
+
+    def _build(self, c, account):
+        config = account_config(self.config, account, self._cipher().decrypt(account['password']))
+        throttle = SendThrottle.from_config(config)
+        # Messages this account sent before a restart still count against today's quota
+        throttle.consume_daily(count_recent_sends(c, account['email']))
+        return Mailer(account['email'], SMTPPool(AccountMail.from_config(config), size=config['SMTP_POOL_SIZE']),
+                      throttle, lambda throttle: AsyncSendEngine.from_config(config, throttle=throttle),
+                      account_id=account['id'], user_id=account['user_id'], version=account['version'])
+
+    def for_user(self, c, user_id):
+        """The user's mailers, primary first; ``[default]`` when the user has no account."""
+        rows = c.execute("SELECT id, version FROM mail_accounts WHERE user_id = ? ORDER BY is_primary DESC, id",
+                         (user_id,)).fetchall()
+        if not rows:
+            return [self.default]
+
+        stale = []
+        mailers = []
+        with self._lock:
+            current = {row['id'] for row in rows}
+            for account_id, mailer in list(self._mailers.items()):
+                if mailer.user_id == user_id and account_id not in current:
+                    stale.append(self._mailers.pop(account_id))
+            for row in rows:
+                mailer = self._mailers.get(row['id'])
+                if mailer is None or mailer.version != row['version']:
+                    if mailer is not None:
+                        stale.append(mailer)
+                    account = c.execute("SELECT * FROM mail_accounts WHERE id = ?", (row['id'],)).fetchone()
+                    mailer = self._mailers[row['id']] = self._build(c, account)
+                mailers.append(mailer)
+        for mailer in stale:
+            # Don't hold up the send for batches still going out through the old settings
+            threading.Thread(target=mailer.close, daemon=True).start()
+        return mailers
+
+    @staticmethod
+    def pick(mailers):
+        """The mailer that can send soonest; among those free now, the one picked least."""
+        if len(mailers) == 1:
+            return mailers[0]
+        mailer = min(mailers, key=lambda mailer: (mailer.throttle.available_in(), mailer.picked))
+        mailer.picked += 1
+        return mailer
+
+    def status(self, user_id):
+        """Rate limits of the user's accounts that have sent from this process, combined."""
+        with self._lock:
+            mailers = [mailer for mailer in self._mailers.values() if mailer.user_id == user_id]
+        statuses = [mailer.throttle.status() for mailer in mailers or [self.default]]
+        if len(statuses) == 1:
+            return statuses[0]
+        status = {
+            'rate_per_second': round(sum(s['rate_per_second'] for s in statuses), 3),
+            'paused_for': min(s['paused_for'] for s in statuses),
+            'accounts': len(statuses),
+        }
+        if all('daily_remaining' in s for s in statuses):
+            status['daily_remaining'] = sum(s['daily_remaining'] for s in statuses)
+        return status
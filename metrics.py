@@ -0,0 +1,240 @@
+"""Process-wide metrics in the Prometheus text format, and opt-in per-request profiling.
+
+Modules create their metrics once at import time with ``counter()``,
+``gauge()`` and ``histogram()``. Recording a value takes one lock and a few
+additions, so instrumentation is always on. ``render()`` produces the
+/metrics page. Every process has its own registry, so when several server
+processes run, each one must be scraped.
+
+``init_app()`` times every request per route. When PROFILE_REQUESTS is set,
+it also runs cProfile for the requests that ask for it with an
+``X-Profile: 1`` header or a ``?profile=1`` query parameter, and writes a
+``.prof`` file per request to PROFILE_DIR.
+"""
+import bisect
+import cProfile
+import itertools
+import os
+import threading
+import time
+
+from flask import g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds, suited to request and query latencies
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in itertools.chain(zip(names, values), extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _lines(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down; with ``fn`` it is read by calling ``fn()`` at scrape time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def _lines(self):
+        if self.fn is not None:
+            yield f'{self.name} {_format_value(self.fn())}'
+        else:
+            yield from super()._lines()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        # Buckets are "less than or equal"; the slot after the last bound is +Inf
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][slot] += 1
+            series[1] += value
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def _lines(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for label_values, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, [('le', _format_value(float(bound)))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class _Timer:
+    # Observes the seconds spent in a with block, also when it raises
+    __slots__ = ('histogram', 'label_values', 'start')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+def _register(metric):
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            # Importing a module twice (e.g. as __main__ and by name) must not fail
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=(), fn=None):
+    return _register(Gauge(name, help, labels, fn))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric._lines())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = histogram('http_request_duration_seconds',
+                            'Time until the response headers are ready, by route', ['method', 'route', 'status'])
+
+_profile_ids = itertools.count(1)
+
+
+def _start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def _observe_request(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        # Streamed responses (exports, /api/events) are timed up to their first byte
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route, str(response.status_code))
+    return response
+
+
+def _profile_requested():
+    return request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1'
+
+
+def _start_profile():
+    if not _profile_requested():
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is active in this process (Python 3.12+ allows only one)
+        return
+    g.profiler = profiler
+
+
+def _save_profile(response, directory):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    endpoint = request.endpoint or 'unmatched'
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_profile_ids)}-{endpoint}.prof"
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, filename))
+    response.headers['X-Profile-Output'] = filename
+    return response
+
+
+def _stop_profile(exc):
+    # A request that failed before its response was built still has its profiler running
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+
+def init_app(app):
+    if app.config.get('PROFILE_REQUESTS'):
+        # Only registered when enabled, so requests pay nothing for profiling otherwise. Registered
+        # first so the after_request hooks (run in reverse) save the profile after the timing
+        directory = app.config['PROFILE_DIR']
+        app.before_request(_start_profile)
+        app.after_request(lambda response: _save_profile(response, directory))
+        app.teardown_request(_stop_profile)
+    app.before_request(_start_timer)
+    app.after_request(_observe_request)
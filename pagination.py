@@ -0,0 +1,78 @@
+"""Keyset (cursor) pagination helpers for the list endpoints."""
+import base64
+import json
+from datetime import datetime, timedelta
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, types):
+    # ``types`` are those of the cursor's values in order, e.g. (str, int) for a timestamp and an id
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise PaginationError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(types):
+        raise PaginationError('Invalid cursor')
+    # JSON true/false decode to bool, which isinstance counts as an int but is no id; ids must also fit
+    # in SQLite's 64-bit integers
+    if any(isinstance(value, bool) or not isinstance(value, kind)
+           or (kind is int and not -2 ** 63 <= value < 2 ** 63) for value, kind in zip(values, types)):
+        raise PaginationError('Invalid cursor')
+    return values
+
+
+def parse_limit(value):
+    if value in (None, ''):
+        return DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError('limit must be a number')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def parse_fields(value, allowed, required):
+    # Projection: a comma separated subset of ``allowed``; ``required`` columns are always returned
+    if not value:
+        return list(allowed)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise PaginationError(f'Unknown fields: {", ".join(unknown)}')
+    return list(required) + [field for field in fields if field not in required]
+
+
+def parse_date_range(date_from, date_to):
+    # Inclusive YYYY-MM-DD bounds, returned as [start, end) timestamps for SQL
+    try:
+        start = datetime.strptime(date_from, '%Y-%m-%d').strftime('%Y-%m-%d') if date_from else None
+        end = (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d') if date_to else None
+    except ValueError:
+        raise PaginationError('Dates must be in YYYY-MM-DD format')
+    return start, end
+
+
+def page(rows, limit, cursor_columns):
+    """Trim the extra look-ahead row and build the next cursor.
+
+    Queries fetch ``limit + 1`` rows; the extra row only tells us whether
+    another page exists.
+    """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor([rows[-1][col] for col in cursor_columns]) if has_more else None
+    return [dict(row) for row in rows], next_cursor
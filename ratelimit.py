@@ -0,0 +1,176 @@
+"""Outbound mail rate limiting: token buckets plus adaptive backoff on throttling replies.
+
+One ``SendThrottle`` is shared by every send worker. It spends a token from
+a per-second bucket and one from a per-day bucket for each message. When
+the server answers with a throttling code (421/454 and friends) it pauses
+all senders, halves the send rate, and then ramps back up as messages get
+through again.
+"""
+import asyncio
+import threading
+import time
+
+# Replies that mean "slow down / try later", not "this message is bad"
+THROTTLE_CODES = {421, 450, 451, 452, 454}
+
+DAY = 24 * 60 * 60
+
+
+def smtp_codes(error):
+    # smtplib sets smtp_code, aiosmtplib sets code; refused recipients carry one code each
+    code = getattr(error, 'smtp_code', None) or getattr(error, 'code', None)
+    if code is not None:
+        return [code]
+    recipients = getattr(error, 'recipients', None)
+    if isinstance(recipients, dict):
+        return [reply[0] for reply in recipients.values()]
+    if isinstance(recipients, list):
+        return [getattr(refused, 'code', None) for refused in recipients]
+    return []
+
+
+def is_throttled(error):
+    codes = smtp_codes(error)
+    return bool(codes) and all(code in THROTTLE_CODES for code in codes)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        # Seconds until one whole token is available (0 if one is there now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class SendThrottle:
+    """Thread-safe limiter for one sending account.
+
+    ``per_second`` is the steady rate and ``burst`` how many messages may go
+    out back to back; ``per_day`` is a rolling daily budget (0 disables it).
+    On a throttling reply ``backoff()`` pauses everyone for an exponentially
+    growing interval (capped at ``max_backoff`` seconds) and halves the
+    rate, never below ``min_rate``; each success wins back a little rate.
+    """
+
+    def __init__(self, per_second=5.0, per_day=0, burst=None, min_rate=0.2, max_backoff=300, retries=8):
+        self.max_rate = float(per_second)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.max_backoff = max_backoff
+        self.retries = retries
+        self._second = TokenBucket(self.max_rate, burst or max(1.0, self.max_rate))
+        self._day = TokenBucket(per_day / DAY, per_day) if per_day else None
+        self._paused_until = 0.0
+        self._streak = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(per_second=config['SEND_RATE_PER_SECOND'], per_day=config['SEND_DAILY_LIMIT'],
+                   burst=config['SEND_BURST'], max_backoff=config['SEND_MAX_BACKOFF'],
+                   retries=config['SEND_THROTTLE_RETRIES'])
+
+    def consume_daily(self, count):
+        # Account for messages already sent in the last day (e.g. before a restart)
+        if self._day is not None:
+            with self._lock:
+                self._day.tokens = max(0.0, self._day.tokens - count)
+
+    def _wait(self, now):
+        # Seconds until a send slot is free (0 if one is free now); the lock must be held
+        if now < self._paused_until:
+            return self._paused_until - now
+        for bucket in self._buckets():
+            bucket.refill(now)
+        return max(bucket.wait_time() for bucket in self._buckets())
+
+    def _buckets(self):
+        return [self._second] + ([self._day] if self._day is not None else [])
+
+    def reserve(self):
+        """Take a send slot if one is free now; otherwise return seconds to wait and take nothing."""
+        with self._lock:
+            wait = self._wait(time.monotonic())
+            if wait > 0:
+                return wait
+            for bucket in self._buckets():
+                bucket.tokens -= 1
+            return 0.0
+
+    def available_in(self):
+        """Seconds until ``reserve()`` would succeed, without taking anything."""
+        with self._lock:
+            return self._wait(time.monotonic())
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def success(self):
+        with self._lock:
+            self._streak = 0
+            # Additive increase: about 25 good sends to recover from one halving
+            self._second.rate = min(self.max_rate, self._second.rate + self.max_rate / 50)
+
+    def backoff(self):
+        """Record a throttling reply; returns the pause in seconds."""
+        with self._lock:
+            now = time.monotonic()
+            # The message was refused, so it did not use up daily quota
+            if self._day is not None:
+                self._day.tokens = min(self._day.capacity, self._day.tokens + 1)
+            if now < self._paused_until:
+                # Other in-flight sends hitting the same limit don't escalate the pause
+                return self._paused_until - now
+            delay = min(self.max_backoff, 2 ** self._streak)
+            self._streak += 1
+            self._paused_until = max(self._paused_until, now + delay)
+            self._second.rate = max(self.min_rate, self._second.rate / 2)
+            self._second.tokens = 0.0
+            self._second.updated = self._paused_until
+            return delay
+
+    def send(self, send_fn, *args):
+        """Call ``send_fn(*args)`` within the limits, retrying throttling replies after backing off."""
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = send_fn(*args)
+            except Exception as e:
+                if not is_throttled(e) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                self.backoff()
+                continue
+            self.success()
+            return result
+
+    def status(self):
+        with self._lock:
+            now = time.monotonic()
+            status = {
+                'rate_per_second': round(self._second.rate, 3),
+                'paused_for': round(max(0.0, self._paused_until - now), 1),
+            }
+            if self._day is not None:
+                self._day.refill(now)
+                status['daily_remaining'] = int(self._day.tokens)
+            return status
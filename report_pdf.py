@@ -0,0 +1,217 @@
+"""Printable report cards, attached to the results email as PDFs.
+
+A sheet is drawn with fpdf2 from the same student dict the email is
+rendered from (see dal.fetch_students). fpdf2 is an optional dependency and
+is only imported where sheets are drawn.
+
+Drawing is CPU-bound, so ``PdfRenderer`` runs it on a process pool (started
+on first use with the 'spawn' method, like analytics.TermAnalytics) and a
+send thread only waits for its own recipients' sheets. Every sheet of a
+layout reuses what that layout needs once per process: the checked font
+and logo paths, and an fpdf2 image cache holding the logo already decoded
+and compressed.
+
+Finished sheets are cached on disk in PDF_CACHE_DIR, named by a hash of the
+layout and of the report's content (``report_fingerprint`` plus the
+assessment labels), so resending an unchanged report reads the file instead
+of drawing it again. A changed result or layout gets a new name; the
+directory can be cleared at any time.
+"""
+import hashlib
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from email_render import report_fingerprint
+
+# Part of every cache key: bump it when the drawing code changes, so sheets of the old layout are not reused
+LAYOUT_VERSION = 1
+
+SHEETS = metrics.counter('pdf_reports_total', 'Report card PDFs attached, by where they came from', ['source'])
+
+
+class PdfError(RuntimeError):
+    pass
+
+
+def sheet_filename(student):
+    name = re.sub(r'[^A-Za-z0-9]+', '-', f"{student['first_name']} {student['last_name']}").strip('-')
+    return f"report-card-{name or student['id']}.pdf"
+
+
+# What the sheets of each layout share, per thread: an image cache counts how often each sheet uses
+# an image, so one cache must not be used by two sheets at once
+_local = threading.local()
+
+
+def _layout_state(layout):
+    states = getattr(_local, 'layouts', None)
+    if states is None:
+        states = _local.layouts = {}
+    state = states.get(layout)
+    if state is None:
+        try:
+            from fpdf import FPDF
+        except ImportError:
+            raise PdfError('PDF attachments require the fpdf2 package')
+        _, font, logo = layout
+        for setting, path in [('PDF_FONT', font), ('PDF_LOGO', logo)]:
+            if path and not os.path.isfile(path):
+                raise PdfError(f'{setting} {path} does not exist')
+        state = states[layout] = {'FPDF': FPDF, 'images': None}
+    return state
+
+
+def render_sheet(layout, student):
+    """The report card of one student as PDF bytes.
+
+    ``layout`` is ``(title, font, logo)``: the heading, and the paths of a
+    TrueType font and of a logo image, either of which may be empty (the
+    built-in Helvetica is used without a font).
+    """
+    state = _layout_state(layout)
+    title, font, logo = layout
+    pdf = state['FPDF'](format='A4')
+    if state['images'] is None:
+        state['images'] = pdf.image_cache
+    else:
+        pdf.image_cache = state['images']
+    pdf.set_title(title)
+    pdf.add_page()
+
+    if font:
+        # fpdf2 embeds the subset of a font each document uses, so a font is registered per document
+        pdf.add_font('report', fname=font)
+
+        def text(value):
+            return '' if value is None else str(value)
+
+        def use_font(size, bold=False):
+            pdf.set_font('report', size=size)
+    else:
+        # The built-in fonts only cover Latin-1
+        def text(value):
+            return '' if value is None else str(value).encode('latin-1', 'replace').decode('latin-1')
+
+        def use_font(size, bold=False):
+            pdf.set_font('helvetica', 'B' if bold else '', size)
+
+    if logo:
+        pdf.image(logo, x=pdf.l_margin, y=pdf.t_margin, h=18)
+    use_font(18, bold=True)
+    pdf.cell(0, 18, text(title), align='C', new_x='LMARGIN', new_y='NEXT')
+    pdf.ln(6)
+
+    use_font(12)
+    for label, value in [('Student', f"{student['first_name']} {student['last_name']}"),
+                         ('Class', student['class'])]:
+        pdf.cell(30, 8, label)
+        pdf.cell(0, 8, text(value), new_x='LMARGIN', new_y='NEXT')
+    pdf.ln(4)
+
+    use_font(12, bold=True)
+    pdf.cell(120, 9, 'Assessment', border=1)
+    pdf.cell(0, 9, 'Score', border=1, align='R', new_x='LMARGIN', new_y='NEXT')
+    use_font(12)
+    for label, score in student['scores']:
+        pdf.cell(120, 8, text(label), border=1)
+        pdf.cell(0, 8, text(score), border=1, align='R', new_x='LMARGIN', new_y='NEXT')
+    use_font(12, bold=True)
+    for label, field in [('Total Score', 'total'), ('Final Grade', 'grade')]:
+        pdf.cell(120, 9, label, border=1)
+        pdf.cell(0, 9, text(student[field]), border=1, align='R', new_x='LMARGIN', new_y='NEXT')
+
+    if student['comments']:
+        pdf.ln(6)
+        use_font(12, bold=True)
+        pdf.cell(0, 8, 'Teacher Comments', new_x='LMARGIN', new_y='NEXT')
+        use_font(12)
+        pdf.multi_cell(0, 7, text(student['comments']))
+
+    data = bytes(pdf.output())
+    state['images'].reset_usages()
+    return data
+
+
+def _render_to_cache(layout, student, path):
+    # Runs on the pool: draw the sheet and store it for the next send of the same report
+    data = render_sheet(layout, student)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return data
+
+
+class PdfRenderer:
+    """Report card PDFs for the send workers, from the disk cache or drawn on a process pool.
+
+    With ``workers`` = 0 sheets are drawn on the calling thread instead.
+    """
+
+    def __init__(self, cache_dir, title='Report Card', font='', logo='', workers=0):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.layout = (title, os.path.abspath(font) if font else '', os.path.abspath(logo) if logo else '')
+        # Replacing the font or logo file (same path) must not reuse sheets drawn with the old one
+        files = [f'{path}:{os.stat(path).st_mtime_ns}:{os.stat(path).st_size}' if os.path.isfile(path) else path
+                 for path in self.layout[1:]]
+        self._layout_key = '\x1f'.join([str(LAYOUT_VERSION), title, *files])
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def cache_path(self, student):
+        # The scores' labels are not part of the fingerprint (they are fixed per term), but they are on the sheet
+        labels = '\x1f'.join(label for label, _ in student['scores'])
+        key = hashlib.sha256('\x1e'.join([self._layout_key, report_fingerprint(student), labels])
+                             .encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f'{key}.pdf')
+
+    def submit(self, student):
+        """A future of the student's sheet as PDF bytes, already done when the sheet is cached."""
+        path = self.cache_path(student)
+        try:
+            with open(path, 'rb') as f:
+                future = Future()
+                future.set_result(f.read())
+            SHEETS.inc('cache')
+            return future
+        except FileNotFoundError:
+            pass
+        SHEETS.inc('rendered')
+        if self.workers > 0:
+            try:
+                return self._get_pool().submit(_render_to_cache, self.layout, student, path)
+            except BrokenProcessPool:
+                # A worker died (killed, out of memory); later sheets get a new pool
+                self.close(wait=False)
+                return self._get_pool().submit(_render_to_cache, self.layout, student, path)
+        future = Future()
+        try:
+            future.set_result(_render_to_cache(self.layout, student, path))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def close(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
@@ -0,0 +1,28 @@
+"""Failure classification and backoff schedule for the send retry queue.
+
+Transient failures (dropped or refused connections, timeouts, 4xx replies)
+are retried later with exponential backoff; permanent ones (5xx replies,
+missing students, bad data) are final on the first attempt.
+"""
+import smtplib
+
+from ratelimit import smtp_codes
+
+# Connection-level problems; aiosmtplib's equivalents subclass ConnectionError/TimeoutError
+TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+def is_transient(error):
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    codes = [code for code in smtp_codes(error) if code is not None]
+    return bool(codes) and all(400 <= code < 500 for code in codes)
+
+
+def retry_delay(attempt, base=60, cap=3600):
+    # Seconds to wait after failed attempt number ``attempt`` (1-based)
+    return min(cap, base * 2 ** (attempt - 1))
+
+
+def describe(error):
+    return f"{type(error).__name__}: {str(error)}"
@@ -0,0 +1,127 @@
+"""Server-side sessions stored in SQLite.
+
+The session cookie carries only a random token; the session itself is a row
+in the ``sessions`` table, keyed by the token's SHA-256 so a copy of the
+database holds no usable cookies. Every server process reads the same rows,
+so a user stays signed in whichever gunicorn worker serves the request, and
+signing out (or ``delete_user_sessions``) takes effect everywhere at once.
+
+Sessions expire after ``PERMANENT_SESSION_LIFETIME`` without a request. The
+expiry slides, but a row is rewritten only once at least half of that time
+has passed, so ordinary requests cost one primary-key SELECT and no write.
+Each row also carries the user's ``settings_version`` (see users.py), which
+lets every process notice changed settings without reading the users table.
+"""
+import hashlib
+import json
+import secrets
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import db
+
+TOKEN_BYTES = 32
+
+
+def init_session_table(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (id TEXT PRIMARY KEY,
+                  user_id INTEGER,
+                  data TEXT NOT NULL,
+                  settings_version INTEGER NOT NULL DEFAULT 0,
+                  expires_at REAL NOT NULL,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+
+
+def _key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def purge_expired(c):
+    return c.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+
+
+def delete_user_sessions(c, user_id):
+    """Sign a user out everywhere, e.g. after a password change."""
+    return c.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,)).rowcount
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, token=None, settings_version=0, expires_at=0.0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.token = token
+        self.new = token is None
+        self.settings_version = settings_version
+        self.expires_at = expires_at
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        """Issue a new token when the session is saved (call on login)."""
+        self.rotate = True
+        self.modified = True
+
+
+class SQLiteSessionInterface(SessionInterface):
+    session_class = ServerSession
+
+    def _connection(self, app):
+        return db.get_connection(app.config['DATABASE'])
+
+    def open_session(self, app, request):
+        token = request.cookies.get(self.get_cookie_name(app))
+        if not token:
+            return self.session_class()
+        row = self._connection(app).execute(
+            "SELECT data, settings_version, expires_at FROM sessions WHERE id = ? AND expires_at > ?",
+            (_key(token), time.time())).fetchone()
+        if row is None:
+            return self.session_class()
+        return self.session_class(json.loads(row['data']), token, row['settings_version'], row['expires_at'])
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        conn = self._connection(app)
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.token is not None and session.modified:
+                conn.execute("DELETE FROM sessions WHERE id = ?", (_key(session.token),))
+                conn.commit()
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+
+        refresh = session.expires_at - now < lifetime / 2
+        if not (session.modified or session.new or refresh):
+            return
+
+        if session.rotate and session.token is not None:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (_key(session.token),))
+        if session.new or session.rotate:
+            session.token = secrets.token_urlsafe(TOKEN_BYTES)
+        # The settings version is set when the row is created; later bumps come from users.py
+        conn.execute('''INSERT INTO sessions (id, user_id, data, settings_version, expires_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (id) DO UPDATE SET user_id = excluded.user_id, data = excluded.data,
+                                                       expires_at = excluded.expires_at''',
+                     (_key(session.token), session.get('user_id'), json.dumps(dict(session)),
+                      session.settings_version, now + lifetime))
+        conn.commit()
+
+        if session.modified or session.new or session.rotate or session.permanent:
+            response.set_cookie(name, session.token, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
@@ -0,0 +1,134 @@
+"""Pool of persistent, authenticated Flask-Mail SMTP connections."""
+import queue
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+# Errors that mean the connection itself is gone, not that the message was bad
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+# Shared with the async engine, which labels its timings engine="async"
+CONNECT_SECONDS = metrics.histogram('smtp_connect_duration_seconds',
+                                    'Time to open and log in to an SMTP connection', ['engine'])
+SEND_SECONDS = metrics.histogram('smtp_send_duration_seconds',
+                                 'Time to hand one message to the SMTP server', ['engine', 'outcome'])
+
+
+class SMTPPool:
+    """Keeps up to ``size`` open connections and hands them out to sender threads.
+
+    Connections come from ``mail.connect()`` so they use the same server,
+    TLS and login settings as ``mail.send()``. Call ``reset()`` after the
+    mail settings change so connections made with old credentials are dropped.
+    """
+
+    def __init__(self, mail, size=4, idle_timeout=60):
+        self.mail = mail
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open_count = 0
+        self._generation = 0
+
+    def _open(self):
+        conn = self.mail.connect()
+        with CONNECT_SECONDS.time('flask-mail'):
+            conn.__enter__()
+        conn.generation = self._generation
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._open_count -= 1
+        try:
+            if conn.host:
+                conn.host.quit()
+        except Exception:
+            pass
+
+    def _usable(self, conn, idle_since):
+        return conn.generation == self._generation and time.monotonic() - idle_since < self.idle_timeout
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+
+            if conn is None:
+                with self._lock:
+                    can_open = self._open_count < self.size
+                    if can_open:
+                        self._open_count += 1
+                if can_open:
+                    try:
+                        return self._open()
+                    except Exception:
+                        with self._lock:
+                            self._open_count -= 1
+                        raise
+
+                # Pool is full; wait for another thread to return a connection
+                try:
+                    conn, idle_since = self._idle.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+            if self._usable(conn, idle_since):
+                return conn
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            self._discard(conn)
+            raise
+        except BaseException:
+            self._checkin(conn)
+            raise
+        else:
+            self._checkin(conn)
+
+    def _checkin(self, conn):
+        # A failed reconnect leaves no host behind; never hand that out again
+        broken = conn.host is None and not self.mail.suppress
+        if broken or conn.generation != self._generation:
+            self._discard(conn)
+        else:
+            self._idle.put((conn, time.monotonic()))
+
+    def send(self, msg):
+        with self.connection() as conn:
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                try:
+                    conn.send(msg)
+                except CONNECTION_ERRORS:
+                    # Server dropped an idle connection; reconnect once and retry
+                    conn.host = None
+                    with CONNECT_SECONDS.time('flask-mail'):
+                        conn.host = conn.configure_host()
+                    conn.send(msg)
+                outcome = 'success'
+            finally:
+                SEND_SECONDS.observe(time.perf_counter() - start, 'flask-mail', outcome)
+
+    def reset(self, mail=None):
+        if mail is not None:
+            self.mail = mail
+        self._generation += 1
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
@@ -0,0 +1,131 @@
+"""Dashboard statistics kept in summary tables.
+
+``user_stats`` holds one row per user with the email counters, and
+``term_stats`` holds a term's student count and averages (one row per
+metric: ``total_students``, ``avg_total`` and ``avg_<assessment code>``),
+so /api/stats is two primary-key lookups and never touches other terms.
+The write paths keep them current: an upload refreshes its term once it
+commits, and every email log entry bumps the sent/failed counters in the
+same transaction. ``rebuild()`` and ``rebuild_terms()`` recompute
+everything from the base tables.
+"""
+
+COUNTER_COLUMNS = ['total_sent', 'total_failed']
+STAT_COLUMNS = COUNTER_COLUMNS
+
+
+def init_stats_table(c):
+    # Migration 3 shape; migration 7 drops the student columns, which moved to term_stats
+    c.execute('''CREATE TABLE IF NOT EXISTS user_stats
+                 (user_id INTEGER PRIMARY KEY,
+                  total_students INTEGER DEFAULT 0,
+                  total_sent INTEGER DEFAULT 0,
+                  total_failed INTEGER DEFAULT 0,
+                  avg_hw1 REAL,
+                  avg_participation REAL,
+                  avg_q1 REAL,
+                  avg_final_khmer REAL,
+                  avg_final_english REAL,
+                  avg_total REAL,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+
+
+def init_term_stats_table(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS term_stats
+                 (term_id INTEGER NOT NULL,
+                  metric TEXT NOT NULL,
+                  value REAL,
+                  PRIMARY KEY (term_id, metric),
+                  FOREIGN KEY (term_id) REFERENCES terms (id)) WITHOUT ROWID''')
+
+
+def _term_metrics(c, term_id):
+    # Both queries only visit the term's students (idx_students_term) and their scores
+    count, avg_total = c.execute("SELECT COUNT(*), AVG(total) FROM students WHERE term_id = ?",
+                                 (term_id,)).fetchone()
+    metrics = {'total_students': count, 'avg_total': avg_total}
+    for code, average in c.execute('''SELECT a.code, t.average FROM assessments a LEFT JOIN
+                                          (SELECT sc.assessment_id, AVG(sc.score) AS average
+                                           FROM students s JOIN scores sc ON sc.student_id = s.id
+                                           WHERE s.term_id = ? GROUP BY sc.assessment_id) t
+                                          ON t.assessment_id = a.id
+                                      WHERE a.term_id = ?''', (term_id, term_id)):
+        metrics[f'avg_{code}'] = average
+    return metrics
+
+
+def refresh_term_stats(c, term_id):
+    # Called once per upload: recompute the student count and averages for one term
+    c.execute("DELETE FROM term_stats WHERE term_id = ?", (term_id,))
+    c.executemany("INSERT INTO term_stats (term_id, metric, value) VALUES (?, ?, ?)",
+                  [(term_id, metric, value) for metric, value in _term_metrics(c, term_id).items()])
+
+
+def get_term_stats(c, term_id):
+    return {row[0]: row[1] for row in c.execute("SELECT metric, value FROM term_stats WHERE term_id = ?",
+                                                  (term_id,))}
+
+
+def record_email(c, user_id, status, delta=1):
+    # Called in the same transaction as the email_logs write it accounts for
+    column = {'success': 'total_sent', 'failed': 'total_failed'}.get(status)
+    if column is None:
+        return
+    c.execute(f'''INSERT INTO user_stats (user_id, {column}) VALUES (?, ?)
+                  ON CONFLICT (user_id) DO UPDATE SET
+                      {column} = {column} + excluded.{column},
+                      updated_at = CURRENT_TIMESTAMP''', (user_id, delta))
+
+
+def get_user_stats(c, user_id):
+    row = c.execute(f"SELECT {', '.join(STAT_COLUMNS)} FROM user_stats WHERE user_id = ?",
+                    (user_id,)).fetchone()
+    stats = dict(zip(STAT_COLUMNS, row)) if row else {}
+    return {col: stats.get(col) or 0 for col in STAT_COLUMNS}
+
+
+def compute_all(c):
+    # Ground truth straight from the base tables, keyed by user id
+    result = {}
+    for row in c.execute('''SELECT sent_by,
+                                   SUM(status = 'success'),
+                                   SUM(status = 'failed')
+                            FROM email_logs WHERE sent_by IS NOT NULL GROUP BY sent_by'''):
+        stats = result.setdefault(row[0], dict.fromkeys(STAT_COLUMNS, 0))
+        stats['total_sent'] = row[1] or 0
+        stats['total_failed'] = row[2] or 0
+    return result
+
+
+def rebuild(c):
+    """Recompute user_stats from scratch; returns the user ids whose row had drifted."""
+    expected = compute_all(c)
+    current = {row[0]: dict(zip(STAT_COLUMNS, row[1:])) for row in
+               c.execute(f"SELECT user_id, {', '.join(STAT_COLUMNS)} FROM user_stats")}
+
+    drifted = []
+    for user_id in set(expected) | set(current):
+        want = expected.get(user_id, dict.fromkeys(STAT_COLUMNS, 0))
+        have = current.get(user_id, {})
+        if any(abs((have.get(col) or 0) - want[col]) > 1e-9 for col in STAT_COLUMNS):
+            drifted.append(user_id)
+
+    c.execute("DELETE FROM user_stats")
+    c.executemany(f'''INSERT INTO user_stats (user_id, {', '.join(STAT_COLUMNS)})
+                      VALUES (?, {', '.join('?' for _ in STAT_COLUMNS)})''',
+                  [(user_id, *(stats[col] for col in STAT_COLUMNS)) for user_id, stats in expected.items()])
+    return sorted(drifted)
+
+
+def rebuild_terms(c):
+    """Recompute term_stats for every term; returns the term ids whose metrics had drifted."""
+    drifted = []
+    for term_id in [row[0] for row in c.execute("SELECT id FROM terms")]:
+        have = get_term_stats(c, term_id)
+        want = _term_metrics(c, term_id)
+        if set(have) != set(want) or any(abs((have[m] or 0) - (want[m] or 0)) > 1e-9 for m in want):
+            drifted.append(term_id)
+            refresh_term_stats(c, term_id)
+    c.execute("DELETE FROM term_stats WHERE term_id NOT IN (SELECT id FROM terms)")
+    return drifted
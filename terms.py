@@ -0,0 +1,214 @@
+"""Terms, classes and the assessment columns each term's spreadsheet carries.
+
+Every user works in one *current* term at a time; uploads, the student list
+and the dashboard statistics default to it and filter on ``term_id``, so
+past terms stay in the database without slowing the current one down.
+
+A ``students`` row is one enrollment: a student in a class (``class_id``,
+with the class name kept alongside for display) in one term. Scores live
+in ``scores`` in long format, one row per student and assessment, and the
+assessments of a term (which spreadsheet columns to read, how to label
+them in the email) are rows in ``assessments`` rather than table columns.
+"""
+import re
+
+# The columns of the original results spreadsheet, used for a user's first term
+DEFAULT_ASSESSMENTS = [
+    {'column': 'HW1', 'label': 'Homework 1 (HW1)'},
+    {'column': 'Participation', 'label': 'Participation'},
+    {'column': 'Q1', 'label': 'Quiz 1 (Q1)'},
+    {'column': 'Final Khmer', 'label': 'Final Exam - Khmer'},
+    {'column': 'Final English', 'label': 'Final Exam - English'},
+]
+DEFAULT_TERM_NAME = 'Term 1'
+
+# Spreadsheet columns every term has besides its assessments (and which assessments may not reuse)
+BASE_COLUMNS = ['first name', 'last name', 'email', 'class', 'total', 'grade', 'comments']
+
+ASSESSMENT_FIELDS = ['id', 'code', 'column_name', 'label', 'position']
+
+
+class TermError(ValueError):
+    pass
+
+
+def init_term_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS terms
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  name TEXT NOT NULL,
+                  is_current INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  UNIQUE (user_id, name),
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS classes
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  term_id INTEGER NOT NULL,
+                  name TEXT NOT NULL,
+                  UNIQUE (term_id, name),
+                  FOREIGN KEY (term_id) REFERENCES terms (id))''')
+
+    # column_name is the spreadsheet header (matched case-insensitively), code its API/stats key
+    c.execute('''CREATE TABLE IF NOT EXISTS assessments
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  term_id INTEGER NOT NULL,
+                  code TEXT NOT NULL,
+                  column_name TEXT NOT NULL,
+                  label TEXT NOT NULL,
+                  position INTEGER NOT NULL,
+                  UNIQUE (term_id, code),
+                  FOREIGN KEY (term_id) REFERENCES terms (id))''')
+
+    # Long format: a missing score is a missing row. Keyed by student, so a term's scores are read
+    # through its students (idx_students_term) and never through other terms' rows.
+    c.execute('''CREATE TABLE IF NOT EXISTS scores
+                 (student_id INTEGER NOT NULL,
+                  assessment_id INTEGER NOT NULL,
+                  score REAL NOT NULL,
+                  PRIMARY KEY (student_id, assessment_id),
+                  FOREIGN KEY (student_id) REFERENCES students (id),
+                  FOREIGN KEY (assessment_id) REFERENCES assessments (id)) WITHOUT ROWID''')
+
+
+def assessment_code(column):
+    code = re.sub(r'[^a-z0-9]+', '_', str(column).strip().lower()).strip('_')
+    if not code:
+        raise TermError(f'Invalid assessment column: {column!r}')
+    return code
+
+
+def parse_assessments(definitions):
+    """Validate a list of ``{'column': ..., 'label': ...}`` dicts (label optional)."""
+    if not isinstance(definitions, list) or not definitions:
+        raise TermError('A term needs at least one assessment')
+    parsed = []
+    seen = set()
+    for definition in definitions:
+        if isinstance(definition, str):
+            definition = {'column': definition}
+        column = str(definition.get('column') or '').strip() if isinstance(definition, dict) else ''
+        if not column:
+            raise TermError('Every assessment needs a column name')
+        if column.lower() in BASE_COLUMNS:
+            raise TermError(f'"{column}" is a base column, not an assessment')
+        code = assessment_code(column)
+        if code in seen:
+            raise TermError(f'Assessment "{column}" is listed twice')
+        seen.add(code)
+        parsed.append({'code': code, 'column_name': column,
+                       'label': str(definition.get('label') or column).strip()})
+    return parsed
+
+
+def get_assessments(c, term_id):
+    rows = c.execute(f"SELECT {', '.join(ASSESSMENT_FIELDS)} FROM assessments WHERE term_id = ? ORDER BY position",
+                     (term_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _add_assessments(c, term_id, assessments):
+    c.executemany('''INSERT INTO assessments (term_id, code, column_name, label, position)
+                     VALUES (?, ?, ?, ?, ?)''',
+                  [(term_id, a['code'], a['column_name'], a['label'], position)
+                   for position, a in enumerate(assessments)])
+
+
+def create_term(c, user_id, name, assessments=None, make_current=True):
+    """Create a term; without ``assessments`` it takes the current term's (or the defaults)."""
+    name = str(name or '').strip()
+    if not name:
+        raise TermError('Term name is required')
+    if c.execute("SELECT 1 FROM terms WHERE user_id = ? AND name = ?", (user_id, name)).fetchone():
+        raise TermError(f'Term "{name}" already exists')
+
+    if assessments is None:
+        current = get_current_term(c, user_id, create=False)
+        assessments = get_assessments(c, current['id']) if current else parse_assessments(DEFAULT_ASSESSMENTS)
+    else:
+        assessments = parse_assessments(assessments)
+
+    term_id = c.execute("INSERT INTO terms (user_id, name) VALUES (?, ?)", (user_id, name)).lastrowid
+    _add_assessments(c, term_id, assessments)
+    if make_current:
+        set_current_term(c, user_id, term_id)
+    return get_term(c, user_id, term_id)
+
+
+def set_current_term(c, user_id, term_id):
+    c.execute("UPDATE terms SET is_current = (id = ?) WHERE user_id = ?", (term_id, user_id))
+
+
+def get_term(c, user_id, term_id):
+    row = c.execute("SELECT id, name, is_current, created_at FROM terms WHERE id = ? AND user_id = ?",
+                    (term_id, user_id)).fetchone()
+    return dict(row) if row else None
+
+
+def get_current_term(c, user_id, create=True):
+    row = c.execute("SELECT id, name, is_current, created_at FROM terms WHERE user_id = ? AND is_current = 1",
+                    (user_id,)).fetchone()
+    if row:
+        return dict(row)
+    if not create:
+        return None
+    return create_term(c, user_id, DEFAULT_TERM_NAME, DEFAULT_ASSESSMENTS)
+
+
+def resolve_term(c, user_id, term_id=None):
+    """The term named by a request's ``term_id`` (must belong to the user), or the current one."""
+    if term_id in (None, ''):
+        return get_current_term(c, user_id)
+    try:
+        term_id = int(term_id)
+    except (TypeError, ValueError):
+        raise TermError('Invalid term_id')
+    term = get_term(c, user_id, term_id)
+    if term is None:
+        raise TermError('Term not found')
+    return term
+
+
+def list_terms(c, user_id):
+    rows = c.execute('''SELECT t.id, t.name, t.is_current, t.created_at,
+                               (SELECT COUNT(*) FROM students s WHERE s.term_id = t.id) AS students
+                        FROM terms t WHERE t.user_id = ? ORDER BY t.id''', (user_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def list_classes(c, term_id):
+    rows = c.execute('''SELECT cl.id, cl.name,
+                               (SELECT COUNT(*) FROM students s WHERE s.term_id = cl.term_id
+                                AND s.class_id = cl.id) AS students
+                        FROM classes cl WHERE cl.term_id = ? ORDER BY cl.name''', (term_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def ensure_classes(c, term_id, names):
+    """Map class names to ids for a term, creating the missing classes."""
+    names = [name for name in dict.fromkeys(names) if name]
+    c.executemany("INSERT OR IGNORE INTO classes (term_id, name) VALUES (?, ?)", [(term_id, name) for name in names])
+    return {row[1]: row[0] for row in c.execute("SELECT id, name FROM classes WHERE term_id = ?", (term_id,))}
+
+
+def backfill_terms(c):
+    """Migration step: move existing students into a first term with the original assessments.
+
+    Runs while the legacy score columns still exist on ``students``.
+    """
+    defaults = parse_assessments(DEFAULT_ASSESSMENTS)
+    user_ids = [row[0] for row in c.execute("SELECT DISTINCT uploaded_by FROM students WHERE uploaded_by IS NOT NULL")]
+    for user_id in user_ids:
+        term_id = c.execute("INSERT INTO terms (user_id, name, is_current) VALUES (?, ?, 1)",
+                            (user_id, DEFAULT_TERM_NAME)).lastrowid
+        _add_assessments(c, term_id, defaults)
+        c.execute("INSERT INTO classes (term_id, name) SELECT DISTINCT ?, class FROM students "
+                  "WHERE uploaded_by = ? AND class IS NOT NULL AND class != ''", (term_id, user_id))
+        c.execute('''UPDATE students SET term_id = ?,
+                         class_id = (SELECT id FROM classes WHERE term_id = ? AND name = students.class)
+                     WHERE uploaded_by = ?''', (term_id, term_id, user_id))
+        for a in get_assessments(c, term_id):
+            # The legacy column names are exactly the default assessment codes
+            c.execute(f'''INSERT INTO scores (student_id, assessment_id, score)
+                          SELECT id, ?, {a['code']} FROM students
+                          WHERE term_id = ? AND {a['code']} IS NOT NULL''', (a['id'], term_id))
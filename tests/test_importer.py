@@ -0,0 +1,48 @@
+"""Chunked imports read text columns the same way whatever the chunk boundaries."""
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from importer import iter_frames, normalize_frame
+
+HEADER = ['First Name', 'Last Name', 'Email', 'Class', 'HW1', 'Participation', 'Q1',
+          'Final Khmer', 'Final English', 'Total', 'Grade', 'Comments']
+# A numeric class, with empty cells in some rows (and so in some chunks but not others)
+ROWS = [[f'F{i}', f'L{i}', f's{i}@example.com', '' if i % 3 == 1 else 3, 90, 90, 90, 90, 90, 450, 'A', '']
+        for i in range(7)]
+
+
+def imported_classes(stream, filename, chunk_size):
+    classes = set()
+    offset = 0
+    for df in iter_frames(stream, filename, chunk_size):
+        df = normalize_frame(df, offset)
+        offset += len(df)
+        classes.update(df['class'].dropna())
+    return classes
+
+
+@pytest.mark.parametrize('chunk_size', range(1, len(ROWS) + 1))
+def test_csv_numeric_class_with_gaps(chunk_size):
+    lines = [','.join(HEADER)] + [','.join(str(value) for value in row) for row in ROWS]
+    stream = io.BytesIO('\n'.join(lines).encode())
+    assert imported_classes(stream, 'term.csv', chunk_size) == {'3'}
+
+
+@pytest.mark.parametrize('chunk_size', range(1, len(ROWS) + 1))
+def test_xlsx_numeric_class_with_gaps(chunk_size):
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(HEADER)
+    for row in ROWS:
+        sheet.append([None if value == '' else value for value in row])
+    stream = io.BytesIO()
+    workbook.save(stream)
+    stream.seek(0)
+    assert imported_classes(stream, 'term.xlsx', chunk_size) == {'3'}
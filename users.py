@@ -0,0 +1,80 @@
+"""The signed-in user's row and settings, cached in each process.
+
+Every API request needs some of the user's settings: the current term,
+and for sends the user's mail accounts (without their passwords).
+``UserCache`` keeps the row and settings per user, LRU bounded and with a
+TTL, so a hot request reads neither the users nor the terms table.
+
+Entries are keyed on ``users.settings_version``. Whatever changes a user's
+settings calls ``bump_settings_version`` in the same transaction; it also
+copies the new version onto the user's session rows, which every request
+loads anyway (see sessions.py). A process holding an older entry therefore
+sees the version change with the next request and reloads. The TTL only
+bounds how long an unversioned change (an edit made directly in the
+database) can go unseen.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from mailers import list_accounts
+from terms import get_current_term
+
+USER_FIELDS = ['id', 'username', 'email', 'full_name', 'settings_version']
+
+
+def get_user(c, user_id):
+    row = c.execute(f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE id = ?", (user_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def load_settings(c, user_id):
+    """The user's row and settings; ``current_term`` is None until the user's first term exists."""
+    user = get_user(c, user_id)
+    if user is None:
+        return None
+    return {'user': user, 'current_term': get_current_term(c, user_id, create=False),
+            'mail_accounts': list_accounts(c, user_id)}
+
+
+def bump_settings_version(c, user_id):
+    """Mark the user's settings as changed, in this process and every other one. Returns the new version."""
+    c.execute("UPDATE users SET settings_version = settings_version + 1 WHERE id = ?", (user_id,))
+    version = c.execute("SELECT settings_version FROM users WHERE id = ?", (user_id,)).fetchone()[0]
+    c.execute("UPDATE sessions SET settings_version = ? WHERE user_id = ?", (version, user_id))
+    return version
+
+
+class UserCache:
+    """Up to ``size`` users' settings, each reused for ``ttl`` seconds while its version is unchanged."""
+
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, c, user_id, version):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == version and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                return entry[2]
+        # Loaded outside the lock; the version was read (with the session) before the data
+        settings = load_settings(c, user_id)
+        if settings is not None:
+            with self._lock:
+                self._entries[user_id] = (version, now + self.ttl, settings)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return settings
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,12 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    waitress-serve --listen=0.0.0.0:8000 wsgi:app
+
+Every server process calls create_app(). Under gunicorn the master has
+already migrated the schema (see gunicorn.conf.py), so the workers find it
+up to date. Only one process runs the send workers.
+"""
+from app import create_app
+
+app = create_app()